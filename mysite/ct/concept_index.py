@@ -0,0 +1,321 @@
+"""
+In-process autocomplete index of Concept titles.
+
+Each process keeps, separately for error and non-error concepts, a sorted
+list of the words of their titles, each with the IDs of the concepts it
+occurs in.  A query finds the words starting with its longest word by
+binary search, then keeps the concepts whose titles have a word starting
+with each of the other query words, so "new yo" finds "New York City".
+
+The index is loaded in a background thread when a gunicorn worker
+starts (see mysite/gunicorn_conf.py), or on first use.  Until loaded,
+search() returns None and callers fall back to the db.  A process forked
+while its parent was loading starts over, without the parent's lock or
+pending updates.  Concept post_save / post_delete
+signals keep it current in this process; concepts added by other
+processes are picked up every CONCEPT_INDEX_REFRESH_INTERVAL seconds.
+Renames and deletes are also logged in the Django cache, as a change
+count plus one key per change holding the concept ID, so every search
+first checks the count and reindexes just the concepts changed since
+its last look.  If those keys are gone (evicted, or the count was
+reset), the index is reloaded in the background.
+At most CONCEPT_INDEX_MAX_SIZE concepts are indexed, to bound memory.
+"""
+import bisect
+import logging
+import os
+import re
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+
+# max concepts indexed per process (roughly 200 bytes each)
+CONCEPT_INDEX_MAX_SIZE = getattr(settings, 'CONCEPT_INDEX_MAX_SIZE', 1000000)
+
+# seconds between checks for concepts added by other processes
+CONCEPT_INDEX_REFRESH_INTERVAL = getattr(
+    settings, 'CONCEPT_INDEX_REFRESH_INTERVAL', 60.
+)
+
+# max concept IDs examined per query
+CONCEPT_INDEX_SCAN_LIMIT = getattr(settings, 'CONCEPT_INDEX_SCAN_LIMIT', 2000)
+
+# matches ranked per result requested; scanning stops when there are enough
+CONCEPT_INDEX_CANDIDATES = getattr(settings, 'CONCEPT_INDEX_CANDIDATES', 10)
+
+# max renames / deletes applied one by one; more trigger a full reload
+CONCEPT_INDEX_MAX_CHANGES = getattr(settings, 'CONCEPT_INDEX_MAX_CHANGES',
+                                    1000)
+
+CHANGE_COUNT_KEY = 'concept_index_changes'
+CHANGE_KEY = 'concept_index_change_%d'
+CHANGE_TIMEOUT = 3600  # seconds a change stays readable by other processes
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+LOGGER = logging.getLogger(__name__)
+
+_lock = threading.Lock()  # guards ConceptIndex per-process reset
+
+
+def get_words(title):
+    'distinct lower-case words of title'
+    return sorted(set(WORD_RE.findall(title.lower())))
+
+
+def get_change_count():
+    'number of concept renames / deletes logged by mark_changed()'
+    return cache.get(CHANGE_COUNT_KEY, 0)
+
+
+class ConceptTitleIndex(object):
+    """
+    Word-prefix index over one set of concept titles: a sorted list of
+    the distinct title words, each with an array of the IDs of concepts
+    whose titles contain it.  Not thread-safe: ConceptIndex serializes
+    access.
+    """
+    def __init__(self, items=(), maxSize=CONCEPT_INDEX_MAX_SIZE):
+        'build index from (conceptID, title) items'
+        self.maxSize = maxSize
+        self.complete = True  # False if concepts were left out
+        self.titles = {}
+        self.postings = {}
+        for conceptID, title in items:
+            if len(self.titles) >= maxSize:
+                self.complete = False
+                break
+            self.titles[conceptID] = title
+            for word in get_words(title):
+                try:
+                    self.postings[word].append(conceptID)
+                except KeyError:
+                    self.postings[word] = array('l', (conceptID,))
+        self.words = sorted(self.postings)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def add(self, conceptID, title):
+        'index a new concept, or reindex a renamed one'
+        if conceptID in self.titles:
+            self.remove(conceptID)
+        elif len(self.titles) >= self.maxSize:
+            self.complete = False
+            return
+        self.titles[conceptID] = title
+        for word in get_words(title):
+            if word not in self.postings:
+                self.postings[word] = array('l')
+                bisect.insort(self.words, word)
+            self.postings[word].append(conceptID)
+
+    def remove(self, conceptID):
+        title = self.titles.pop(conceptID, None)
+        if title is None:
+            return
+        for word in get_words(title):
+            ids = self.postings[word]
+            ids.remove(conceptID)
+            if not ids:
+                del self.postings[word]
+                del self.words[bisect.bisect_left(self.words, word)]
+
+    def search(self, q, limit=10):
+        '''list of up to limit (conceptID, title) whose titles have words
+        starting with each word of q; titles starting with q come first,
+        then shorter titles'''
+        words = get_words(q)
+        if not words:
+            return []
+        words.sort(key=len, reverse=True)
+        first, others = words[0], words[1:]
+        matches, nScanned = set(), 0
+        maxMatches = limit * CONCEPT_INDEX_CANDIDATES
+        i = bisect.bisect_left(self.words, first)
+        while i < len(self.words) and nScanned < CONCEPT_INDEX_SCAN_LIMIT \
+                and len(matches) < maxMatches:
+            word = self.words[i]
+            if not word.startswith(first):
+                break
+            i += 1
+            for conceptID in self.postings[word]:
+                nScanned += 1
+                if conceptID in matches:
+                    continue
+                if others:
+                    titleWords = get_words(self.titles[conceptID])
+                    if not all(any(w.startswith(o) for w in titleWords)
+                               for o in others):
+                        continue
+                matches.add(conceptID)
+        q = q.strip().lower()
+        results = [(conceptID, self.titles[conceptID]) for conceptID in matches]
+        results.sort(key=lambda t: (not t[1].lower().startswith(q),
+                                    len(t[1]), t[1].lower()))
+        return results[:limit]
+
+
+class ConceptIndex(object):
+    """
+    Thread-safe error / non-error ConceptTitleIndex pair for this process.
+    """
+    def __init__(self, maxSize=CONCEPT_INDEX_MAX_SIZE,
+                 refreshInterval=CONCEPT_INDEX_REFRESH_INTERVAL):
+        self.maxSize = maxSize
+        self.refreshInterval = refreshInterval
+        self._indexes = None  # {isError: ConceptTitleIndex} once loaded
+        self._maxID = 0
+        self._changeCount = 0  # CHANGE_COUNT_KEY value already applied
+        self._lastRefresh = 0
+        self._pid = None
+        self._init_process()
+
+    def _init_process(self):
+        '''after a fork, drop the parent's lock and any load in progress
+        (its thread did not survive the fork); a completed index is kept'''
+        with _lock:
+            if self._pid == os.getpid():
+                return
+            self._lock = threading.Lock()
+            if getattr(self, '_loading', False):
+                self._indexes = None
+            self._loading = False
+            self._pending = []  # updates received while loading
+            self._pid = os.getpid()
+
+    def load(self):
+        'build the index from the db, replacing any current one'
+        from ct.models import Concept
+        self._init_process()
+        with self._lock:
+            self._loading = True
+            self._pending = []
+        changeCount = get_change_count()  # changes after this get reapplied
+        try:
+            rows = Concept.objects.order_by('-pk') \
+                .values_list('pk', 'title', 'isError')
+            items = {False: [], True: []}
+            maxID = 0
+            for conceptID, title, isError in rows.iterator():
+                maxID = max(maxID, conceptID)
+                items[isError].append((conceptID, title))
+            indexes = dict((isError, ConceptTitleIndex(l, self.maxSize))
+                           for isError, l in items.items())
+        finally:
+            with self._lock:
+                self._loading = False
+        with self._lock:
+            self._indexes = indexes
+            self._maxID = maxID
+            self._changeCount = changeCount
+            self._lastRefresh = time.time()
+            for args in self._pending:
+                self._update(*args)
+            self._pending = []
+        return sum(len(index) for index in indexes.values())
+
+    def start_loading(self):
+        'load the index in a background thread'
+        self._init_process()
+        def run():
+            try:
+                self.load()
+            except Exception:
+                LOGGER.exception('concept index load failed')
+        thread = threading.Thread(target=run, name='concept-index-load')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def clear(self):
+        self._init_process()
+        with self._lock:
+            self._indexes = None
+
+    def _update(self, conceptID, title=None, isError=False):
+        'add / reindex (or with title None, remove) one concept'
+        self._maxID = max(self._maxID, conceptID)
+        for flag, index in self._indexes.items():
+            if title is not None and flag == isError:
+                index.add(conceptID, title)
+            else:
+                index.remove(conceptID)
+
+    def update(self, conceptID, title=None, isError=False):
+        self._init_process()
+        with self._lock:
+            if self._loading:
+                self._pending.append((conceptID, title, isError))
+            elif self._indexes is not None:
+                self._update(conceptID, title, isError)
+
+    def refresh(self, changeCount=None):
+        '''add concepts created by other processes since our last look,
+        and reindex those they renamed or deleted (see mark_changed())'''
+        from ct.models import Concept
+        if changeCount is None:
+            changeCount = get_change_count()
+        with self._lock:
+            if self._loading:
+                return
+            maxID, seen = self._maxID, self._changeCount
+            self._lastRefresh = time.time()
+        changed = set()
+        if changeCount != seen:
+            keys = [CHANGE_KEY % i for i in range(seen + 1, changeCount + 1)]
+            found = cache.get_many(keys) \
+                if len(keys) <= CONCEPT_INDEX_MAX_CHANGES else {}
+            if not keys or len(found) < len(keys):  # lost track of changes
+                self.start_loading()
+                return
+            changed = set(found.values())
+        rows = list(Concept.objects
+                    .filter(Q(pk__gt=maxID) | Q(pk__in=changed))
+                    .values_list('pk', 'title', 'isError'))
+        with self._lock:
+            if self._loading or self._changeCount != seen:
+                return  # a load or another refresh got there first
+            for row in rows:
+                self._update(*row)
+            for conceptID in changed - set(row[0] for row in rows):
+                self._update(conceptID)  # deleted
+            self._changeCount = changeCount
+
+    @staticmethod
+    def mark_changed(conceptID):
+        'tell all processes that this concept was renamed or deleted'
+        cache.add(CHANGE_COUNT_KEY, 0, None)  # first change, or evicted
+        try:
+            n = cache.incr(CHANGE_COUNT_KEY)
+        except ValueError:  # cache down: others see it at their next reload
+            LOGGER.warning('cannot log change of concept %d', conceptID)
+            return
+        cache.set(CHANGE_KEY % n, conceptID, CHANGE_TIMEOUT)
+
+    def search(self, q, isError=False, limit=10):
+        '''list of (conceptID, title) matching q, or None if the index
+        cannot answer (not loaded yet, or too small to be complete)'''
+        self._init_process()
+        if self._indexes is None:
+            if self._loading:
+                return None
+            self.load()
+        changeCount = get_change_count()
+        if changeCount != self._changeCount or \
+                time.time() - self._lastRefresh > self.refreshInterval:
+            self.refresh(changeCount)
+        with self._lock:
+            index = self._indexes[isError]
+            results = index.search(q, limit)
+            if len(results) < limit and not index.complete:
+                return None
+        return results
+
+
+concept_index = ConceptIndex()
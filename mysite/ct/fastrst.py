@@ -0,0 +1,307 @@
+"""
+Pure-Python renderer for the simple RST subset most lesson texts use.
+
+render(txt) returns exactly the HTML that ``pandoc -f rst -t html
+--mathjax`` (pandoc >= 2) produces, or None if txt uses anything outside
+the supported subset, in which case the caller must fall back to pandoc.
+ct_extras only uses it with pandoc >= 2 installed (see fast_path_ok()).
+Supported: paragraphs, tight bullet / enumerated lists of one paragraph
+per item, ``*emphasis*``, ``**strong**``, ````literal````, backslash
+escapes, the :math: role, and single-line ``.. math::`` and
+``.. image:: STATICIMAGE/...`` directives (the latter with an optional
+integer percentage :width:).  Audio/video directives reach this module
+as plain-text markers (see ct_extras.render_rst()).
+
+Anything ambiguous is rejected rather than guessed at: every construct
+whose meaning depends on context (sections, targets, references,
+substitutions, block quotes, definition lists, literal blocks, tables,
+autolinks...) makes render() return None.
+"""
+import re
+import unicodedata
+
+
+WRAP_COLUMN = 72  # pandoc's default --columns
+
+BulletPat = re.compile(r'^([-*+]) (?=\S)')
+EnumPat = re.compile(r'^(#|[0-9]+)\. (?=\S)')
+ListLikePat = re.compile(r'^(\(?[A-Za-z0-9#]+[.)]|[-*+]|>>>)(\s|$)')
+AdornmentPat = re.compile(r'^([!-/:-@[-`{-~])\1*$')  # section underline
+ImagePat = re.compile(r'^\.\. image:: (STATICIMAGE/[A-Za-z0-9_./-]+)$')
+ImageWidthPat = re.compile(r'^   :width: ([0-9]+)%$')
+MathDirectivePat = re.compile(r'^\.\. math:: (\S.*)$')
+UnsupportedTextPat = re.compile(r'[|_`*\t\x00-\x1f\x7f]|://|@')
+# ASCII punctuation that may start a line of paragraph text
+LineStartChars = u'*(":\'\\`'
+# characters that may precede an inline markup start-string, and follow an
+# end-string, chosen conservatively from docutils' rules
+StartPrefix = u' \n('
+EndSuffix = u' \n.,;:!?)\'-'
+
+
+class Unsupported(Exception):
+    'text uses RST outside the fast-path subset'
+    pass
+
+
+def render(txt):
+    'get pandoc-identical HTML for txt, or None if not in our subset'
+    try:
+        if isinstance(txt, str):
+            txt = txt.decode('utf-8')
+        return u''.join(block + u'\n' for block in _blocks(txt)) or u'\n'
+    except (Unsupported, UnicodeDecodeError):
+        return None
+
+
+def _blocks(txt):
+    'generate rendered HTML blocks'
+    lines = txt.replace(u'\r\n', u'\n').replace(u'\r', u'\n').split(u'\n')
+    lines = [line.rstrip(u' ') for line in lines]
+    i = 0
+    while i < len(lines):
+        if not lines[i]:
+            i += 1
+            continue
+        if BulletPat.match(lines[i]) or EnumPat.match(lines[i]):
+            i, html = _list(lines, i)
+        else:
+            j = i
+            while j < len(lines) and lines[j]:
+                j += 1
+            if lines[i].startswith(u'.. image::'):
+                html = _image(lines[i:j])
+            elif lines[i].startswith(u'.. math::'):
+                html = _math_directive(lines[i:j])
+            else:
+                html = _paragraph(lines[i:j])
+            i = j
+        yield html
+
+
+def _check_line(line):
+    'reject block-level syntax we do not handle'
+    c = line[0]
+    if ((not c.isalnum() and c not in LineStartChars) or c == u'_' or
+            line.endswith(u'::') or ListLikePat.match(line) or
+            AdornmentPat.match(line) or
+            (c == u':' and not line.startswith(u':math:`'))):
+        raise Unsupported(line)
+
+
+def _paragraph(lines):
+    for line in lines:
+        _check_line(line)
+    return _wrap(_inline(u'\n'.join(lines), u'<p>', u'</p>'))
+
+
+def _image(lines):
+    m = ImagePat.match(lines[0])
+    if not m or len(lines) > 2:
+        raise Unsupported(lines[0])
+    style = u''
+    if len(lines) == 2:
+        w = ImageWidthPat.match(lines[1])
+        if not w:
+            raise Unsupported(lines[1])
+        style = u' style="width:%d.0%%"' % int(w.group(1))
+    return _wrap([u'<p><img', u'src="%s"%s' % (m.group(1), style),
+                  u'alt="image"', u'/></p>'])
+
+
+def _math_directive(lines):
+    m = MathDirectivePat.match(lines[0])
+    if not m or len(lines) > 1:
+        raise Unsupported(lines[0])
+    words = _math_words(m.group(1), display=True)
+    words[0] = u'<p>' + words[0]
+    words[-1] += u'</p>'
+    return _wrap(words)
+
+
+def _list(lines, i):
+    'parse a tight list starting at line i; returns (next line, html)'
+    m = BulletPat.match(lines[i]) or EnumPat.match(lines[i])
+    marker = m.group(1)
+    if marker in u'-*+':
+        pat, tag, start = BulletPat, u'<ul>', None
+    elif marker == u'#':
+        pat, tag, start = EnumPat, u'<ol>', None
+    else:
+        pat, start = EnumPat, int(marker)
+        tag = u'<ol type="1">' if start == 1 \
+            else u'<ol start="%d" type="1">' % start
+    items = []
+    while i < len(lines):
+        m = pat.match(lines[i])
+        if not m:
+            break
+        if m.group(1) != (marker if start is None
+                          else str(start + len(items))):
+            raise Unsupported(lines[i])
+        indent = len(m.group(0))
+        item = [lines[i][indent:]]
+        i += 1
+        while i < len(lines) and lines[i] and not pat.match(lines[i]):
+            if lines[i][:indent].strip() or lines[i][indent] == u' ':
+                raise Unsupported(lines[i])
+            item.append(lines[i][indent:])
+            i += 1
+        for line in item:
+            _check_line(line)
+        items.append(item)
+        while i < len(lines) and not lines[i]:
+            i += 1
+        if i < len(lines) and lines[i].startswith(u' '):
+            raise Unsupported(lines[i])  # multi-paragraph item
+    if i < len(lines) and (BulletPat.match(lines[i]) or
+                           EnumPat.match(lines[i])):
+        raise Unsupported(lines[i])  # a different list follows directly
+    html = [tag]
+    for item in items:
+        html.append(_wrap(_inline(u'\n'.join(item), u'<li>', u'</li>')))
+    html.append(u'</%s>' % tag[1:3])
+    return i, u'\n'.join(html)
+
+
+def _escape(s):
+    return s.replace(u'&', u'&amp;').replace(u'<', u'&lt;') \
+        .replace(u'>', u'&gt;')
+
+
+def _check_unicode(s):
+    'reject characters that pandoc spaces or measures differently'
+    for c in s:
+        if ord(c) > 127 and (unicodedata.combining(c) or
+                             unicodedata.category(c) in ('Zs', 'Zl', 'Zp',
+                                                         'Cf', 'Cc') or
+                             unicodedata.east_asian_width(c) in 'WF'):
+            raise Unsupported(s)
+
+
+def _math_words(math, display=False):
+    'get breakable pieces of a math span'
+    if (math != math.strip() or u'  ' in math or u'\n' in math or
+            u'`' in math):
+        raise Unsupported(math)
+    _check_unicode(math)
+    if display:
+        cls, words = u'math display', (u'\\[' + _escape(math) + u'\\]')
+    else:
+        cls, words = u'math inline', (u'\\(' + _escape(math) + u'\\)')
+    words = words.split(u' ')
+    words[0] = u'class="%s">%s' % (cls, words[0])
+    words[-1] += u'</span>'
+    return [u'<span'] + words
+
+
+def _can_start(s, i):
+    'may inline markup start at s[i]?'
+    return i == 0 or (s[i - 1] in StartPrefix and
+                      not (i > 1 and s[i - 2] == u'\\'))
+
+
+def _find_end(s, pos, end):
+    'find inline markup end-string after pos, checking docutils rules'
+    k = s.find(end, pos)
+    if k <= pos or s[pos] in u' \n' or s[k - 1] in u' \n\\':
+        raise Unsupported(s[pos:])
+    after = s[k + len(end):k + len(end) + 1]
+    if after and after not in EndSuffix:
+        raise Unsupported(s[pos:])
+    return k
+
+
+class _Words(object):
+    """
+    Output HTML of a paragraph as a list of words, i.e. the pieces that
+    pandoc may put line breaks between.
+    """
+    def __init__(self, head):
+        self.words = [head]
+        self.glue = True  # append next piece to last word?
+
+    def add(self, piece):
+        if self.glue:
+            self.words[-1] += piece
+        else:
+            self.words.append(piece)
+        self.glue = True
+
+    def add_words(self, pieces):
+        self.add(pieces[0])
+        self.words.extend(pieces[1:])
+
+    def add_text(self, text):
+        if UnsupportedTextPat.search(text):
+            raise Unsupported(text)
+        _check_unicode(text)
+        for k, piece in enumerate(text.replace(u'\n', u' ').split(u' ')):
+            if k:
+                self.glue = False
+            if piece:
+                self.add(_escape(piece))
+
+
+def _inline(s, head, tail):
+    'parse inline markup of one paragraph into breakable words'
+    out = _Words(head)
+    i, n = 0, len(s)
+    while i < n:
+        c = s[i]
+        if c in u' \n':
+            out.glue = False
+            i += 1
+        elif c in u'*`' and not _can_start(s, i):
+            raise Unsupported(s[i:])
+        elif s.startswith(u'``', i):
+            k = _find_end(s, i + 2, u'``')
+            lit = s[i + 2:k]
+            if u'\n' in lit or u'\t' in lit:
+                raise Unsupported(lit)
+            _check_unicode(lit)
+            out.add(u'<code>' + _escape(lit) + u'</code>')
+            i = k + 2
+        elif s.startswith(u':math:`', i):
+            if not _can_start(s, i):
+                raise Unsupported(s[i:])
+            k = _find_end(s, i + 7, u'`')
+            out.add_words(_math_words(s[i + 7:k]))
+            i = k + 1
+        elif s.startswith(u'**', i):
+            k = _find_end(s, i + 2, u'**')
+            out.add(u'<strong>')
+            out.add_text(s[i + 2:k])
+            out.add(u'</strong>')
+            i = k + 2
+        elif c == u'*':
+            k = _find_end(s, i + 1, u'*')
+            out.add(u'<em>')
+            out.add_text(s[i + 1:k])
+            out.add(u'</em>')
+            i = k + 1
+        elif c == u'\\':
+            if i + 1 >= n or s[i + 1].isspace() or s[i + 1].isalnum():
+                raise Unsupported(s[i:])
+            out.add(_escape(s[i + 1]))
+            i += 2
+        else:  # plain text up to the next possible markup
+            k = i + 1
+            while (k < n and s[k] not in u' \n*`\\' and
+                   not s.startswith(u':math:`', k)):
+                k += 1
+            out.add_text(s[i:k])
+            i = k
+    out.words[-1] += tail
+    return out.words
+
+
+def _wrap(words):
+    'join words with spaces / newlines, greedily filling WRAP_COLUMN'
+    lines = [words[0]]
+    for word in words[1:]:
+        if len(lines[-1]) + 1 + len(word) <= WRAP_COLUMN:
+            lines[-1] += u' ' + word
+        else:
+            lines.append(word)
+    return u'\n'.join(lines)
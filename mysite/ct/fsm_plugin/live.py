@@ -1,13 +1,12 @@
-from fsm.models import ActivityLog
+from fsm.models import ActivityLog, LiveSession
+from ct.models import ResponseTally
 
 
 def quit_edge(self, edge, fsmStack, request, **kwargs):
     """
     Edge method that terminates this live-session.
     """
-    for studentState in fsmStack.state.linkChildren.all():
-        studentState.linkState = None  # detach from our state
-        studentState.save()
+    LiveSession.end(fsmStack.state)  # also detaches our students
     return edge.toNode
 
 
@@ -35,8 +34,11 @@ class START(object):
             course=course
         )  # create a new activity
         activity.save()
+        ResponseTally.start_session(activity)
         fsmStack.state.activity = activity
         fsmStack.state.isLiveSession = True
+        fsmStack.state.save()  # registry needs our pk
+        LiveSession.start(fsmStack.state, course)
         return node.get_path(fsmStack.state, request, **kwargs)
     # node specification data goes here
     path = 'fsm:fsm_node'
@@ -1,3 +1,6 @@
+from ct.models import ResponseTally
+
+
 def ask_edge(self, edge, fsmStack, request, **kwargs):
     """
     Try to transition to ASK, or WAIT_ASK if not ready.
@@ -39,6 +42,7 @@ class START(object):
     def start_event(self, node, fsmStack, request, **kwargs):
         'event handler for START node'
         fsmStack.state.activity = fsmStack.state.linkState.activity
+        ResponseTally.add_student(fsmStack.state.activity_id)
         unit = fsmStack.state.linkState.get_data_attr('unit')
         course = fsmStack.state.linkState.get_data_attr('course')
         fsmStack.state.set_data_attr('unit', unit)
@@ -0,0 +1,102 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+
+from ct.models import Lesson, LessonDelta
+from ct.version_store import LESSON_KEYFRAME_INTERVAL
+
+
+def table_size(table):
+    'bytes used by table and its indexes, or None if the db cannot tell'
+    cursor = connection.cursor()
+    try:
+        if connection.vendor == 'sqlite':
+            cursor.execute('SELECT SUM(pgsize) FROM dbstat WHERE name IN '
+                           '(SELECT name FROM sqlite_master WHERE tbl_name = %s)',
+                           [table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT pg_total_relation_size(%s)', [table])
+        else:
+            return None
+    except Exception: # e.g. SQLite built without dbstat
+        return None
+    return cursor.fetchone()[0] or 0
+
+
+def text_bytes():
+    'total length of Lesson texts and data, and of stored deltas'
+    cursor = connection.cursor()
+    cursor.execute('SELECT SUM(LENGTH(text)), SUM(LENGTH(data)) FROM ct_lesson')
+    nText, nData = cursor.fetchone()
+    cursor.execute('SELECT SUM(LENGTH(delta)) FROM ct_lessondelta')
+    return (nText or 0) + (nData or 0), cursor.fetchone()[0] or 0
+
+
+class Command(BaseCommand):
+    """Store old Lesson versions as compressed deltas.
+
+    Converts existing version history (see ct.version_store): versions
+    that are not tree heads, keyframes or used by any UnitLesson,
+    Response, StudyList or ConceptLink keep only a delta from their
+    parent version.
+    Safe to re-run; already compressed versions are left alone.  Reports
+    the size of the Lesson table and the time of a full scan of lesson
+    texts (as done by the unindexed lesson search) before and after.
+    The database only gives the freed space back to the table (or the
+    disk) when vacuumed, so use --vacuum to see the full effect.
+    """
+    help = 'Delta-compress the text of old Lesson versions'
+    option_list = BaseCommand.option_list + (
+        make_option('--keyframe-interval', type='int',
+                    default=LESSON_KEYFRAME_INTERVAL,
+                    help='versions between full-text keyframes'),
+        make_option('--vacuum', action='store_true', default=False,
+                    help='VACUUM the Lesson table afterwards'),
+        make_option('--scans', type='int', default=5,
+                    help='number of timed table scans (best is reported)'),
+    )
+
+    def handle(self, *args, **options):
+        self.report('before', options['scans'])
+        t = time.time()
+        n = LessonDelta.compress_all(options['keyframe_interval'])
+        self.stdout.write('compressed %d of %d versions in %.2f s'
+                          % (n, Lesson.objects.count(), time.time() - t))
+        if options['vacuum']:
+            t = time.time()
+            self.vacuum()
+            self.stdout.write('vacuumed in %.2f s' % (time.time() - t))
+        self.report('after', options['scans'])
+
+    def report(self, label, scans):
+        size = table_size('ct_lesson')
+        deltaSize = table_size('ct_lessondelta')
+        nText, nDelta = text_bytes()
+        self.stdout.write('%s: ct_lesson %s, ct_lessondelta %s; '
+                          'text %d bytes, deltas %d bytes; scan %.1f ms'
+                          % (label, self.format_size(size),
+                             self.format_size(deltaSize), nText, nDelta,
+                             self.time_scan(scans)))
+
+    def vacuum(self):
+        'rewrite the Lesson table to release the space of cleared texts'
+        if connection.vendor == 'sqlite':
+            connection.cursor().execute('VACUUM')
+        elif connection.vendor == 'postgresql':
+            connection.cursor().execute('VACUUM FULL ct_lesson')
+
+    def format_size(self, size):
+        return 'size unknown' if size is None else '%d bytes' % size
+
+    def time_scan(self, scans):
+        'best ms for an icontains search that must read every lesson text'
+        q = Q(title__icontains='zqxj') | Q(text__icontains='zqxj')
+        times = []
+        for i in range(scans):
+            t = time.time()
+            Lesson.objects.filter(q).count()
+            times.append((time.time() - t) * 1000.)
+        return min(times)
@@ -0,0 +1,53 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ct.concept_index import ConceptTitleIndex
+from ct.management.commands.search_bench import make_vocabulary, percentile
+
+
+class Command(BaseCommand):
+    """Benchmark the concept title autocomplete index.
+
+    Builds a ConceptTitleIndex of --concepts synthetic titles in memory
+    (the db is not touched), then times --queries autocomplete lookups of
+    prefixes of one or two title words, as typed a keystroke at a time.
+    """
+    help = 'Time concept title autocomplete against a synthetic index'
+    option_list = BaseCommand.option_list + (
+        make_option('--concepts', type='int', default=1000000,
+                    help='number of synthetic concept titles'),
+        make_option('--queries', type='int', default=1000,
+                    help='number of autocomplete lookups'),
+        make_option('--seed', type='int', default=None,
+                    help='random seed, for repeatable runs'),
+    )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        vocabulary = make_vocabulary(rng, 20000)
+        titles = [' '.join(rng.choice(vocabulary)
+                           for k in range(rng.randint(1, 4)))
+                  for i in range(options['concepts'])]
+        t = time.time()
+        index = ConceptTitleIndex(enumerate(titles, 1),
+                                  maxSize=len(titles))
+        self.stdout.write('indexed %d concepts (%d words) in %.2f s'
+                          % (len(index), len(index.words), time.time() - t))
+        queries = []
+        for i in range(options['queries']):
+            words = rng.choice(titles).split()[:2]
+            words[-1] = words[-1][:rng.randint(1, len(words[-1]))]
+            queries.append(' '.join(words))
+        times, hits = [], 0
+        for q in queries:
+            t = time.time()
+            hits += len(index.search(q))
+            times.append((time.time() - t) * 1000.)
+        self.stdout.write('%d queries: mean %.3f ms, p50 %.3f ms, '
+                          'p99 %.3f ms, max %.3f ms, %.1f results/query'
+                          % (len(queries), sum(times) / len(times),
+                             percentile(times, 50), percentile(times, 99),
+                             max(times), float(hits) / len(queries)))
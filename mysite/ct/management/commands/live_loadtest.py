@@ -0,0 +1,543 @@
+import json
+import random
+import threading
+import time
+import urllib2
+import uuid
+from contextlib import contextmanager
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve
+from django.db import connection, close_old_connections
+from django.test.client import Client, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from ct.models import (
+    Course,
+    CourseUnit,
+    Lesson,
+    Response,
+    Role,
+    Unit,
+    UnitLesson,
+    DONE_STATUS,
+    NEED_HELP_STATUS,
+)
+from fsm.fsm_base import FSMStack
+from fsm.live_channel import live_channel, LIVE_CHANNEL_TIMEOUT
+from fsm.models import FSM, FSMState
+
+
+ORIGIN = 'http://testserver'
+WRITE_SQL = ('INSERT', 'UPDATE', 'DELETE')
+FSM_NAMES = ('liveteach', 'livestudent')
+FAST_HASHER = 'django.contrib.auth.hashers.MD5PasswordHasher'
+
+
+def is_write(sql):
+    'True if sql (as logged by the debug cursor) modifies the db'
+    if sql.startswith('QUERY = '):  # sqlite backend's format
+        sql = sql[len('QUERY = '):].lstrip('u\'"')
+    return sql.lstrip().upper().startswith(WRITE_SQL)
+
+
+def percentile(values, p):
+    'nearest-rank percentile of a sorted list'
+    if not values:
+        return 0.
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+class Stats(object):
+    """
+    Thread-safe latency / query samples, grouped by label.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}  # label -> [(secs, nQueries, nWrites), ...]
+        self.errors = []
+
+    def add(self, labels, secs, nQueries, nWrites):
+        with self._lock:
+            for label in labels:
+                self.samples.setdefault(label, []).append(
+                    (secs, nQueries, nWrites))
+
+    def error(self, msg):
+        with self._lock:
+            self.errors.append(msg)
+
+    def report(self, prefix):
+        'yield one formatted line per label starting with prefix'
+        yield '%-32s %6s %8s %8s %8s %7s %7s' % (
+            prefix.strip(':'), 'n', 'p50 ms', 'p95 ms', 'p99 ms',
+            'queries', 'writes')
+        for label in sorted(self.samples):
+            if not label.startswith(prefix):
+                continue
+            samples = self.samples[label]
+            secs = sorted(s[0] * 1000. for s in samples)
+            n = len(samples)
+            yield '%-32s %6d %8.1f %8.1f %8.1f %7.1f %7.1f' % (
+                label[len(prefix):], n, percentile(secs, 50),
+                percentile(secs, 95), percentile(secs, 99),
+                sum(s[1] for s in samples) / float(n),
+                sum(s[2] for s in samples) / float(n))
+
+
+class DummyLock(object):
+    'no-op stand-in for threading.Lock'
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+class SerialPool(object):
+    'ThreadPool stand-in that runs everything in the calling thread'
+    def map(self, func, items, chunksize=None):
+        return map(func, items)
+
+    def map_async(self, func, items, chunksize=None):
+        return SerialResult(self.map(func, items))
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class SerialResult(object):
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+class SimUser(object):
+    """
+    One simulated browser: a test Client whose requests are measured.
+    """
+    def __init__(self, user, password, stats, dbLock):
+        self.user = user
+        self.stats = stats
+        self.dbLock = dbLock
+        self.client = Client()
+        if not self.client.login(username=user.username, password=password):
+            raise CommandError('cannot log in %s' % user.username)
+
+    def get_node(self):
+        'name of our current FSM node (not measured), or None'
+        stateID = self.client.session.get('fsmID')
+        if stateID is None:
+            return None
+        return FSMState.objects.filter(pk=stateID) \
+            .values_list('fsmNode__name', flat=True).first()
+
+    def request(self, method, url, data=None):
+        'do one measured request; POSTs come from the page at url'
+        node = self.get_node()
+        kwargs = {}
+        if method == 'post':
+            kwargs = dict(HTTP_REFERER=ORIGIN + url, HTTP_ORIGIN=ORIGIN)
+        with self.dbLock:
+            with CaptureQueriesContext(connection) as queries:
+                t = time.time()
+                response = getattr(self.client, method)(url, data or {},
+                                                        **kwargs)
+                dt = time.time() - t
+        view = resolve(url).url_name
+        nWrites = sum(1 for q in queries if is_write(q['sql']))
+        labels = ['view:%s %s' % (method.upper(), view)]
+        if node:
+            labels.append('node:%s' % node)
+        self.stats.add(labels, dt, len(queries), nWrites)
+        if response.status_code not in (200, 302):
+            self.stats.error('%s %s (%s): HTTP %d' % (
+                method.upper(), url, node, response.status_code))
+        return response
+
+    def get(self, url):
+        return self.request('get', url)
+
+    def post(self, url, data):
+        'POST, then GET the page it redirects to; returns that URL'
+        response = self.request('post', url, data)
+        if response.status_code != 302:
+            return url
+        url = response['Location']
+        if url.startswith(ORIGIN):
+            url = url[len(ORIGIN):]
+        self.get(url)
+        return url
+
+
+class Listener(threading.Thread):
+    """
+    One browser page following a live session on a real server, by
+    long-polling live_events as fsm/live_client.html does.
+    """
+    def __init__(self, baseURL, stateID, sessionID, stats):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = '%s/fsm/live/%d/events/' % (baseURL, stateID)
+        self.cookie = 'sessionid=%s' % sessionID
+        self.stats = stats
+        latest = live_channel.get_latest(stateID)
+        self.since = latest.version if latest else 0
+        self.received = {}  # transition version -> time received
+        self.running = True
+        self.closed = False  # told the session ended, instead of its END
+
+    def run(self):
+        while self.running:
+            request = urllib2.Request('%s?since=%d' % (self.url, self.since),
+                                      headers=dict(Cookie=self.cookie))
+            t = time.time()
+            try:
+                msg = json.load(urllib2.urlopen(
+                    request, timeout=LIVE_CHANNEL_TIMEOUT + 10))
+            except urllib2.HTTPError as e:
+                if e.code == 404:  # session closed, as the page would see
+                    self.closed = True
+                    return
+                self.stats.error('GET %s: %s' % (self.url, e))
+                time.sleep(1)
+                continue
+            except Exception as e:
+                self.stats.error('GET %s: %s' % (self.url, e))
+                time.sleep(1)
+                continue
+            self.stats.add(['listen:%s' % msg['event']], time.time() - t,
+                           0, 0)
+            if msg['event'] != 'timeout':
+                self.since = msg['version']
+            if msg['event'] == 'transition':
+                self.received[msg['version']] = time.time()
+
+
+class Command(BaseCommand):
+    """Load test a live classroom session.
+
+    Creates a course with a courselet of ORCT questions, an instructor
+    running liveteach and --students simulated students running livestudent.
+    For each question the students, --concurrency at a time, go through
+    WAIT_ASK -> ASK -> WAIT_ASSESS -> ASSESS -> ERRORS while the
+    instructor polls the live_question page, all via the Django test
+    client against the configured database.  Reports latency percentiles,
+    SQL queries and SQL writes per FSM node and per view.
+
+    SQLite allows only one writer, so requests are serialized there and
+    --concurrency only interleaves students; use PostgreSQL to measure
+    real concurrency.
+
+    With --listen URL, every student page also follows the session the
+    way the browser does, with a thread long-polling live_events on the
+    server at URL (which must use the same database), and the home page
+    there is fetched during each phase.  The report then shows how long
+    the students took to hear of each instructor transition, how many
+    live_events requests they made, and how fast the server answered
+    other requests while holding all of theirs.  Created users, course and courselet are deleted
+    afterwards unless --keep is given.
+    """
+    help = 'Simulate a live session with N students and report latencies'
+    option_list = BaseCommand.option_list + (
+        make_option('--students', type='int', default=30,
+                    help='number of simulated students'),
+        make_option('--concurrency', type='int', default=10,
+                    help='number of students making requests at once'),
+        make_option('--questions', type='int', default=2,
+                    help='number of questions to ask'),
+        make_option('--polls', type='int', default=5,
+                    help='instructor page reloads per question phase'),
+        make_option('--seed', type='int', default=None,
+                    help='random seed for student answers'),
+        make_option('--keep', action='store_true', default=False,
+                    help='keep the created users, course and courselet'),
+        make_option('--listen', metavar='URL', default=None,
+                    help='follow live_events on the server at URL, '
+                    'e.g. http://127.0.0.1:8000'),
+    )
+
+    def handle(self, *args, **options):
+        if options['students'] < 1 or options['concurrency'] < 1:
+            raise CommandError('need at least one student and thread')
+        if FSM.objects.filter(name__in=FSM_NAMES).count() < len(FSM_NAMES):
+            raise CommandError('run fsm_deploy first: need %s FSMs'
+                               % ' and '.join(FSM_NAMES))
+        self.random = random.Random(options['seed'])
+        self.stats = Stats()
+        # sqlite has no concurrent writers, and its test db is per-thread
+        self.dbLock = threading.Lock() if connection.vendor == 'sqlite' \
+            else DummyLock()
+        self.tag = 'loadtest_%s' % uuid.uuid4().hex[:8]
+        self.users = []
+        self.password = uuid.uuid4().hex
+        self.listeners = []
+        self.transitions = {}  # session channel version -> time of POST
+        with override_settings(ALLOWED_HOSTS=['testserver'],
+                               PASSWORD_HASHERS=(FAST_HASHER,)):
+            try:
+                self.setup(options['students'], options['questions'])
+                self.run_session(options)
+            finally:
+                if not options['keep']:
+                    self.cleanup()
+        self.write_report(options)
+
+    def create_user(self, name):
+        user = User.objects.create_user('%s_%s' % (self.tag, name),
+                                        password=self.password)
+        self.users.append(user)
+        return user
+
+    def setup(self, nStudents, nQuestions):
+        'create course, courselet, users and the live session'
+        self.stdout.write('Setting up %s with %d students...'
+                          % (self.tag, nStudents))
+        instructor = self.create_user('prof')
+        self.course = Course.objects.create(
+            title='Load test %s' % self.tag, description='load test',
+            addedBy=instructor
+        )
+        Role.objects.create(course=self.course, user=instructor,
+                            role=Role.INSTRUCTOR)
+        self.unit = Unit.objects.create(title='Load test questions',
+                                        addedBy=instructor)
+        CourseUnit.objects.create(course=self.course, unit=self.unit, order=0,
+                                  addedBy=instructor,
+                                  releaseTime=timezone.now())
+        self.questions = []
+        for i in range(nQuestions):
+            lesson = Lesson(title='Question %d' % (i + 1),
+                            text='What is %d + %d?' % (i, i),
+                            kind=Lesson.ORCT_QUESTION, addedBy=instructor)
+            lesson.save_root()
+            ul = UnitLesson.create_from_lesson(lesson, self.unit,
+                                               order='APPEND', addAnswer=True)
+            for j in range(2):
+                em = Lesson(title='Error %d' % (j + 1), text='a mistake',
+                            kind=Lesson.ERROR_MODEL, addedBy=instructor)
+                em.save_root()
+                UnitLesson.create_from_lesson(em, self.unit, parent=ul)
+            self.questions.append(ul)
+        self.teacher = SimUser(instructor, self.password, self.stats,
+                               self.dbLock)
+        self.students = []
+        for i in range(nStudents):
+            user = self.create_user('s%d' % i)
+            Role.objects.create(course=self.course, user=user,
+                                role=Role.ENROLLED)
+            self.students.append(SimUser(user, self.password, self.stats,
+                                         self.dbLock))
+        # start liveteach, as the Start Activity menu would
+        request = RequestFactory().get('/ct/')
+        request.user = instructor
+        request.session = self.teacher.client.session
+        fsmStack = FSMStack(request)
+        self.teachURL = fsmStack.push(request, 'liveteach', dict(
+            unit=self.unit, course=self.course
+        ))
+        request.session.save()
+        self.liveState = fsmStack.state
+
+    def run_session(self, options):
+        'run the whole live session, question by question'
+        if options['concurrency'] > 1:
+            pool = ThreadPool(options['concurrency'])
+        else:  # e.g. sqlite in-memory test db, which threads cannot share
+            pool = SerialPool()
+        try:
+            pool.map(self.join, self.students, chunksize=1)
+            if options['listen']:
+                self.start_listening(options['listen'])
+            url = self.teach(self.teachURL, dict(fsmtask='next'))
+            for ul in self.questions:
+                self.stdout.write('Asking %s...' % ul.lesson.title)
+                url = self.teach(url, dict(fsmtask='select_UnitLesson',
+                                           selectID=ul.pk))
+                self.teacher.post(url, dict(task='start'))
+                self.run_phase(pool, self.ask, options['polls'], url)
+                url = self.teach(url, dict(fsmtask='next'))  # ANSWER
+                self.run_phase(pool, self.assess, options['polls'], url)
+                url = self.teach(url, dict(fsmtask='next'))  # RECYCLE
+                if ul != self.questions[-1]:
+                    url = self.teach(url, dict(fsmedge='next'))
+            self.teach(url, dict(fsmedge='quit'))
+            self.stop_listening()
+            pool.map(self.leave, self.students, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            self.stop_listening()
+
+    def teach(self, url, data):
+        'instructor POST that may be a transition students must hear of'
+        t = time.time()
+        url = self.teacher.post(url, data)
+        latest = live_channel.get_latest(self.liveState.pk)
+        if latest and latest.version not in self.transitions:
+            self.transitions[latest.version] = t
+        return url
+
+    def start_listening(self, baseURL):
+        'start a Listener for each student'
+        self.baseURL = baseURL.rstrip('/')
+        for student in self.students:
+            self.listeners.append(Listener(
+                self.baseURL, self.liveState.pk,
+                student.client.cookies['sessionid'].value, self.stats))
+        self.stdout.write('Starting %d listeners on %s...'
+                          % (len(self.listeners), self.baseURL))
+        for listener in self.listeners:
+            listener.start()
+
+    def stop_listening(self):
+        'give listeners time to hear the last transition, then stop them'
+        if not any(l.running for l in self.listeners):
+            return
+        lastVersion = max(self.transitions) if self.transitions else 0
+        deadline = time.time() + LIVE_CHANNEL_TIMEOUT
+        while time.time() < deadline and \
+                any(l.since < lastVersion and not l.closed
+                    for l in self.listeners):
+            time.sleep(0.1)
+        for listener in self.listeners:
+            listener.running = False
+
+    def probe(self):
+        'time a home page request to the server, as the first student'
+        if not self.listeners:
+            return
+        request = urllib2.Request(self.baseURL + '/ct/',
+                                  headers=dict(Cookie=self.listeners[0].cookie))
+        t = time.time()
+        try:
+            urllib2.urlopen(request, timeout=60).read()
+        except Exception as e:
+            self.stats.error('GET /ct/: %s' % e)
+            return
+        self.stats.add(['probe:GET /ct/'], time.time() - t, 0, 0)
+
+    def run_phase(self, pool, func, nPolls, teacherURL):
+        'run func for all students while the instructor watches teacherURL'
+        result = pool.map_async(func, self.students, chunksize=1)
+        for i in range(nPolls):
+            self.teacher.get(teacherURL)
+            self.probe()
+            if result.ready():
+                break
+            time.sleep(0.2)
+        result.get()
+
+    @contextmanager
+    def db_thread(self):
+        'let a pool thread use (and release) its own db connection'
+        if isinstance(threading.current_thread(), threading._MainThread):
+            yield  # SerialPool
+            return
+        close_old_connections()
+        try:
+            yield
+        finally:
+            connection.close()
+
+    def join(self, student):
+        'START -> WAIT_ASK'
+        with self.db_thread():
+            url = student.post('/ct/', dict(liveID=self.liveState.pk))
+            student.url = student.post(url, dict(fsmedge='next'))
+
+    def ask(self, student):
+        'WAIT_ASK -> ASK -> WAIT_ASSESS'
+        with self.db_thread():
+            url = student.post(student.url, dict(fsmedge='next'))
+            confidence = self.random.choice(Response.CONF_CHOICES)[0]
+            student.url = student.post(url, dict(text='i think it is 42',
+                                                 confidence=confidence))
+
+    def assess(self, student):
+        'WAIT_ASSESS -> ASSESS (-> ERRORS) -> WAIT_ASK'
+        with self.db_thread():
+            url = student.post(student.url, dict(fsmedge='next'))
+            selfeval = self.random.choice(Response.EVAL_CHOICES)[0]
+            status = NEED_HELP_STATUS if selfeval == Response.DIFFERENT \
+                else DONE_STATUS
+            url = student.post(url, dict(selfeval=selfeval, status=status,
+                                         liked=''))
+            if selfeval != Response.CORRECT:  # on ERRORS page
+                ul = UnitLesson.objects.get(pk=resolve(url).kwargs['ul_id'])
+                ems = [em.pk for em in ul.get_errors()][:1]
+                url = student.post(url, dict(emlist=ems))
+            student.url = url
+
+    def leave(self, student):
+        'WAIT_ASK -> END'
+        with self.db_thread():
+            student.post(student.url, dict(fsmedge='next'))
+
+    def cleanup(self):
+        'delete everything the load test created'
+        Course.objects.filter(pk=getattr(self, 'course', None) and
+                              self.course.pk).delete()
+        if hasattr(self, 'unit'):
+            Lesson.objects.filter(unitlesson__unit=self.unit).delete()
+            self.unit.delete()
+        User.objects.filter(pk__in=[u.pk for u in self.users]).delete()
+
+    def write_report(self, options):
+        self.stdout.write('\n%d students, %d questions, concurrency %d, '
+                          'database %s\n' % (
+                              options['students'], options['questions'],
+                              options['concurrency'], connection.vendor))
+        for prefix in ('node:', 'view:'):
+            for line in self.stats.report(prefix):
+                self.stdout.write(line)
+            self.stdout.write('')
+        views = [s for label, samples in self.stats.samples.items()
+                 if label.startswith('view:') for s in samples]
+        self.stdout.write('Total: %d requests, %d SQL queries, %d SQL writes'
+                          % (len(views), sum(s[1] for s in views),
+                             sum(s[2] for s in views)))
+        if self.listeners:
+            self.write_listen_report()
+        if self.stats.errors:
+            self.stderr.write('%d requests failed, e.g. %s'
+                              % (len(self.stats.errors), self.stats.errors[0]))
+
+    def write_listen_report(self):
+        self.stdout.write('')
+        for prefix in ('listen:', 'probe:'):
+            for line in self.stats.report(prefix):
+                self.stdout.write(line)
+            self.stdout.write('')
+        lags, missed = [], 0
+        for listener in self.listeners:
+            for version, t in self.transitions.items():
+                if version in listener.received:
+                    lags.append((listener.received[version] - t) * 1000.)
+                elif listener.since < version and not listener.closed:
+                    missed += 1  # superseded versions are not missed
+        lags.sort()
+        nRequests = sum(len(samples) for label, samples
+                        in self.stats.samples.items()
+                        if label.startswith('listen:'))
+        self.stdout.write(
+            '%d listeners, %d transitions: %d live_events requests '
+            '(%.1f per listener), %d transitions missed' % (
+                len(self.listeners), len(self.transitions), nRequests,
+                nRequests / float(len(self.listeners)), missed))
+        self.stdout.write('transition delivery ms: p50 %.0f, p95 %.0f, '
+                          'max %.0f' % (percentile(lags, 50),
+                                        percentile(lags, 95),
+                                        lags[-1] if lags else 0.))
@@ -0,0 +1,84 @@
+import os
+import json
+import time
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ct import pandoc_pool, fastrst
+from ct.templatetags.ct_extras import convert_rst
+
+
+def load_texts(path):
+    'get the non-empty lesson texts from a dumpdata fixture'
+    with open(path) as ifile:
+        data = json.load(ifile)
+    return [o['fields']['text'] for o in data
+            if o['model'] == 'ct.lesson' and o['fields'].get('text')]
+
+
+class Command(BaseCommand):
+    """Benchmark pandoc backends for md2html (bypasses the render cache).
+
+    Converts every lesson text in the fixture with the one-process-per-document
+    pypandoc path and with the persistent worker pool, and reports docs/sec.
+    Both backends are driven by --pool-size concurrent threads.  Texts the
+    pure-Python fast path (ct.fastrst) accepts are also timed with it.
+    """
+    help = 'Compare md2html pandoc backends in docs/sec'
+    option_list = BaseCommand.option_list + (
+        make_option('--fixture', default='dumpdata/debug.json',
+                    help='dumpdata JSON file to take lesson texts from'),
+        make_option('--repeat', type='int', default=3,
+                    help='number of passes over the texts'),
+        make_option('--pool-size', type='int',
+                    default=pandoc_pool.PANDOC_POOL_SIZE,
+                    help='number of pool workers (and client threads)'),
+    )
+
+    def handle(self, *args, **options):
+        os.chdir(settings.BASE_DIR)
+        try:
+            texts = load_texts(options['fixture'])
+        except (IOError, ValueError) as e:
+            raise CommandError('cannot read %s: %s' % (options['fixture'], e))
+        if not texts:
+            raise CommandError('no lesson texts in %s' % options['fixture'])
+        texts = texts * options['repeat']
+        pool = pandoc_pool.PandocPool(size=options['pool_size'])
+        threads = ThreadPool(options['pool_size'])
+        backends = (
+            ('pypandoc', lambda txt: convert_rst(txt, 'pypandoc')),
+            ('pool', pool.convert),
+        )
+        try:
+            # don't count process start-up
+            threads.map(pool.convert, ['warm up'] * options['pool_size'])
+            results = {}
+            for name, func in backends:
+                t = time.time()
+                results[name] = threads.map(func, texts, chunksize=1)
+                dt = time.time() - t
+                self.stdout.write('%-10s %5d docs in %7.2f s: %8.1f docs/sec'
+                                  % (name, len(texts), dt, len(texts) / dt))
+        except StandardError as e:
+            raise CommandError('conversion failed: %s' % e)
+        finally:
+            threads.close()
+            pool.close()
+        nDiff = sum(1 for a, b in zip(results['pypandoc'], results['pool'])
+                    if a != b)
+        eligible = [(txt, html) for txt, html in zip(texts, results['pypandoc'])
+                    if fastrst.render(txt) is not None]
+        if eligible:
+            t = time.time()
+            htmls = [fastrst.render(txt) for txt, html in eligible]
+            dt = time.time() - t
+            self.stdout.write('%-10s %5d docs in %7.2f s: %8.1f docs/sec'
+                              % ('fastpath', len(eligible), dt,
+                                 len(eligible) / dt))
+            nDiff += sum(1 for a, (txt, b) in zip(htmls, eligible) if a != b)
+        if nDiff:
+            self.stderr.write('%d documents rendered differently' % nDiff)
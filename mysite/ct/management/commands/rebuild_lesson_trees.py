@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ct.models import LessonClosure, LessonTreeHead
+
+
+class Command(BaseCommand):
+    """Rebuild the LessonClosure and LessonTreeHead tables from Lessons.
+
+    Both are kept current by Lesson.save_root() and checkin(), so this is
+    only needed after bulk loads or direct db edits.
+    """
+    help = 'Recompute Lesson version history and tree head tables'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            nRows = LessonClosure.rebuild()
+            nHeads = LessonTreeHead.rebuild()
+        self.stdout.write('Rebuilt %d closure rows and %d tree heads.'
+                          % (nRows, nHeads))
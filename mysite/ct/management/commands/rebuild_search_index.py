@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ct.search_index import get_search_backend
+
+
+class Command(BaseCommand):
+    """Rebuild the full-text lesson search index from the Lesson table.
+
+    The index is kept current as lessons are saved, so this is only
+    needed after bulk loads, queryset updates or direct db edits.
+    """
+    help = 'Reindex all lesson titles and texts for search'
+
+    def handle(self, *args, **options):
+        search = get_search_backend()
+        with transaction.atomic():
+            n = search.rebuild()
+        self.stdout.write('Indexed %d lessons (%s backend).'
+                          % (n, search.name))
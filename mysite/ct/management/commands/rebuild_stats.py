@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ct.models import UnitLessonStats
+
+
+class Command(BaseCommand):
+    """Rebuild the UnitLessonStats rollup from Response and StudentError rows.
+
+    The rollup is kept current as responses are saved, so this is only
+    needed after bulk loads or direct db edits.
+    """
+    help = 'Recompute per-question response statistics'
+    option_list = BaseCommand.option_list + (
+        make_option('--unitlesson', type='int', action='append', default=None,
+                    help='rebuild only the rollup of this UnitLesson id'),
+    )
+
+    def handle(self, *args, **options):
+        nRows = UnitLessonStats.rebuild(options['unitlesson'])
+        self.stdout.write('Rebuilt %d statistics rows.' % nRows)
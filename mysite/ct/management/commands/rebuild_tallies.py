@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ct.models import ResponseTally, Response
+from fsm.models import FSMState
+
+
+class Command(BaseCommand):
+    """Rebuild live ResponseTally counters from Response rows.
+
+    By default only activities of running live sessions are rebuilt;
+    the reconcile_response_tallies Celery task does this periodically.
+    """
+    help = 'Reconcile live session response tallies with the responses'
+    option_list = BaseCommand.option_list + (
+        make_option('--activity', type='int', action='append', default=[],
+                    help='rebuild tallies of this ActivityLog id'),
+        make_option('--all', action='store_true', default=False,
+                    help='rebuild tallies of every activity with responses'),
+    )
+
+    def handle(self, *args, **options):
+        if options['activity']:
+            activityIDs = options['activity']
+        elif options['all']:
+            activityIDs = Response.objects.filter(activity__isnull=False) \
+                .values_list('activity', flat=True).distinct()
+        else:
+            activityIDs = FSMState.objects.filter(isLiveSession=True,
+                                                  activity__isnull=False) \
+                .values_list('activity', flat=True).distinct()
+        nRows = 0
+        activityIDs = list(activityIDs)
+        for activityID in activityIDs:
+            nRows += ResponseTally.rebuild(activityID)
+        self.stdout.write('Rebuilt %d tallies for %d activities.'
+                          % (nRows, len(activityIDs)))
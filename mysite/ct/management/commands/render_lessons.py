@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ct.models import LessonHTML, Course
+from ct.render_cache import RENDERER_VERSION
+from ct.templatetags.ct_extras import md2html_many
+
+
+class Command(BaseCommand):
+    """Pre-render lesson texts to HTML (stored in LessonHTML).
+
+    Run after deploying a new renderer version (RENDERER_VERSION), or to
+    backfill lessons committed before pre-rendering existed.  Also warms
+    the render cache with course descriptions.
+    """
+    help = 'Pre-render lesson HTML for the current renderer version'
+    option_list = BaseCommand.option_list + (
+        make_option('--force', action='store_true', default=False,
+                    help='re-render lessons even if already up to date'),
+    )
+
+    def handle(self, *args, **options):
+        nRendered, nFailed = LessonHTML.render_all(force=options['force'])
+        md2html_many(Course.objects.exclude(description='')
+                     .values_list('description', flat=True))
+        self.stdout.write('Rendered %d lessons (renderer version %d).'
+                          % (nRendered, RENDERER_VERSION))
+        if nFailed:
+            self.stderr.write('%d lessons failed to render.' % nFailed)
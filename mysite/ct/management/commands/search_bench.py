@@ -0,0 +1,111 @@
+import bisect
+import random
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from ct.models import Lesson
+from ct.search_index import get_search_backend, LikeSearch
+
+
+class Rollback(Exception):
+    'raised to discard the synthetic lessons'
+
+
+def make_vocabulary(rng, n):
+    'n distinct pronounceable pseudo-words'
+    consonants, vowels = 'bcdfghjklmnprstvwz', 'aeiou'
+    words = set()
+    while len(words) < n:
+        words.add(''.join(rng.choice(consonants) + rng.choice(vowels)
+                          for i in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+class Command(BaseCommand):
+    """Benchmark lesson search: full-text index vs. icontains scan.
+
+    Adds --lessons synthetic lessons (in a transaction that is rolled back
+    at the end), indexes them, then times the first page of ranked results
+    for --queries searches of one or two words with each backend.  Lesson
+    words follow a Zipf distribution; search words are picked uniformly.
+    """
+    help = 'Time lesson full-text search against a synthetic library'
+    option_list = BaseCommand.option_list + (
+        make_option('--lessons', type='int', default=100000,
+                    help='number of synthetic lessons to add'),
+        make_option('--queries', type='int', default=50,
+                    help='number of searches per backend'),
+        make_option('--page-size', type='int', default=20,
+                    help='number of results fetched per search'),
+        make_option('--seed', type='int', default=None,
+                    help='random seed, for repeatable runs'),
+    )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        vocabulary = make_vocabulary(rng, 5000)
+        # Zipf-like word frequencies, as in real text
+        cumulative, total = [], 0.
+        for i in range(len(vocabulary)):
+            total += 1. / (i + 1)
+            cumulative.append(total)
+        def word():
+            return vocabulary[bisect.bisect(cumulative, rng.random() * total)]
+        # searches are for specific terms, so pick words uniformly
+        queries = [' '.join(rng.choice(vocabulary)
+                            for i in range(rng.randint(1, 2)))
+                   for i in range(options['queries'])]
+        search = get_search_backend()
+        try:
+            with transaction.atomic():
+                self.add_lessons(options['lessons'], word)
+                t = time.time()
+                n = search.rebuild()
+                if n:
+                    self.stdout.write('indexed %d lessons in %.2f s'
+                                      % (n, time.time() - t))
+                backends = [LikeSearch(connection)]
+                if search.name != LikeSearch.name:
+                    backends.append(search)
+                for backend in backends:
+                    self.time_queries(backend, queries, options['page_size'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def add_lessons(self, nLessons, word, batchSize=2000):
+        user = User.objects.create_user('search_bench_%d' % time.time())
+        t = time.time()
+        for i in range(0, nLessons, batchSize):
+            Lesson.objects.bulk_create([
+                Lesson(title=' '.join(word() for k in range(4)),
+                       text=' '.join(word() for k in range(80)),
+                       addedBy=user)
+                for j in range(min(batchSize, nLessons - i))
+            ])
+        self.stdout.write('added %d lessons in %.2f s'
+                          % (nLessons, time.time() - t))
+
+    def time_queries(self, backend, queries, pageSize):
+        times, hits = [], 0
+        for s in queries:
+            t = time.time()
+            qs = backend.order_by_rank(
+                backend.filter(Lesson.objects.all(), s, lessonPath=''),
+                s, lessonPath='')
+            hits += len(list(qs.values_list('pk', flat=True)[:pageSize]))
+            times.append((time.time() - t) * 1000.)
+        self.stdout.write('%-10s %4d queries: mean %8.1f ms, p50 %8.1f ms, '
+                          'p95 %8.1f ms, %5.1f results/page'
+                          % (backend.name, len(queries),
+                             sum(times) / len(times), percentile(times, 50),
+                             percentile(times, 95), float(hits) / len(queries)))
@@ -0,0 +1,102 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ct import sourcedb_cache
+from ct.management.commands.search_bench import percentile
+from ct.sourcedb_plugin import localfile_plugin
+from ct.sourcedb_search import SourceDBSearch, SOURCEDB_SEARCH_THREADS
+
+
+def make_source(name, latency, jitter, rng):
+    'localfile LessonDoc class whose searches take about latency seconds'
+    class LessonDoc(localfile_plugin.LessonDoc):
+        sourceDB = name
+        @classmethod
+        def search(klass, query, max_results=10):
+            time.sleep(latency * (1. + jitter * (2. * rng.random() - 1.)))
+            return localfile_plugin.LessonDoc.search(query, max_results)
+    return LessonDoc
+
+
+class Command(BaseCommand):
+    """Benchmark federated sourceDB search against its slowest source.
+
+    Sets up one simulated sourceDB per --latencies value (the localfile
+    pages, searched after sleeping that many ms, +/- --jitter), then for
+    --queries searches of their titles times: each source searched alone,
+    all of them searched one after the other, and the federated search
+    of all of them in parallel, both until its first merged results and
+    until it is complete.  Nothing is cached between searches.
+    """
+    help = 'Time federated sourceDB search against simulated slow sources'
+    option_list = BaseCommand.option_list + (
+        make_option('--latencies', default='50,150,400',
+                    help='comma-separated search latency (ms) of each source'),
+        make_option('--jitter', type='float', default=0.2,
+                    help='relative random variation of latencies'),
+        make_option('--queries', type='int', default=20,
+                    help='number of searches'),
+        make_option('--seed', type='int', default=None,
+                    help='random seed, for repeatable runs'),
+    )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        latencies = [float(s) / 1000. for s in options['latencies'].split(',')]
+        sources = {}
+        for i, latency in enumerate(latencies):
+            name = 'bench%d' % i
+            sources[name] = sourcedb_cache.CachedSourceDB(
+                name, make_source(name, latency, options['jitter'], rng),
+                useDB=False)
+        names = sorted(sources)
+        if len(names) > SOURCEDB_SEARCH_THREADS:
+            self.stdout.write('warning: more sources than search threads (%d)'
+                              % SOURCEDB_SEARCH_THREADS)
+        titles = sorted(localfile_plugin.get_page_file().pages)
+        queries = [rng.choice(titles) for i in range(options['queries'])]
+        sourcedb_cache._cachedSourceDBs.update(sources)
+        try:
+            single = dict((name, []) for name in names)
+            sequential, first, federated = [], [], []
+            for q in queries:
+                for name in names:
+                    sources[name].clear()
+                    single[name].append(self.time_search(q, [name])[1])
+                sequential.append(sum(single[name][-1] for name in names))
+                for name in names:
+                    sources[name].clear()
+                tFirst, tAll = self.time_search(q, names)
+                first.append(tFirst)
+                federated.append(tAll)
+        finally:
+            for name in names:
+                del sourcedb_cache._cachedSourceDBs[name]
+        for name, latency in zip(names, latencies):
+            self.report('%s (%d ms)' % (name, latency * 1000), single[name])
+        slowest = max(names, key=lambda name: sum(single[name]))
+        self.report('sequential', sequential)
+        self.report('federated: first results', first)
+        self.report('federated: all results', federated)
+        self.stdout.write('federated / slowest single source (%s): %.2f'
+                          % (slowest, sum(federated) / sum(single[slowest])))
+
+    def time_search(self, q, names):
+        'get ms until first merged result, and until search complete'
+        t = time.time()
+        tFirst = None
+        for result in SourceDBSearch(q, names, timeout=60.).iter_merged():
+            if tFirst is None:
+                tFirst = time.time()
+        tAll = time.time()
+        if tFirst is None:
+            tFirst = tAll
+        return (tFirst - t) * 1000., (tAll - t) * 1000.
+
+    def report(self, label, times):
+        self.stdout.write('%-26s mean %7.1f ms, p50 %7.1f ms, p95 %7.1f ms'
+                          % (label, sum(times) / len(times),
+                             percentile(times, 50), percentile(times, 95)))
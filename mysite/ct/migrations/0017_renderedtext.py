@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0016_auto_20150626_0301'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenderedText',
+            fields=[
+                ('key', models.CharField(max_length=40, serialize=False, primary_key=True)),
+                ('html', models.TextField()),
+                ('atime', models.DateTimeField(default=django.utils.timezone.now, verbose_name=b'time rendered')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0017_renderedtext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LessonHTML',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('rendererVersion', models.IntegerField()),
+                ('textKey', models.CharField(max_length=40)),
+                ('html', models.TextField()),
+                ('atime', models.DateTimeField(default=django.utils.timezone.now, verbose_name=b'time rendered')),
+                ('lesson', models.ForeignKey(to='ct.Lesson')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='lessonhtml',
+            unique_together=set([('lesson', 'rendererVersion')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fsm', '0005_liveevent'),
+        ('ct', '0018_lessonhtml'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResponseTally',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=40)),
+                ('count', models.IntegerField(default=0)),
+                ('activity', models.ForeignKey(to='fsm.ActivityLog')),
+                ('unitLesson', models.ForeignKey(to='ct.UnitLesson', null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='responsetally',
+            unique_together=set([('activity', 'unitLesson', 'key')]),
+        ),
+    ]
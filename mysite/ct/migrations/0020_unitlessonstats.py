@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+
+
+def response_keys(confidence, selfeval, status):
+    keys = ['responses', 'confidence:%s' % confidence]
+    if selfeval:
+        keys += ['assessed', 'status:%s' % status,
+                 'eval:%s:%s' % (confidence, selfeval)]
+    return keys
+
+
+def build_stats(apps, schema_editor):
+    'roll up existing ORCT responses and student errors'
+    Response = apps.get_model('ct', 'Response')
+    StudentError = apps.get_model('ct', 'StudentError')
+    UnitLessonStats = apps.get_model('ct', 'UnitLessonStats')
+    tallies = {}
+    for d in Response.objects.filter(kind='orct') \
+            .values('unitLesson', 'course', 'confidence', 'selfeval', 'status') \
+            .annotate(c=Count('id')):
+        for key in response_keys(d['confidence'], d['selfeval'], d['status']):
+            k = (d['unitLesson'], d['course'], key)
+            tallies[k] = tallies.get(k, 0) + d['c']
+    for d in StudentError.objects.filter(response__kind='orct') \
+            .values('response__unitLesson', 'response__course', 'errorModel') \
+            .annotate(c=Count('id')):
+        tallies[d['response__unitLesson'], d['response__course'],
+                'error:%d' % d['errorModel']] = d['c']
+    UnitLessonStats.objects.bulk_create(
+        [UnitLessonStats(unitLesson_id=ul_id, course_id=course_id, key=key,
+                         count=c)
+         for (ul_id, course_id, key), c in tallies.items()],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0019_responsetally'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnitLessonStats',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=40)),
+                ('count', models.IntegerField(default=0)),
+                ('course', models.ForeignKey(to='ct.Course')),
+                ('unitLesson', models.ForeignKey(to='ct.UnitLesson')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='unitlessonstats',
+            unique_together=set([('unitLesson', 'course', 'key')]),
+        ),
+        migrations.RunPython(build_stats),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import models, migrations, DatabaseError, transaction
+
+
+def create_search_index(apps, schema_editor):
+    'create and fill the full-text lesson index, if the db supports one'
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            with transaction.atomic(using=schema_editor.connection.alias):
+                schema_editor.execute(
+                    "CREATE VIRTUAL TABLE ct_lessonsearch USING "
+                    "fts5(title, text, tokenize='porter unicode61')")
+        except DatabaseError: # sqlite built without FTS5: search unindexed
+            return
+        schema_editor.execute(
+            "INSERT INTO ct_lessonsearch (rowid, title, text) "
+            "SELECT id, title, coalesce(text, '') FROM ct_lesson")
+    elif vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE ct_lessonsearch (lesson_id integer PRIMARY KEY '
+            'REFERENCES ct_lesson (id) ON DELETE CASCADE '
+            'DEFERRABLE INITIALLY DEFERRED, document tsvector NOT NULL)')
+        schema_editor.execute('CREATE INDEX ct_lessonsearch_document '
+                              'ON ct_lessonsearch USING GIN (document)')
+        config = getattr(settings, 'LESSON_SEARCH_CONFIG', 'english')
+        schema_editor.execute(
+            "INSERT INTO ct_lessonsearch (lesson_id, document) "
+            "SELECT id, setweight(to_tsvector(%s::regconfig, title), 'A') "
+            "|| setweight(to_tsvector(%s::regconfig, coalesce(text, '')), 'B') "
+            "FROM ct_lesson", (config, config))
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute('DROP TABLE IF EXISTS ct_lessonsearch')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0020_unitlessonstats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
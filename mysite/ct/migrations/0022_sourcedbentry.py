@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0021_lessonsearch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SourceDBEntry',
+            fields=[
+                ('key', models.CharField(max_length=40, serialize=False, primary_key=True)),
+                ('sourceDB', models.CharField(max_length=32)),
+                ('data', models.TextField()),
+                ('expires', models.DateTimeField(db_index=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
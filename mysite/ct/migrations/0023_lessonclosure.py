@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def build_trees(apps, schema_editor):
+    'fill closure rows from Lesson.parent, and heads from commit times'
+    Lesson = apps.get_model('ct', 'Lesson')
+    LessonClosure = apps.get_model('ct', 'LessonClosure')
+    LessonTreeHead = apps.get_model('ct', 'LessonTreeHead')
+    parents = dict(Lesson.objects.values_list('pk', 'parent'))
+    rows = []
+    for lessonID in parents:
+        ancestorID, depth = lessonID, 0
+        while ancestorID is not None and depth <= len(parents):
+            rows.append(LessonClosure(ancestor_id=ancestorID,
+                                      descendant_id=lessonID, depth=depth))
+            ancestorID = parents.get(ancestorID)
+            depth += 1
+    LessonClosure.objects.bulk_create(rows, batch_size=1000)
+    heads = {}
+    for lessonID, treeID, commitTime in Lesson.objects \
+            .filter(treeID__isnull=False, commitTime__isnull=False) \
+            .order_by('commitTime', 'pk') \
+            .values_list('pk', 'treeID', 'commitTime'):
+        heads[treeID] = (lessonID, commitTime)
+    LessonTreeHead.objects.bulk_create(
+        [LessonTreeHead(treeID=treeID, lesson_id=lessonID,
+                        commitTime=commitTime)
+         for treeID, (lessonID, commitTime) in heads.items()],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0022_sourcedbentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LessonClosure',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('depth', models.IntegerField()),
+                ('ancestor', models.ForeignKey(related_name='descendantLinks', to='ct.Lesson')),
+                ('descendant', models.ForeignKey(related_name='ancestorLinks', to='ct.Lesson')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='LessonTreeHead',
+            fields=[
+                ('treeID', models.IntegerField(serialize=False, primary_key=True)),
+                ('commitTime', models.DateTimeField(verbose_name=b'time committed')),
+                ('lesson', models.ForeignKey(related_name='treeHeads', to='ct.Lesson')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='lessonclosure',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.RunPython(build_trees),
+    ]
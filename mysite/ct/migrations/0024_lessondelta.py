@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0023_lessonclosure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LessonDelta',
+            fields=[
+                ('lesson', models.OneToOneField(related_name='delta', primary_key=True, serialize=False, to='ct.Lesson')),
+                ('delta', models.BinaryField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='lesson',
+            name='isDelta',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
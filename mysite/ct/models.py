@@ -1,9 +1,17 @@
-from django.db import models, transaction
+import difflib
+from django.db import models, transaction, IntegrityError, connections
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 from django.core.urlresolvers import reverse
-from django.db.models import Q, Count, Max
+from django.db.models import Q, Count, Max, Sum
+from django.db.models.signals import post_init, post_save, post_delete
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.safestring import mark_safe
+from ct.render_cache import RENDERER_VERSION
+from ct.search_index import get_search_backend
+from ct.concept_index import concept_index
+from ct.version_store import LESSON_KEYFRAME_INTERVAL, pack_delta, unpack_delta
 
 
 ########################################################
@@ -93,10 +101,11 @@ class Concept(models.Model):
         return '%s%s/%d/%s' % (basePath, head, objID, tail)
     def get_error_tests(self, **kwargs):
         'get questions that test this error model'
-        return distinct_subset(UnitLesson.objects
+        return UnitLesson.objects \
             .filter(kind=UnitLesson.COMPONENT,
                     unitlesson__kind=UnitLesson.MISUNDERSTANDS,
-                    unitlesson__lesson__concept=self, **kwargs))
+                    unitlesson__lesson__concept=self, **kwargs) \
+            .distinct_trees()
     def get_conceptlinks(self, unit):
         'get list of conceptLinks deduped on (treeID, relationship)'
         d = {}
@@ -158,6 +167,37 @@ ACCESS_CHOICES = (
 )
 
 
+class TreeQuerySet(models.QuerySet):
+    'QuerySet for version-controlled models, which have a treeID'
+    def distinct_trees(self):
+        '''like distinct_subset(), but done by the db: keep just the
+        lowest pk row of each treeID.  Returns a QuerySet (with this
+        one's ordering), so it can still be counted, sliced and paged.'''
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        try:
+            sql, params = self.order_by().values_list('pk', 'treeID') \
+                .query.get_compiler(self.db).as_sql()
+        except EmptyResultSet: # e.g. pk__in=[]
+            return self.none()
+        pk, treeID = qn(self.model._meta.pk.column), qn('treeID')
+        if connection.vendor == 'postgresql':
+            subquery = 'SELECT DISTINCT ON (t.%s) t.%s FROM (%s) t ' \
+                'ORDER BY t.%s, t.%s' % (treeID, pk, sql, treeID, pk)
+        else: # same rows, via GROUP BY
+            subquery = 'SELECT MIN(t.%s) FROM (%s) t GROUP BY t.%s' \
+                % (pk, sql, treeID)
+        # filter a fresh QuerySet, so joins here cannot duplicate rows
+        out = self.model._default_manager.using(self.db).extra(
+            where=['%s.%s IN (%s)' % (qn(self.model._meta.db_table), pk,
+                                      subquery)],
+            params=params)
+        out.query.select_related = self.query.select_related
+        if self.query.order_by:
+            out = out.order_by(*self.query.order_by)
+        return out
+
+
 class Lesson(models.Model):
     BASE_EXPLANATION = 'base' # focused on one concept, as intro for ORCT
     EXPLANATION = 'explanation' # conventional textbook or lecture explanation
@@ -211,7 +251,6 @@ class Lesson(models.Model):
         (DATABASE, 'Database'),
         (SOFTWARE, SOFTWARE),
     )
-    _sourceDBdict = {}
     title = models.CharField(max_length=200)
     text = models.TextField(null=True)
     data = models.TextField(null=True) # JSON DATA
@@ -228,27 +267,23 @@ class Lesson(models.Model):
     atime = models.DateTimeField('time submitted', default=timezone.now)
     concept = models.ForeignKey(Concept, null=True) # concept definition
     treeID = models.IntegerField(null=True) # VCS METADATA
+    objects = TreeQuerySet.as_manager()
     parent = models.ForeignKey('Lesson', null=True,
                                related_name='children')
     mergeParent = models.ForeignKey('Lesson', null=True,
                                     related_name='mergeChildren')
     changeLog = models.TextField(null=True)
     commitTime = models.DateTimeField('time committed', null=True)
+    isDelta = models.BooleanField(default=False) # text, data in LessonDelta
 
     _cloneAttrs = ('title', 'text', 'data', 'url', 'kind', 'medium', 'access',
                    'sourceDB', 'sourceID', 'concept', 'treeID')
 
     @classmethod
     def get_sourceDB_plugin(klass, sourceDB):
-        try:
-            return klass._sourceDBdict[sourceDB]
-        except KeyError:
-            import importlib
-            mod = importlib.import_module('ct.sourcedb_plugin.%s_plugin'
-                                          % sourceDB)
-            dataClass = mod.LessonDoc
-            klass._sourceDBdict[sourceDB] = dataClass
-            return dataClass
+        'get LessonDoc-like access to sourceDB, via the lookup cache'
+        from ct.sourcedb_cache import get_cached_sourceDB
+        return get_cached_sourceDB(sourceDB)
     @classmethod
     def get_from_sourceDB(klass, sourceID, user, sourceDB='wikipedia',
                           doSave=True):
@@ -294,6 +329,8 @@ class Lesson(models.Model):
             self.save()
             self.treeID = self.pk
         self.save()
+        self.add_to_tree()
+        self.save_html()
         if concept:
             if relationship is None:
                 relationship = DEFAULT_RELATION_MAP[self.kind]
@@ -317,6 +354,7 @@ class Lesson(models.Model):
         return self.commitTime is not None
     def _clone_dict(self):
         'get dict of attrs to clone'
+        self.load_text()
         kwargs = {}
         for attr in self._cloneAttrs: # clone our attributes
             kwargs[attr] = getattr(self, attr)
@@ -340,9 +378,111 @@ class Lesson(models.Model):
             self.commitTime = timezone.now()
         if commit or doSave:
             self.save()
+            self.add_to_tree()
+        if commit:
+            self.save_html()
         if copyLinks:
             for cl in self.parent.conceptlink_set.all():
                 cl.copy(self)
+    def add_to_tree(self):
+        '''record this saved version in the LessonClosure table (if new)
+        and, if committed, as head of its tree (if latest)'''
+        LessonClosure.add(self)
+        LessonTreeHead.update(self)
+    def load_text(self):
+        '''fill in our text and data, if stored as a delta (see
+        ct.version_store); returns self'''
+        if self.isDelta and self.text is None and self.data is None:
+            chain = [] # back to the nearest version stored in full
+            for lesson in self.get_history().select_related('delta') \
+                    .iterator():
+                chain.append(lesson)
+                if not lesson.isDelta:
+                    break
+            chain.reverse()
+            LessonDelta.expand(chain)
+            self.text, self.data = chain[-1].text, chain[-1].data
+        return self
+    def get_history(self):
+        'QuerySet of this version and its ancestors, newest first'
+        return self.__class__.objects.filter(descendantLinks__descendant=self) \
+            .order_by('descendantLinks__depth')
+    def get_descendants(self):
+        'QuerySet of all later versions derived from this one'
+        return self.__class__.objects.filter(ancestorLinks__ancestor=self,
+                                             ancestorLinks__depth__gt=0)
+    def get_head(self):
+        'get latest committed version of our tree (None if none committed)'
+        try:
+            return self.__class__.objects.get(treeHeads__treeID=self.treeID)
+        except self.__class__.DoesNotExist:
+            return None
+    @classmethod
+    def get_heads(klass, treeIDs):
+        'QuerySet of latest committed versions of these trees'
+        return klass.objects.filter(treeHeads__treeID__in=treeIDs)
+    def get_changes(self, since=None):
+        '''list of (version, diff) from the root (or from after ancestor
+        since) to this version, where diff is the unified diff of its text
+        against the previous version's'''
+        history = list(self.get_history().select_related('delta'))
+        history.reverse()
+        LessonDelta.expand(history)
+        if since is not None:
+            history = history[[l.pk for l in history].index(since.pk):]
+        else:
+            history.insert(0, None)
+        return [(lesson, text_diff(prev, lesson))
+                for prev, lesson in zip(history, history[1:])]
+    @classmethod
+    def commit_all(klass, lessons, changeLog):
+        '''commit the uncommitted ones of lessons (and their uncommitted
+        parents), as checkin(commit=True) would, with a few queries in
+        all.  changeLog is recorded on those lessons.  Their HTML is
+        stored later, by the render_lessons task.'''
+        lessons = dict((l.pk, l) for l in lessons if not l.is_committed())
+        parents = {}
+        parentIDs = set(l.parent_id for l in lessons.values()) - set([None])
+        while parentIDs:
+            found = list(klass.objects.filter(
+                pk__in=parentIDs - set(lessons) - set(parents),
+                commitTime=None))
+            parents.update((l.pk, l) for l in found)
+            parentIDs = set(l.parent_id for l in found) - set([None])
+        if not lessons:
+            return 0
+        commitTime = timezone.now()
+        klass.objects.filter(pk__in=list(lessons)) \
+            .update(changeLog=changeLog, commitTime=commitTime)
+        if parents:
+            klass.objects.filter(pk__in=list(parents)) \
+                .update(commitTime=commitTime)
+        for lesson in lessons.values():
+            lesson.changeLog = changeLog
+        for lesson in lessons.values() + parents.values():
+            lesson.commitTime = commitTime
+        LessonTreeHead.update_many(lessons.values() + parents.values())
+        return len(lessons) + len(parents)
+    def get_html(self):
+        '''get HTML for our text, normally pre-rendered by save_html().
+        Otherwise renders it (via the render cache) without storing it:
+        page views do not write, checkin and render_lessons store it'''
+        from ct.templatetags.ct_extras import md2html_key
+        text = self.load_text().text or ''
+        try:
+            lh = self.lessonhtml_set.get(rendererVersion=RENDERER_VERSION)
+        except LessonHTML.DoesNotExist:
+            pass
+        else:
+            if lh.textKey == md2html_key(text):
+                return mark_safe(lh.html)
+        return LessonHTML.render_texts([text])[0][0]
+    def save_html(self):
+        'render our text and store it for get_html(); returns the HTML'
+        html, ok = LessonHTML.render_texts([self.load_text().text or ''])[0]
+        if ok:
+            LessonHTML.store(self, html)
+        return html
     def add_concept_link(self, concept, relationship, addedBy):
         'add concept link if not already present'
         if self.conceptlink_set.filter(concept=concept,
@@ -358,6 +498,218 @@ class Lesson(models.Model):
     ##     else:
     ##         return reverse('ct:lesson', args=(self.id,))
 
+def lesson_saved_handler(sender, instance, **kwargs):
+    'update the full-text search index entry of a saved Lesson'
+    get_search_backend(kwargs.get('using')).index([instance.pk])
+post_save.connect(lesson_saved_handler, sender=Lesson)
+
+def lesson_deleted_handler(sender, instance, **kwargs):
+    'drop the full-text search index entry of a deleted Lesson'
+    get_search_backend(kwargs.get('using')).remove([instance.pk])
+post_delete.connect(lesson_deleted_handler, sender=Lesson)
+
+def concept_saved_handler(sender, instance, **kwargs):
+    'update the autocomplete index entry of a saved Concept'
+    concept_index.update(instance.pk, instance.title, instance.isError)
+    if not kwargs.get('created'): # new ones are found by refresh() anyway
+        concept_index.mark_changed(instance.pk)
+post_save.connect(concept_saved_handler, sender=Concept)
+
+def concept_deleted_handler(sender, instance, **kwargs):
+    'drop the autocomplete index entry of a deleted Concept'
+    concept_index.update(instance.pk)
+    concept_index.mark_changed(instance.pk)
+post_delete.connect(concept_deleted_handler, sender=Concept)
+
+def text_diff(old, new):
+    'list of unified diff lines from Lesson old (may be None) to new'
+    if old is None:
+        oldText, oldLabel = '', 'empty'
+    else:
+        oldText, oldLabel = old.text or '', 'version %d' % old.pk
+    return list(difflib.unified_diff(oldText.splitlines(),
+                                     (new.text or '').splitlines(),
+                                     oldLabel, 'version %d' % new.pk,
+                                     lineterm=''))
+
+class LessonClosure(models.Model):
+    '''one row per (ancestor, descendant) pair of Lesson versions linked
+    by parent, including each version paired with itself at depth 0'''
+    ancestor = models.ForeignKey(Lesson, related_name='descendantLinks')
+    descendant = models.ForeignKey(Lesson, related_name='ancestorLinks')
+    depth = models.IntegerField() # number of parent hops
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+
+    @classmethod
+    def add(klass, lesson):
+        'add rows linking a saved lesson to itself and its ancestors'
+        if klass.objects.filter(ancestor=lesson, descendant=lesson).exists():
+            return
+        rows = [klass(ancestor=lesson, descendant=lesson, depth=0)]
+        if lesson.parent_id:
+            ancestors = klass.objects.filter(descendant=lesson.parent_id) \
+                .values_list('ancestor', 'depth')
+            if not ancestors: # parent predates the closure table
+                klass.add(lesson.parent)
+                ancestors = ancestors.all()
+            rows += [klass(ancestor_id=ancestor_id, descendant=lesson,
+                           depth=depth + 1) for ancestor_id, depth in ancestors]
+        try:
+            with transaction.atomic(): # may race with another worker
+                klass.objects.bulk_create(rows)
+        except IntegrityError:
+            pass
+    @classmethod
+    def rebuild(klass, batchSize=1000):
+        'recompute all rows from Lesson.parent; returns number of rows'
+        klass.objects.all().delete()
+        parents = dict(Lesson.objects.values_list('pk', 'parent'))
+        rows = []
+        n = 0
+        for lessonID in parents:
+            ancestorID, depth = lessonID, 0
+            while ancestorID is not None and depth <= len(parents):
+                rows.append(klass(ancestor_id=ancestorID,
+                                  descendant_id=lessonID, depth=depth))
+                ancestorID = parents.get(ancestorID)
+                depth += 1
+            if len(rows) >= batchSize:
+                klass.objects.bulk_create(rows)
+                n += len(rows)
+                rows = []
+        klass.objects.bulk_create(rows)
+        return n + len(rows)
+
+class LessonTreeHead(models.Model):
+    'latest committed Lesson version of each treeID'
+    treeID = models.IntegerField(primary_key=True)
+    lesson = models.ForeignKey(Lesson, related_name='treeHeads')
+    commitTime = models.DateTimeField('time committed')
+
+    @classmethod
+    def update(klass, lesson):
+        'make lesson head of its tree, if committed and latest'
+        if lesson.treeID is None or not lesson.is_committed():
+            return
+        kwargs = dict(lesson=lesson, commitTime=lesson.commitTime)
+        current = klass.objects.filter(treeID=lesson.treeID,
+                                       commitTime__lte=lesson.commitTime)
+        if current.update(**kwargs):
+            return
+        try:
+            with transaction.atomic(): # may race with another worker
+                klass.objects.create(treeID=lesson.treeID, **kwargs)
+        except IntegrityError: # head exists, so check again if it's older
+            current.update(**kwargs)
+    @classmethod
+    def update_many(klass, lessons):
+        'update() for many lessons, with three queries'
+        latest = {}
+        for lesson in lessons:
+            if lesson.treeID is not None and lesson.is_committed() and \
+                    (lesson.treeID not in latest or
+                     latest[lesson.treeID].commitTime <= lesson.commitTime):
+                latest[lesson.treeID] = lesson
+        current = klass.objects.filter(treeID__in=list(latest))
+        for treeID, commitTime in current.values_list('treeID', 'commitTime'):
+            if commitTime > latest[treeID].commitTime: # already later
+                del latest[treeID]
+        current.filter(treeID__in=list(latest)).delete()
+        klass.objects.bulk_create([
+            klass(treeID=treeID, lesson=lesson, commitTime=lesson.commitTime)
+            for treeID, lesson in latest.items()
+        ])
+    @classmethod
+    def rebuild(klass):
+        'recompute all heads from Lesson commit times; returns number'
+        klass.objects.all().delete()
+        heads = {}
+        for lessonID, treeID, commitTime in Lesson.objects \
+                .filter(treeID__isnull=False, commitTime__isnull=False) \
+                .order_by('commitTime', 'pk') \
+                .values_list('pk', 'treeID', 'commitTime'):
+            heads[treeID] = (lessonID, commitTime)
+        klass.objects.bulk_create([
+            klass(treeID=treeID, lesson_id=lessonID, commitTime=commitTime)
+            for treeID, (lessonID, commitTime) in heads.items()
+        ], batch_size=1000)
+        return len(heads)
+
+class LessonDelta(models.Model):
+    '''text and data of an old Lesson version, stored as a compressed
+    delta from its parent version's (see ct.version_store)'''
+    lesson = models.OneToOneField(Lesson, primary_key=True,
+                                  related_name='delta')
+    delta = models.BinaryField()
+
+    @staticmethod
+    def expand(lessons):
+        '''fill in text and data of the isDelta versions in lessons,
+        each of which must come after its parent (also in lessons)'''
+        versions = {}
+        for lesson in lessons:
+            if lesson.isDelta and lesson.text is None and lesson.data is None:
+                parent = versions[lesson.parent_id]
+                lesson.text, lesson.data = unpack_delta(
+                    lesson.delta.delta, parent.text, parent.data)
+            versions[lesson.pk] = lesson
+    @classmethod
+    def compress_all(klass, keyframeInterval=LESSON_KEYFRAME_INTERVAL,
+                     batchSize=100):
+        '''store old versions of all lessons as deltas, where that saves
+        space; returns number of versions compressed'''
+        pinned = set(LessonTreeHead.objects.values_list('lesson', flat=True))
+        for model in (UnitLesson, Response, StudyList, ConceptLink):
+            pinned.update(model.objects.values_list('lesson', flat=True)
+                          .distinct())
+        treeIDs = list(Lesson.objects.filter(parent__isnull=False)
+                       .values_list('treeID', flat=True).distinct())
+        n = 0
+        for i in range(0, len(treeIDs), batchSize):
+            with transaction.atomic():
+                n += klass.compress_trees(treeIDs[i:i + batchSize], pinned,
+                                          keyframeInterval)
+        return n
+    @classmethod
+    def compress_trees(klass, treeIDs, pinned, keyframeInterval):
+        '''store versions in these trees as deltas, except for pinned
+        (lesson IDs), uncommitted and keyframe versions and roots;
+        pinned versions already stored as deltas get their full text
+        back.  Returns number of versions compressed'''
+        lessons = list(Lesson.objects.filter(treeID__in=treeIDs)
+                       .select_related('delta').order_by('pk'))
+        klass.expand(lessons)
+        versions = dict((lesson.pk, lesson) for lesson in lessons)
+        depths, rows, restored = {}, [], []
+        for lesson in lessons: # parents come first
+            parent = versions.get(lesson.parent_id)
+            depths[lesson.pk] = depths[parent.pk] + 1 if parent else 0
+            if lesson.isDelta and lesson.pk in pinned:
+                Lesson.objects.filter(pk=lesson.pk).update(
+                    text=lesson.text, data=lesson.data, isDelta=False)
+                restored.append(lesson.pk)
+            if lesson.isDelta or lesson.pk in pinned or \
+                    depths[lesson.pk] % keyframeInterval == 0 or \
+                    not lesson.is_committed() or not parent.is_committed():
+                continue
+            delta = pack_delta(parent.text, parent.data,
+                               lesson.text, lesson.data)
+            if len(delta) < len(lesson.text or '') + len(lesson.data or ''):
+                rows.append(klass(lesson=lesson, delta=delta))
+        klass.objects.bulk_create(rows, batch_size=100)
+        lessonIDs = [row.lesson_id for row in rows]
+        for i in range(0, len(lessonIDs), 500):
+            chunk = lessonIDs[i:i + 500]
+            Lesson.objects.filter(pk__in=chunk) \
+                .update(text=None, data=None, isDelta=True)
+            LessonHTML.objects.filter(lesson__in=chunk).delete()
+            get_search_backend().remove(chunk)
+        if restored:
+            klass.objects.filter(lesson__in=restored).delete()
+            get_search_backend().index(restored)
+        return len(rows)
+
 def distinct_subset(inlist, distinct_func=lambda x:x.treeID):
     'eliminate duplicate treeIDs from the input list'
     s = set()
@@ -484,6 +836,7 @@ class UnitLesson(models.Model):
     atime = models.DateTimeField('time added', default=timezone.now)
     addedBy = models.ForeignKey(User)
     treeID = models.IntegerField() # VCS METADATA
+    objects = TreeQuerySet.as_manager()
     branch = models.CharField(max_length=32, default='master')
     ## @classmethod
     ## def create_from_concept(klass, concept, unit=None, ulArgs={}, **kwargs):
@@ -528,34 +881,40 @@ class UnitLesson(models.Model):
         else: # search for regular concepts (not an error)
             kwargs['lesson__concept__isnull'] = False
             kwargs['lesson__concept__isError'] = False
-        out = klass.objects.filter((Q(lesson__title__icontains=s) |
-                                    Q(lesson__text__icontains=s)) &
-                                   Q(**kwargs)).distinct()
+        search = get_search_backend()
+        out = search.filter(klass.objects.filter(**kwargs), s).distinct()
         if excludeArgs:
             out = out.exclude(**excludeArgs)
         if dedupe:
-            out = distinct_subset(out)
-        return out
+            out = out.distinct_trees()
+        return search.order_by_rank(out, s)
     @classmethod
     def search_sourceDB(klass, query, sourceDB='wikipedia', unit=None,
                         **kwargs):
         'get sourceDB search results, represented by existing ULs if any'
+        return klass.map_sourceDB_results(
+            Lesson.search_sourceDB(query, sourceDB, **kwargs), sourceDB, unit)
+    @classmethod
+    def map_sourceDB_results(klass, results, sourceDB='wikipedia', unit=None):
+        '''split sourceDB search results into existing ULs (preferring
+        ones in unit) and remaining [(title, sourceID, url)], in one query'''
+        hits = {}
+        for ul in klass.objects.filter(
+                lesson__sourceDB=sourceDB,
+                lesson__sourceID__in=[t[1] for t in results]) \
+                .select_related('lesson').order_by('pk'):
+            sourceID = ul.lesson.sourceID
+            if sourceID not in hits or (unit and ul.unit_id == unit.pk
+                                        and hits[sourceID].unit_id != unit.pk):
+                hits[sourceID] = ul # use UL from this unit if any
         resultsUL = []
-        results = []
-        for t in Lesson.search_sourceDB(query, sourceDB, **kwargs):
-            queryArgs = dict(lesson__sourceDB=sourceDB, lesson__sourceID=t[1])
-            hits = ()
-            if unit:
-                hits = klass.objects.filter(unit=unit, **queryArgs)
-            try: # use UL from this unit if any
-                resultsUL.append(hits[0])
-            except IndexError:
-                hits = klass.objects.filter(**queryArgs)
-                try: # otherwise use any UL matching this sourceID
-                    resultsUL.append(hits[0])
-                except IndexError: # no UL so just return tuple
-                    results.append(t)
-        return resultsUL, results
+        remaining = []
+        for t in results:
+            if t[1] in hits:
+                resultsUL.append(hits[t[1]])
+            else: # no UL so just return tuple
+                remaining.append(t)
+        return resultsUL, remaining
     def get_answers(self):
         'get query set with answer(s) if any'
         return self.unitlesson_set.filter(kind=self.ANSWERS)
@@ -581,9 +940,9 @@ class UnitLesson(models.Model):
         return self.response_set.filter(kind=Response.STUDENT_QUESTION,
                                         needsEval=True)
     def get_alternative_defs(self, **kwargs):
-        return distinct_subset(self.__class__.objects
-            .filter(lesson__concept=self.lesson.concept)
-            .exclude(treeID=self.treeID))
+        return self.__class__.objects \
+            .filter(lesson__concept=self.lesson.concept) \
+            .exclude(treeID=self.treeID).distinct_trees()
     def get_next_lesson(self):
         if self.order is not None:
             return self.unit.unitlesson_set.get(order=self.order + 1)
@@ -628,6 +987,53 @@ class UnitLesson(models.Model):
         for child in self.unitlesson_set.all(): # copy children
             child.copy(unit, addedBy, parent=ul, **kwargs)
         return ul
+    @classmethod
+    def bulk_copy(klass, uls, unit, addedBy, progress=None):
+        '''copy uls to unit, like copy() but with one INSERT per level
+        of their parent tree; uls must include all their children.
+        Returns {original UL id: copy}.  progress(nDone, nTotal) is
+        called after each level.'''
+        uls = list(uls)
+        name = addedBy.get_full_name() or addedBy.get_username()
+        Lesson.commit_all([ul.lesson for ul in uls if ul.lesson_id],
+                          'snapshot for fork by %s' % name)
+        ids = set(ul.pk for ul in uls)
+        children = {}
+        for ul in uls:
+            parentID = ul.parent_id if ul.parent_id in ids else None
+            children.setdefault(parentID, []).append(ul)
+        def key(ul, parentID):
+            'copied fields: rows with the same key are interchangeable'
+            return (ul.lesson_id, ul.kind, ul.treeID, ul.order, ul.branch,
+                    parentID)
+        lastID = klass.objects.filter(unit=unit) \
+            .aggregate(n=Max('pk'))['n'] or 0
+        copies = {}
+        level = children.get(None, [])
+        while level:
+            klass.objects.bulk_create([
+                klass(lesson_id=ul.lesson_id, addedBy=addedBy, unit=unit,
+                      kind=ul.kind, treeID=ul.treeID, order=ul.order,
+                      parent=copies.get(ul.parent_id), branch=ul.branch)
+                for ul in level
+            ])
+            # bulk_create() does not set pks, and the db need not number
+            # the rows in insert order, so match them up by their fields
+            new = {}
+            for copy in klass.objects.filter(unit=unit, pk__gt=lastID):
+                new.setdefault(key(copy, copy.parent_id), []).append(copy)
+                lastID = max(lastID, copy.pk)
+            for ul in level:
+                parent = copies.get(ul.parent_id)
+                try:
+                    copies[ul.pk] = new[key(ul, parent and parent.pk)].pop()
+                except (KeyError, IndexError):
+                    raise ValueError('no copy of UnitLesson %d was inserted'
+                                     % ul.pk)
+            if progress:
+                progress(len(copies), len(uls))
+            level = [child for ul in level for child in children.get(ul.pk, ())]
+        return copies
     def save_resolution(self, lesson):
         'save new lesson as resolution for this error model UL'
         if not self.lesson.concept or self.kind != self.MISUNDERSTANDS:
@@ -762,8 +1168,9 @@ class Unit(models.Model):
             .filter(kind=UnitLesson.MISUNDERSTANDS, parent__isnull=True))
         if not aborts: # need to add ABORTs etc. to this unit
             aborts = []
-            for errorLesson in distinct_subset(Lesson.objects
-                .filter(kind=Lesson.ERROR_MODEL, concept__alwaysAsk=True)):
+            for errorLesson in Lesson.objects \
+                .filter(kind=Lesson.ERROR_MODEL, concept__alwaysAsk=True) \
+                .distinct_trees():
                 em = self.unitlesson_set.create(lesson=errorLesson,
                         kind=UnitLesson.MISUNDERSTANDS,
                         addedBy=errorLesson.addedBy,
@@ -771,50 +1178,66 @@ class Unit(models.Model):
                 aborts.append(em)
         return aborts
     def get_new_inquiry_uls(self, **kwargs):
-        return distinct_subset(self.unitlesson_set
+        return (self.unitlesson_set
             .filter(response__kind=Response.STUDENT_QUESTION,
-                    response__needsEval=True, **kwargs))
+                    response__needsEval=True, **kwargs)
+            .distinct_trees())
     def get_errorless_uls(self, **kwargs):
-        return distinct_subset(self.unitlesson_set
+        return (self.unitlesson_set
             .filter(lesson__kind=Lesson.ORCT_QUESTION,  **kwargs)
-            .exclude(unitlesson__kind=UnitLesson.MISUNDERSTANDS))
+            .exclude(unitlesson__kind=UnitLesson.MISUNDERSTANDS)
+            .distinct_trees())
     def get_resoless_uls(self, **kwargs):
-        return distinct_subset(self.unitlesson_set
+        return (self.unitlesson_set
             .filter(Q(unitlesson__kind=UnitLesson.MISUNDERSTANDS, **kwargs)
             & ~Q(unitlesson__lesson__concept__conceptlink__relationship=
-                 ConceptLink.RESOLVES)))
+                 ConceptLink.RESOLVES))
+            .distinct_trees())
     def get_unanswered_uls(self, user=None, **kwargs):
         if user:
             kwargs['response__author'] = user
-        return distinct_subset(self.unitlesson_set
+        return (self.unitlesson_set
           .filter(lesson__kind=Lesson.ORCT_QUESTION)
-          .exclude(response__kind=Response.ORCT_RESPONSE, **kwargs))
+          .exclude(response__kind=Response.ORCT_RESPONSE, **kwargs)
+          .distinct_trees())
     def get_selfeval_uls(self, user=None, **kwargs):
         if user:
             kwargs['response__author'] = user
         else: # ensure it finds Response
             kwargs['response__isnull'] = False
-        return distinct_subset(self.unitlesson_set
+        return (self.unitlesson_set
             .filter(response__selfeval__isnull=True,
-                    response__kind=Response.ORCT_RESPONSE, **kwargs))
+                    response__kind=Response.ORCT_RESPONSE, **kwargs)
+            .distinct_trees())
     def get_serrorless_uls(self, user=None, **kwargs):
         if user:
             kwargs['response__author'] = user
-        return distinct_subset(self.unitlesson_set
+        return (self.unitlesson_set
             .filter((Q(response__selfeval=Response.DIFFERENT) |
                      Q(response__status=NEED_HELP_STATUS)) &
-                    Q(response__studenterror__isnull=True, **kwargs)))
+                    Q(response__studenterror__isnull=True, **kwargs))
+            .distinct_trees())
     def get_unresolved_uls(self, user=None, **kwargs):
         'get ORCT with errors not yet DONE_STATUS'
         if user:
             kwargs['response__author'] = user
-        return distinct_subset(self.unitlesson_set
+        return (self.unitlesson_set
             .filter(response__studenterror__status__in=
-                    [NEED_HELP_STATUS, NEED_REVIEW_STATUS], **kwargs))
+                    [NEED_HELP_STATUS, NEED_REVIEW_STATUS], **kwargs)
+            .distinct_trees())
     def get_study_url(self, path, extension=['tasks']):
         'return URL for next study tasks on this unit'
         from ct.templatetags.ct_extras import get_base_url
         return get_base_url(path, extension)
+    @transaction.atomic
+    def fork(self, addedBy, title=None, progress=None):
+        '''copy this unit, with all its UnitLessons, to a new Unit in
+        bulk; see UnitLesson.bulk_copy()'''
+        unit = self.__class__.objects.create(title=title or self.title,
+                                             kind=self.kind, addedBy=addedBy)
+        UnitLesson.bulk_copy(self.unitlesson_set.select_related('lesson')
+                             .order_by('pk'), unit, addedBy, progress)
+        return unit
     def append(self, ul, user):
         'append unitLesson to main lesson sequence'
         if ul.unit == self:
@@ -964,13 +1387,20 @@ class Response(models.Model):
             tail = ''
         return '%slessons/%d/responses/%d/%s' % (basePath, self.unitLesson_id,
                                                  self.pk, tail)
-    def get_next_step(self):
-        'indicate what task student should do next'
+    def get_next_step(self, errors=None):
+        '''indicate what task student should do next; errors is the
+        list of this response's StudentErrors, if already fetched'''
         if not self.selfeval:
             return self.SELFEVAL_STEP, 'self-assess your answer'
+        if self.needs_classify(errors):
+            return self.CLASSIFY_STEP, 'classify your error(s)'
+    def needs_classify(self, errors=None):
+        'True if student said this answer is wrong but classified no error'
         if self.selfeval == self.DIFFERENT or self.status == NEED_HELP_STATUS:
-            if self.studenterror_set.count() == 0:
-                return self.CLASSIFY_STEP, 'classify your error(s)'
+            if errors is None:
+                return self.studenterror_set.count() == 0
+            return not errors
+        return False
 
         
 
@@ -1000,19 +1430,329 @@ class StudentError(models.Model):
         'get StudentErrors for a specific question'
         return klass.objects.filter(response__unitLesson=ul, **kwargs)
 
-def errormodel_table(target, n, fmt='%d (%.0f%%)', includeAll=False, attr=''):
-    if n == 0: # prevent div by zero error
-        n = 1
-    kwargs = {'kind':Lesson.MISUNDERSTANDS, 'parent':target}
-    l = []
-    for em in UnitLesson.objects.filter(**kwargs):
-        kwargs = {'errorModel':em}
-        nse = StudentError.objects.filter(**kwargs).count()
-        if nse > 0 or includeAll:
-            l.append((em, nse))
-    l.sort(lambda x,y:cmp(x[1], y[1]), reverse=True)
-    fmt_count = lambda c: fmt % (c, c * 100. / n)
-    return [(t[0],fmt_count(t[1])) for t in l]
+class StudentTasks(object):
+    '''next steps for one student on a unit, or on one UnitLesson.
+    Fetches the student's responses and their StudentErrors in two
+    queries, then classifies them in one pass.'''
+    def __init__(self, user, unit=None, unitLesson=None):
+        if unitLesson is not None:
+            kwargs = dict(unitLesson=unitLesson)
+        else:
+            kwargs = dict(unitLesson__unit=unit)
+        self.unit = unit
+        self.responses = list(Response.objects.filter(author=user, **kwargs)
+                              .select_related('unitLesson__lesson')
+                              .order_by('atime'))
+        self.errors = dict((r.pk, []) for r in self.responses)
+        if self.responses:
+            for se in StudentError.objects.filter(
+                    response__author=user,
+                    **dict(('response__' + k, v) for k, v in kwargs.items())) \
+                    .select_related('errorModel__lesson').order_by('atime'):
+                self.errors[se.response_id].append(se)
+    def get_response_table(self):
+        'list of (response, step, label) for responses needing work'
+        l = []
+        for r in self.responses:
+            step = r.get_next_step(self.errors[r.pk])
+            if step and (r.kind == Response.ORCT_RESPONSE or
+                         step[0] == Response.CLASSIFY_STEP):
+                l.append((r, step[0], step[1]))
+        return l
+    def get_error_table(self):
+        'latest unresolved StudentError for each error model'
+        d = {}
+        for r in self.responses:
+            for se in self.errors[r.pk]:
+                if se.status != DONE_STATUS:
+                    d[se.errorModel_id] = se
+        return d.values()
+    def get_task_table(self):
+        '''list of (ul, task) for the unit, where task is 'start',
+        'selfeval', 'classify' or 'resolve'; one query for the unit's
+        questions, on top of the two in the constructor'''
+        answered = set()
+        tasks = dict(selfeval=[], classify=[], resolve=[])
+        for r in sorted(self.responses, key=lambda r:r.unitLesson_id):
+            errors = self.errors[r.pk]
+            if r.kind == Response.ORCT_RESPONSE:
+                answered.add(r.unitLesson_id)
+                if not r.selfeval:
+                    tasks['selfeval'].append(r.unitLesson)
+            if r.needs_classify(errors):
+                tasks['classify'].append(r.unitLesson)
+            if [se for se in errors
+                if se.status in (NEED_HELP_STATUS, NEED_REVIEW_STATUS)]:
+                tasks['resolve'].append(r.unitLesson)
+        tasks['start'] = [ul for ul in self.unit.unitlesson_set
+                          .filter(lesson__kind=Lesson.ORCT_QUESTION)
+                          .select_related('lesson').order_by('pk')
+                          if ul.pk not in answered]
+        return [(ul, task) for task in ('start', 'selfeval', 'classify',
+                                        'resolve')
+                for ul in distinct_subset(tasks[task])]
+
+class Tally(models.Model):
+    '''abstract table of named response counters within some scope.
+    key is one of 'responses', 'assessed', 'confidence:C', 'status:S',
+    'eval:C:E' (C: confidence, S: status, E: selfeval) or subclass keys.'''
+    key = models.CharField(max_length=40)
+    count = models.IntegerField(default=0)
+    class Meta:
+        abstract = True
+
+    @staticmethod
+    def response_keys(confidence, selfeval, status):
+        'tally keys that one Response with these values counts toward'
+        keys = ['responses', 'confidence:%s' % confidence]
+        if selfeval:
+            keys += ['assessed', 'status:%s' % status,
+                     'eval:%s:%s' % (confidence, selfeval)]
+        return keys
+    @classmethod
+    def add(klass, keys, delta=1, **scope):
+        '''atomically add delta to each tally key, creating rows as needed
+        (but not for negative delta, e.g. while its scope is being deleted)'''
+        for key in keys:
+            kwargs = dict(key=key, **scope)
+            if klass.objects.filter(**kwargs) \
+                   .update(count=models.F('count') + delta) or delta < 0:
+                continue
+            try:
+                with transaction.atomic(): # may race with another student
+                    klass.objects.create(count=delta, **kwargs)
+            except IntegrityError:
+                klass.objects.filter(**kwargs) \
+                    .update(count=models.F('count') + delta)
+    @staticmethod
+    def make_tables(d, n, tableKey='status', fmt_count=fmt_count,
+                    simpleTable=False,
+                    title='Student Status for Understanding This Lesson'):
+        'same tables as Response.get_counts(), from dict of tallies d'
+        if not n: # prevent DivideByZero
+            return (), (), 0
+        prefix = tableKey + ':'
+        choices = dict(status=STATUS_TABLE_LABELS,
+                       confidence=Response.CONF_CHOICES)[tableKey]
+        statusTable = CountsTable(title, choices, n,
+                                  dict((k[len(prefix):], c) for k, c in d.items()
+                                       if k.startswith(prefix)))
+        if simpleTable: # caller only wants statusTable
+            return statusTable, n, None
+        l = []
+        for conf,label in Response.CONF_CHOICES:
+            l.append((label, [fmt_count(d.get('eval:%s:%s' % (conf, selfeval), 0), n)
+                              for selfeval,_ in Response.EVAL_CHOICES]))
+        return statusTable, l, n
+
+class ResponseTally(Tally):
+    '''running count of ORCT Responses to a question in one live activity.
+    Live session size is kept under STUDENTS_KEY with no unitLesson.
+    Serves live tables with one query, however big the class.'''
+    STUDENTS_KEY = 'students'
+    activity = models.ForeignKey('fsm.ActivityLog')
+    unitLesson = models.ForeignKey(UnitLesson, null=True)
+    class Meta:
+        unique_together = ('activity', 'unitLesson', 'key')
+
+    @classmethod
+    def count_response(klass, r, old=None):
+        '''update tallies for Response r just saved; old is
+        (confidence, selfeval, status) before this save, if it existed'''
+        if not r.activity_id or r.kind != Response.ORCT_RESPONSE:
+            return
+        keys = klass.response_keys(r.confidence, r.selfeval, r.status)
+        if old:
+            oldKeys = klass.response_keys(*old)
+            klass.add([k for k in oldKeys if k not in keys], -1,
+                      activity_id=r.activity_id, unitLesson_id=r.unitLesson_id)
+            keys = [k for k in keys if k not in oldKeys]
+        klass.add(keys, activity_id=r.activity_id,
+                  unitLesson_id=r.unitLesson_id)
+    @classmethod
+    def start_session(klass, activity):
+        'create session size tally for a new live session activity'
+        klass.objects.create(activity=activity, key=klass.STUDENTS_KEY)
+    @classmethod
+    def add_student(klass, activity_id, delta=1):
+        'change the live session size, without creating a race-prone row'
+        klass.objects.filter(activity_id=activity_id, unitLesson__isnull=True,
+                             key=klass.STUDENTS_KEY) \
+            .update(count=models.F('count') + delta)
+    @classmethod
+    def get_counts(klass, activity_id, unitLesson, tableKey='status',
+                   fmt_count=fmt_count, simpleTable=False,
+                   title='Student Status for Understanding This Lesson'):
+        '''same tables as Response.get_counts() for live session responses,
+        with n = session size; tableKey 'status' covers assessed responses'''
+        d = dict(klass.objects.filter(Q(unitLesson=unitLesson) |
+                                      Q(unitLesson__isnull=True),
+                                      activity_id=activity_id)
+                 .values_list('key', 'count'))
+        n = d.get(klass.STUDENTS_KEY) or \
+            d.get(dict(status='assessed').get(tableKey, 'responses'), 0)
+        return klass.make_tables(d, n, tableKey, fmt_count, simpleTable, title)
+    @classmethod
+    def rebuild(klass, activity_id):
+        '''recompute tallies of an activity from Response and FSMState rows.
+        Deletes first, so that concurrent add() calls either wait for us
+        or are counted by our queries.  Returns number of tally rows.'''
+        from fsm.models import FSMState
+        with transaction.atomic():
+            isLive = FSMState.objects.filter(activity_id=activity_id,
+                                             isLiveSession=True).exists()
+            old = klass.objects.filter(activity_id=activity_id)
+            if not isLive: # keep final size of a finished session
+                old = old.exclude(key=klass.STUDENTS_KEY)
+            old.delete()
+            tallies = {}
+            for d in Response.objects.filter(activity_id=activity_id,
+                                             kind=Response.ORCT_RESPONSE) \
+                    .values('unitLesson', 'confidence', 'selfeval', 'status') \
+                    .annotate(c=Count('id')):
+                for key in klass.response_keys(d['confidence'], d['selfeval'],
+                                               d['status']):
+                    k = (d['unitLesson'], key)
+                    tallies[k] = tallies.get(k, 0) + d['c']
+            rows = [klass(activity_id=activity_id, unitLesson_id=ul_id,
+                          key=key, count=c)
+                    for (ul_id, key), c in tallies.items()]
+            if isLive:
+                n = FSMState.objects.filter(linkState__activity_id=activity_id,
+                                            linkState__isLiveSession=True).count()
+                rows.append(klass(activity_id=activity_id,
+                                  key=klass.STUDENTS_KEY, count=n))
+            klass.objects.bulk_create(rows)
+        return len(rows)
+
+class UnitLessonStats(Tally):
+    '''rollup of all ORCT Responses to a question within one course,
+    plus 'error:ID' counts of StudentErrors for error model UnitLesson ID.
+    Kept current by Response / StudentError signal handlers, so that
+    instructor dashboards need not scan raw responses.'''
+    ERROR_PREFIX = 'error:'
+    unitLesson = models.ForeignKey(UnitLesson)
+    course = models.ForeignKey('Course')
+    class Meta:
+        unique_together = ('unitLesson', 'course', 'key')
+
+    @classmethod
+    def response_scope(klass, r):
+        '''(unitLesson_id, course_id, keys) that Response r counts toward,
+        or None if it is not counted'''
+        if r.pk is None or r.kind != Response.ORCT_RESPONSE:
+            return None
+        return (r.unitLesson_id, r.course_id,
+                klass.response_keys(r.confidence, r.selfeval, r.status))
+    @classmethod
+    def update(klass, old, new):
+        'move counts from scope old to scope new (either may be None)'
+        if old == new:
+            return
+        if old and new and old[:2] == new[:2]: # only apply the difference
+            old, new = ((old[0], old[1], [k for k in old[2] if k not in new[2]]),
+                        (new[0], new[1], [k for k in new[2] if k not in old[2]]))
+        if old:
+            klass.add(old[2], -1, unitLesson_id=old[0], course_id=old[1])
+        if new:
+            klass.add(new[2], unitLesson_id=new[0], course_id=new[1])
+    @classmethod
+    def get_dict(klass, unitLesson):
+        'get {key:count} for unitLesson, summed over all courses'
+        return dict(klass.objects.filter(unitLesson=unitLesson)
+                    .values_list('key').annotate(c=Sum('count')))
+    @classmethod
+    def get_counts(klass, unitLesson, d=None, **kwargs):
+        '''same tables as Response.get_counts() for all assessed responses
+        to unitLesson'''
+        if d is None:
+            d = klass.get_dict(unitLesson)
+        return klass.make_tables(d, d.get('assessed', 0), **kwargs)
+    @classmethod
+    def get_error_counts(klass, d, n, fmt_count=fmt_count):
+        'same table as StudentError.get_counts(), from get_dict() result d'
+        counts = dict((int(k[len(klass.ERROR_PREFIX):]), c)
+                      for k, c in d.items()
+                      if k.startswith(klass.ERROR_PREFIX) and c > 0)
+        ems = UnitLesson.objects.select_related('lesson').in_bulk(list(counts))
+        l = [(ems[pk], c) for pk, c in counts.items() if pk in ems]
+        l.sort(lambda x,y:cmp(x[1], y[1]), reverse=True)
+        return [(t[0],fmt_count(t[1], n)) for t in l]
+    @classmethod
+    def rebuild(klass, unitLesson_ids=None, batchSize=500):
+        '''recompute rollup rows (for just unitLesson_ids, if given) from
+        Response and StudentError rows.  Returns number of rows.'''
+        responses = Response.objects.filter(kind=Response.ORCT_RESPONSE)
+        errors = StudentError.objects.filter(
+            response__kind=Response.ORCT_RESPONSE)
+        old = klass.objects.all()
+        if unitLesson_ids is not None:
+            responses = responses.filter(unitLesson__in=unitLesson_ids)
+            errors = errors.filter(response__unitLesson__in=unitLesson_ids)
+            old = old.filter(unitLesson__in=unitLesson_ids)
+        with transaction.atomic():
+            old.delete()
+            tallies = {}
+            for d in responses.values('unitLesson', 'course', 'confidence',
+                                      'selfeval', 'status') \
+                    .annotate(c=Count('id')):
+                for key in klass.response_keys(d['confidence'], d['selfeval'],
+                                               d['status']):
+                    k = (d['unitLesson'], d['course'], key)
+                    tallies[k] = tallies.get(k, 0) + d['c']
+            for d in errors.values('response__unitLesson', 'response__course',
+                                   'errorModel').annotate(c=Count('id')):
+                k = (d['response__unitLesson'], d['response__course'],
+                     '%s%d' % (klass.ERROR_PREFIX, d['errorModel']))
+                tallies[k] = d['c']
+            klass.objects.bulk_create(
+                [klass(unitLesson_id=ul_id, course_id=course_id, key=key,
+                       count=c)
+                 for (ul_id, course_id, key), c in tallies.items()],
+                batch_size=batchSize)
+        return len(tallies)
+
+def response_init_handler(sender, instance, **kwargs):
+    'remember what a loaded Response counts toward, to diff on save'
+    instance._statsScope = UnitLessonStats.response_scope(instance)
+post_init.connect(response_init_handler, sender=Response)
+
+def response_saved_handler(sender, instance, raw=False, **kwargs):
+    'update UnitLessonStats for a changed Response'
+    if raw: # loading fixtures; use rebuild_stats
+        return
+    new = UnitLessonStats.response_scope(instance)
+    UnitLessonStats.update(getattr(instance, '_statsScope', None), new)
+    instance._statsScope = new
+post_save.connect(response_saved_handler, sender=Response)
+
+def response_deleted_handler(sender, instance, **kwargs):
+    'remove a deleted Response from UnitLessonStats'
+    UnitLessonStats.update(getattr(instance, '_statsScope', None), None)
+post_delete.connect(response_deleted_handler, sender=Response)
+
+def count_student_error(se, delta):
+    'add delta to the UnitLessonStats error count for StudentError se'
+    try:
+        r = se.response
+    except Response.DoesNotExist:
+        return
+    if r.kind == Response.ORCT_RESPONSE:
+        UnitLessonStats.add(['%s%d' % (UnitLessonStats.ERROR_PREFIX,
+                                       se.errorModel_id)], delta,
+                            unitLesson_id=r.unitLesson_id, course_id=r.course_id)
+
+def student_error_saved_handler(sender, instance, created, raw=False,
+                                **kwargs):
+    'count a new StudentError in UnitLessonStats'
+    if created and not raw:
+        count_student_error(instance, 1)
+post_save.connect(student_error_saved_handler, sender=StudentError)
+
+def student_error_deleted_handler(sender, instance, **kwargs):
+    'uncount a deleted StudentError from UnitLessonStats'
+    count_student_error(instance, -1)
+post_delete.connect(student_error_deleted_handler, sender=StudentError)
 
 class InquiryCount(models.Model):
     'record users who have the same question'
@@ -1061,6 +1801,25 @@ class Course(models.Model):
                         order=CourseUnit.objects.filter(course=self).count())
         cu.save()
         return unit
+    @transaction.atomic
+    def fork(self, addedBy, title=None, progress=None):
+        '''copy this course and its units (via Unit.fork()) to a new
+        course taught by addedBy, with its units not yet released.
+        progress(nDone, nTotal) is called after each unit.'''
+        course = self.__class__.objects.create(
+            title=title or self.title, description=self.description,
+            access=self.access, lockout=self.lockout, addedBy=addedBy)
+        Role.objects.create(course=course, user=addedBy, role=Role.INSTRUCTOR)
+        courseUnits = list(self.courseunit_set.select_related('unit')
+                           .order_by('order'))
+        forks = []
+        for cu in courseUnits:
+            forks.append(CourseUnit(unit=cu.unit.fork(addedBy), course=course,
+                                    order=cu.order, addedBy=addedBy))
+            if progress:
+                progress(len(forks), len(courseUnits))
+        CourseUnit.objects.bulk_create(forks)
+        return course
         
     def get_user_role(self, user, justOne=True, raiseError=True):
         'return role(s) of specified user in this course'
@@ -1164,3 +1923,78 @@ class UnitStatus(models.Model):
         except UnitLesson.DoesNotExist:
             self.done()
             return None
+
+
+#######################################
+# rendered text cache
+
+class RenderedText(models.Model):
+    'HTML rendering of a text, keyed on hash of source text + renderer options'
+    key = models.CharField(max_length=40, primary_key=True)
+    html = models.TextField()
+    atime = models.DateTimeField('time rendered', default=timezone.now)
+
+
+class LessonHTML(models.Model):
+    'pre-rendered HTML of a Lesson text, for one renderer version'
+    lesson = models.ForeignKey(Lesson)
+    rendererVersion = models.IntegerField()
+    textKey = models.CharField(max_length=40) # render_cache key of the text
+    html = models.TextField()
+    atime = models.DateTimeField('time rendered', default=timezone.now)
+    class Meta:
+        unique_together = ('lesson', 'rendererVersion')
+
+    @staticmethod
+    def render_texts(texts):
+        'get [(html, ok)] for texts, via md2html and its cache'
+        from ct.templatetags.ct_extras import md2html_checked
+        return md2html_checked(texts)
+    @classmethod
+    def store(klass, lesson, html, textKey=None):
+        'save html as the current rendering of lesson'
+        if textKey is None:
+            from ct.templatetags.ct_extras import md2html_key
+            textKey = md2html_key(lesson.text or '')
+        try:
+            with transaction.atomic(): # may race with another worker
+                klass.objects.update_or_create(
+                    lesson=lesson, rendererVersion=RENDERER_VERSION,
+                    defaults=dict(textKey=textKey, html=html,
+                                  atime=timezone.now()))
+        except IntegrityError:
+            pass
+    @classmethod
+    def render_all(klass, force=False, chunkSize=200):
+        """Pre-render all lessons missing current HTML (or all, if force),
+        deleting renderings from other renderer versions.
+        Returns (number rendered, number failed)."""
+        from ct.templatetags.ct_extras import md2html_key
+        klass.objects.exclude(rendererVersion=RENDERER_VERSION).delete()
+        current = {} if force else dict(klass.objects.filter(
+            rendererVersion=RENDERER_VERSION).values_list('lesson', 'textKey'))
+        nRendered = nFailed = 0
+        lessons = Lesson.objects.filter(isDelta=False).order_by('pk') \
+            .only('text')
+        for i in range(0, lessons.count(), chunkSize):
+            todo = []
+            for lesson in lessons[i:i + chunkSize]:
+                textKey = md2html_key(lesson.text or '')
+                if current.get(lesson.pk) != textKey:
+                    todo.append((lesson, textKey))
+            results = klass.render_texts([l.text or '' for l, k in todo])
+            for (lesson, textKey), (html, ok) in zip(todo, results):
+                if ok:
+                    klass.store(lesson, html, textKey)
+                    nRendered += 1
+                else:
+                    nFailed += 1
+        return nRendered, nFailed
+
+
+class SourceDBEntry(models.Model):
+    'cached sourceDB plugin page lookup or search result (see sourcedb_cache)'
+    key = models.CharField(max_length=40, primary_key=True)
+    sourceDB = models.CharField(max_length=32)
+    data = models.TextField() # JSON
+    expires = models.DateTimeField(db_index=True)
@@ -0,0 +1,219 @@
+"""
+Pool of long-lived pandoc converter processes.
+
+Calling ``pypandoc.convert`` spawns a fresh pandoc process (and Haskell
+runtime) per document.  Instead, each worker here runs
+``pandoc lua pandoc_worker.lua`` once and is then fed documents over its
+stdin/stdout pipes (see pandoc_worker.lua for the wire format).  Workers
+are recycled after a fixed number of conversions, and a worker that
+exceeds the per-document timeout or breaks its pipe is killed and replaced.
+
+Requires a pandoc with the ``lua`` subcommand (pandoc >= 3.0).
+"""
+import os
+import select
+import subprocess
+import threading
+import time
+import Queue
+
+from django.conf import settings
+
+
+PANDOC_PATH = getattr(settings, 'PANDOC_PATH', 'pandoc')
+
+# number of converter processes kept per web worker process
+PANDOC_POOL_SIZE = getattr(settings, 'PANDOC_POOL_SIZE', 2)
+
+# seconds allowed for converting a single document
+PANDOC_POOL_TIMEOUT = getattr(settings, 'PANDOC_POOL_TIMEOUT', 10.)
+
+# restart a converter process after this many documents
+PANDOC_POOL_MAX_DOCS = getattr(settings, 'PANDOC_POOL_MAX_DOCS', 500)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'pandoc_worker.lua')
+
+
+def pandoc_version(pandocPath=PANDOC_PATH):
+    'installed pandoc version as a tuple, e.g. (2, 19); () if none found'
+    try:
+        out = subprocess.check_output([pandocPath, '--version'])
+        return tuple(int(v) for v in out.split()[1].split('.')[:2])
+    except (OSError, subprocess.CalledProcessError, IndexError, ValueError):
+        return ()
+
+
+class PandocWorkerError(RuntimeError):
+    'conversion failed, timed out or the worker process died'
+    pass
+
+
+class PandocWorker(object):
+    """
+    One ``pandoc lua`` process fed documents over pipes.
+    """
+    def __init__(self, pandocPath=PANDOC_PATH, script=WORKER_SCRIPT):
+        try:
+            with open(os.devnull, 'w') as devnull:  # drop pandoc warnings
+                self.proc = subprocess.Popen(
+                    [pandocPath, 'lua', script], stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=devnull, close_fds=True)
+        except OSError as e:
+            raise PandocWorkerError('cannot start pandoc: %s' % e)
+        self.nDocs = 0
+        self._buf = b''
+
+    def convert(self, txt, to='html', format='rst', timeout=None):
+        'convert one document; raises PandocWorkerError on failure'
+        if isinstance(txt, unicode):
+            txt = txt.encode('utf-8')
+        try:
+            self.proc.stdin.write(b'%s %s %d\n' % (format, to, len(txt)))
+            self.proc.stdin.write(txt)
+            self.proc.stdin.flush()
+        except (IOError, OSError) as e:
+            self.close()
+            raise PandocWorkerError('pandoc worker pipe broken: %s' % e)
+        deadline = None if timeout is None else time.time() + timeout
+        header = self._read_until(b'\n', deadline)
+        status, n = header.split(b' ')
+        body = self._read_bytes(int(n), deadline)
+        self.nDocs += 1
+        if status != b'ok':
+            raise PandocWorkerError(body.decode('utf-8', 'replace'))
+        return body.decode('utf-8')
+
+    def _fill(self, deadline):
+        'read whatever output is available, enforcing the deadline'
+        fd = self.proc.stdout.fileno()
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                self.close()
+                raise PandocWorkerError('pandoc worker timed out')
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            self.close()
+            raise PandocWorkerError('pandoc worker exited')
+        self._buf += chunk
+
+    def _read_until(self, sep, deadline):
+        while sep not in self._buf:
+            self._fill(deadline)
+        line, self._buf = self._buf.split(sep, 1)
+        return line
+
+    def _read_bytes(self, n, deadline):
+        while len(self._buf) < n:
+            self._fill(deadline)
+        data, self._buf = self._buf[:n], self._buf[n:]
+        return data
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def close(self):
+        'terminate the process; safe to call repeatedly'
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        for f in (proc.stdin, proc.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+
+class PandocPool(object):
+    """
+    Fixed-size pool of PandocWorker processes, created lazily.
+
+    Thread-safe; after a fork (e.g. gunicorn pre-fork) the child discards
+    the parent's workers and starts its own.
+    """
+    def __init__(self, size=PANDOC_POOL_SIZE, timeout=PANDOC_POOL_TIMEOUT,
+                 maxDocs=PANDOC_POOL_MAX_DOCS, pandocPath=PANDOC_PATH):
+        self.size = size
+        self.timeout = timeout
+        self.maxDocs = maxDocs
+        self.pandocPath = pandocPath
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = Queue.LifoQueue()
+        self._nWorkers = 0
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():  # forked: parent's pipes not ours
+                self._reset()
+            try:
+                return self._idle.get_nowait()
+            except Queue.Empty:
+                pass
+            if self._nWorkers < self.size:
+                self._nWorkers += 1
+                newWorker = True
+            else:
+                newWorker = False
+        if not newWorker:
+            try:
+                return self._idle.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise PandocWorkerError('no pandoc worker available')
+        try:
+            return PandocWorker(self.pandocPath)
+        except PandocWorkerError:
+            self._discard()
+            raise
+
+    def _discard(self):
+        with self._lock:
+            self._nWorkers -= 1
+
+    def _release(self, worker):
+        if worker.is_alive() and worker.nDocs < self.maxDocs:
+            self._idle.put(worker)
+            return
+        worker.close()  # recycle, replacing it so waiters aren't starved
+        try:
+            self._idle.put(PandocWorker(self.pandocPath))
+        except PandocWorkerError:
+            self._discard()
+
+    def convert(self, txt, to='html', format='rst'):
+        'convert one document using an idle worker'
+        worker = self._acquire()
+        try:
+            return worker.convert(txt, to, format, self.timeout)
+        finally:
+            self._release(worker)
+
+    def close(self):
+        'terminate all idle workers'
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            worker.close()
+            self._discard()
+
+
+_pool = None
+_poolLock = threading.Lock()
+
+
+def get_pool():
+    'get the process-wide pandoc pool, creating it on first use'
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = PandocPool()
+        return _pool
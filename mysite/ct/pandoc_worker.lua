@@ -0,0 +1,39 @@
+-- Long-lived pandoc converter used by ct.pandoc_pool.
+--
+-- Run as ``pandoc lua pandoc_worker.lua``.  Each request on stdin is a
+-- header line "<format> <to> <nbytes>" followed by nbytes of source text;
+-- each reply on stdout is "ok <nbytes>" or "error <nbytes>" followed by
+-- nbytes of HTML (or of the error message).
+io.stdin:setvbuf("full")
+io.stdout:setvbuf("full")
+
+local function reply(status, body)
+  io.stdout:write(status, " ", #body, "\n", body)
+  io.stdout:flush()
+end
+
+while true do
+  local header = io.stdin:read("l")
+  if header == nil then
+    break
+  end
+  local fmt, to, n = header:match("^(%S+) (%S+) (%d+)$")
+  if fmt == nil then
+    reply("error", "bad request header: " .. header)
+    break
+  end
+  n = tonumber(n)
+  local txt = ""
+  if n > 0 then -- read(0) would block waiting for the next request
+    txt = io.stdin:read(n) or ""
+  end
+  local ok, result = pcall(function()
+    local doc = pandoc.read(txt, fmt)
+    return pandoc.write(doc, to, {html_math_method = "mathjax"}) .. "\n"
+  end)
+  if ok then
+    reply("ok", result)
+  else
+    reply("error", tostring(result))
+  end
+end
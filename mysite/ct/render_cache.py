@@ -0,0 +1,176 @@
+"""
+Content-addressed cache for lesson text rendered to HTML.
+
+Rendered HTML is keyed on a hash of the source text plus the renderer
+options.  Lookups go first to a bounded in-process LRU, then to the
+shared ``RenderedText`` table, so identical texts are converted only once
+no matter which request, worker or deploy asks for them.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils.encoding import force_bytes
+
+
+# bump this whenever the md2html pipeline output changes
+RENDERER_VERSION = 1
+
+# maximum number of rendered texts kept in each process
+MD2HTML_CACHE_SIZE = getattr(settings, 'MD2HTML_CACHE_SIZE', 2000)
+
+# also store rendered texts in the shared RenderedText table?
+MD2HTML_CACHE_DB = getattr(settings, 'MD2HTML_CACHE_DB', True)
+
+
+def make_key(txt, options=()):
+    """
+    Get hex digest identifying txt rendered with the specified options.
+    """
+    h = hashlib.sha1(force_bytes(repr((RENDERER_VERSION,) + tuple(options))))
+    h.update(b'\0')
+    h.update(force_bytes(txt))
+    return h.hexdigest()
+
+
+class LRUCache(object):
+    """
+    Thread-safe bounded mapping that evicts least recently used items.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return None
+            self._data[key] = value  # move to most recently used
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RenderCache(object):
+    """
+    Two-tier (process LRU + RenderedText table) cache of rendered texts.
+    """
+    def __init__(self, maxsize=MD2HTML_CACHE_SIZE, useDB=MD2HTML_CACHE_DB):
+        self.lru = LRUCache(maxsize)
+        self.useDB = useDB
+        self.stats = dict(hits=0, dbHits=0, misses=0)
+
+    def get_or_render(self, txt, options, renderFunc):
+        """
+        Return cached HTML for txt, else call renderFunc(txt).
+
+        renderFunc must return (html, ok); html is only stored in the
+        cache if ok is True, so a failed conversion is retried later.
+        """
+        key = make_key(txt, options)
+        html = self.lru.get(key)
+        if html is not None:
+            self.stats['hits'] += 1
+            return html
+        if self.useDB:
+            html = self._db_get(key)
+            if html is not None:
+                self.stats['dbHits'] += 1
+                self.lru.set(key, html)
+                return html
+        self.stats['misses'] += 1
+        html, ok = renderFunc(txt)
+        if ok:
+            self.lru.set(key, html)
+            if self.useDB:
+                self._db_set(key, html)
+        return html
+
+    def get_or_render_many(self, texts, options, renderManyFunc,
+                           withStatus=False):
+        """
+        Batch version of get_or_render(), returning a list of HTML
+        (or of (html, ok) if withStatus).
+
+        Misses are looked up in the RenderedText table with one query,
+        and the remaining (distinct) texts are passed together to
+        renderManyFunc(texts), which must return a list of (html, ok).
+        """
+        keys = [make_key(txt, options) for txt in texts]
+        found = {}
+        for key in keys:
+            html = self.lru.get(key)
+            if html is not None:
+                self.stats['hits'] += 1
+                found[key] = html
+        missing = set(keys) - set(found)
+        if missing and self.useDB:
+            from ct.models import RenderedText
+            for key, html in RenderedText.objects.filter(pk__in=missing) \
+              .values_list('key', 'html'):
+                self.stats['dbHits'] += 1
+                self.lru.set(key, html)
+                found[key] = html
+        toRender = OrderedDict()
+        for key, txt in zip(keys, texts):
+            if key not in found:
+                toRender[key] = txt
+        failed = set()
+        if toRender:
+            self.stats['misses'] += len(toRender)
+            results = renderManyFunc(list(toRender.values()))
+            for key, (html, ok) in zip(toRender, results):
+                found[key] = html
+                if ok:
+                    self.lru.set(key, html)
+                    if self.useDB:
+                        self._db_set(key, html)
+                else:
+                    failed.add(key)
+        if withStatus:
+            return [(found[key], key not in failed) for key in keys]
+        return [found[key] for key in keys]
+
+    def _db_get(self, key):
+        from ct.models import RenderedText
+        try:
+            return RenderedText.objects.get(pk=key).html
+        except RenderedText.DoesNotExist:
+            return None
+
+    def _db_set(self, key, html):
+        from ct.models import RenderedText
+        try:
+            with transaction.atomic():  # another worker may beat us to it
+                RenderedText.objects.create(key=key, html=html)
+        except IntegrityError:
+            pass
+
+    def clear(self, stats=True):
+        """
+        Empty the process LRU (the shared table is left alone).
+        """
+        self.lru.clear()
+        if stats:
+            for k in self.stats:
+                self.stats[k] = 0
+
+
+md2html_cache = RenderCache()
@@ -0,0 +1,220 @@
+"""
+Full-text search index for lesson titles and texts.
+
+UnitLesson.search_text() goes through the backend for the database in use:
+
+* SQLite: FTS5 virtual table ``ct_lessonsearch`` (rowid = Lesson id),
+  ranked by bm25 with titles weighted LESSON_SEARCH_TITLE_WEIGHT times
+  the text.
+* PostgreSQL: table ``ct_lessonsearch`` of weighted tsvectors with a GIN
+  index, ranked by ts_rank.
+* anything else (or SQLite built without FTS5): the old icontains scan,
+  unranked.
+
+Each search word matches any indexed word it is a prefix of, and all
+words must match.  The index is updated by Lesson save / delete signals
+and can be rebuilt from scratch by the rebuild_search_index command.
+"""
+import re
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Q
+
+
+# 'auto' (use the db's full-text index if it has one) or 'like'
+LESSON_SEARCH_BACKEND = getattr(settings, 'LESSON_SEARCH_BACKEND', 'auto')
+
+# PostgreSQL text search configuration for stemming and stop words
+LESSON_SEARCH_CONFIG = getattr(settings, 'LESSON_SEARCH_CONFIG', 'english')
+
+# how much more a title match counts than a text match (SQLite)
+LESSON_SEARCH_TITLE_WEIGHT = getattr(settings, 'LESSON_SEARCH_TITLE_WEIGHT', 10.)
+
+INDEX_TABLE = 'ct_lessonsearch'
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def get_words(s):
+    'list of search words in user query string s'
+    return WORD_RE.findall(s)
+
+
+def lesson_column(qs, lessonPath):
+    'SQL for the Lesson id column of qs, reached via field lessonPath'
+    model = qs.model
+    qn = connections[qs.db].ops.quote_name
+    if lessonPath:
+        column = model._meta.get_field(lessonPath).column
+    else: # qs is a Lesson QuerySet
+        column = model._meta.pk.column
+    return '%s.%s' % (qn(model._meta.db_table), qn(column))
+
+
+class LikeSearch(object):
+    """
+    Unindexed substring search, for databases without a full-text index.
+    """
+    name = 'like'
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def filter(self, qs, s, lessonPath='lesson'):
+        'restrict qs to rows whose lesson matches search string s'
+        prefix = lessonPath + '__' if lessonPath else ''
+        return qs.filter(Q(**{prefix + 'title__icontains': s}) |
+                         Q(**{prefix + 'text__icontains': s}))
+
+    def order_by_rank(self, qs, s, lessonPath='lesson'):
+        'order qs by relevance to s (a no-op without an index)'
+        return qs
+
+    def index(self, lessonIDs):
+        pass
+
+    def remove(self, lessonIDs):
+        pass
+
+    def rebuild(self):
+        'reindex all lessons; returns number of lessons indexed'
+        return 0
+
+
+class IndexedSearch(LikeSearch):
+    """
+    Base for searches via the INDEX_TABLE full-text index.  Subclasses
+    give SQL templates for matching, ranking and indexing, with {table}
+    and {column} (the Lesson id column of the searched QuerySet) slots.
+    """
+    match_sql = join_sql = rank_sql = insert_sql = delete_sql = None
+    rankOrder = 'searchRank'
+
+    def query_params(self, words):
+        'SQL params representing words, for match_sql and join_sql'
+        raise NotImplementedError
+
+    def rank_params(self, words):
+        'SQL params for rank_sql'
+        return self.query_params(words)
+
+    def insert_params(self):
+        'SQL params for insert_sql'
+        return []
+
+    def _sql(self, template, qs=None, lessonPath=None):
+        column = lesson_column(qs, lessonPath) if qs is not None else None
+        return template.format(table=INDEX_TABLE, column=column)
+
+    def filter(self, qs, s, lessonPath='lesson'):
+        words = get_words(s)
+        if not words:
+            return qs.none()
+        return qs.extra(where=[self._sql(self.match_sql, qs, lessonPath)],
+                        params=self.query_params(words))
+
+    def order_by_rank(self, qs, s, lessonPath='lesson'):
+        'join qs to its index entries (matching once) to order by rank'
+        words = get_words(s)
+        if not words:
+            return qs
+        return qs.extra(
+            select=dict(searchRank=self._sql(self.rank_sql)),
+            select_params=self.rank_params(words),
+            tables=[INDEX_TABLE],
+            where=[self._sql(self.join_sql, qs, lessonPath)],
+            params=self.query_params(words),
+        ).order_by(self.rankOrder, 'pk')
+
+    def index(self, lessonIDs):
+        'add or refresh the index entries of these lessons'
+        lessonIDs = list(lessonIDs)
+        if not lessonIDs:
+            return
+        self.remove(lessonIDs)
+        self.connection.cursor().execute(
+            self._sql(self.insert_sql) + ' WHERE id IN (%s)'
+            % ', '.join(['%s'] * len(lessonIDs)),
+            self.insert_params() + lessonIDs)
+
+    def remove(self, lessonIDs):
+        'drop the index entries of these lessons'
+        lessonIDs = list(lessonIDs)
+        if lessonIDs:
+            self.connection.cursor().execute(
+                self._sql(self.delete_sql) % ', '.join(['%s'] * len(lessonIDs)),
+                lessonIDs)
+
+    def rebuild(self):
+        cursor = self.connection.cursor()
+        cursor.execute(self._sql('DELETE FROM {table}'))
+        cursor.execute(self._sql(self.insert_sql), self.insert_params())
+        # old versions stored as deltas (see ct.version_store) have no text
+        cursor.execute(self._sql(self.delete_sql)
+                       % 'SELECT id FROM ct_lesson WHERE "isDelta"')
+        cursor.execute(self._sql('SELECT COUNT(*) FROM {table}'))
+        return cursor.fetchone()[0]
+
+
+class FTS5Search(IndexedSearch):
+    """
+    SQLite FTS5 index with porter stemming.
+    """
+    name = 'fts5'
+    match_sql = '{column} IN (SELECT rowid FROM {table} WHERE {table} MATCH %s)'
+    join_sql = '{table}.rowid = {column} AND {table} MATCH %s'
+    rank_sql = 'bm25({table}, %s, 1.0)'
+    insert_sql = ("INSERT INTO {table} (rowid, title, text) "
+                  "SELECT id, title, coalesce(text, '') FROM ct_lesson")
+    delete_sql = 'DELETE FROM {table} WHERE rowid IN (%s)'
+
+    def query_params(self, words):
+        return [' '.join('"%s"*' % w for w in words)]
+
+    def rank_params(self, words):
+        return [LESSON_SEARCH_TITLE_WEIGHT]
+
+
+class PostgresSearch(IndexedSearch):
+    """
+    PostgreSQL tsvector index, titles weighted A and texts B.
+    """
+    name = 'postgresql'
+    match_sql = ('{column} IN (SELECT lesson_id FROM {table} '
+                 'WHERE document @@ to_tsquery(%s::regconfig, %s))')
+    join_sql = ('{table}.lesson_id = {column} AND '
+                '{table}.document @@ to_tsquery(%s::regconfig, %s)')
+    rank_sql = 'ts_rank({table}.document, to_tsquery(%s::regconfig, %s))'
+    rankOrder = '-searchRank'
+    insert_sql = ("INSERT INTO {table} (lesson_id, document) "
+                  "SELECT id, setweight(to_tsvector(%s::regconfig, title), 'A') "
+                  "|| setweight(to_tsvector(%s::regconfig, coalesce(text, '')), 'B') "
+                  "FROM ct_lesson")
+    delete_sql = 'DELETE FROM {table} WHERE lesson_id IN (%s)'
+
+    def query_params(self, words):
+        return [LESSON_SEARCH_CONFIG, ' & '.join('%s:*' % w for w in words)]
+
+    def insert_params(self):
+        return [LESSON_SEARCH_CONFIG, LESSON_SEARCH_CONFIG]
+
+
+_backends = {}
+
+
+def get_search_backend(using=DEFAULT_DB_ALIAS):
+    'get the lesson search backend for database alias using'
+    connection = connections[using]
+    key = (using, connection.settings_dict['NAME'])
+    try:
+        return _backends[key]
+    except KeyError:
+        pass
+    klass = LikeSearch
+    if LESSON_SEARCH_BACKEND == 'auto' and \
+            INDEX_TABLE in connection.introspection.table_names():
+        klass = dict(sqlite=FTS5Search,
+                     postgresql=PostgresSearch).get(connection.vendor, LikeSearch)
+    backend = _backends[key] = klass(connection)
+    return backend
@@ -0,0 +1,259 @@
+"""
+Cache for sourceDB plugin page lookups and searches.
+
+Plugins such as ``ct/sourcedb_plugin/wikipedia_plugin`` fetch over the
+network on every call.  Lesson.get_sourceDB_plugin() therefore hands out
+a CachedSourceDB instead of the plugin's LessonDoc class.  It has the
+same interface, but answers from a bounded in-process LRU and then from
+the shared ``SourceDBEntry`` table, calling the plugin only on a miss:
+
+* page data is kept SOURCEDB_CACHE_TTL seconds, and search results
+  SOURCEDB_CACHE_SEARCH_TTL seconds;
+* "no such page" answers (the plugin raising KeyError, e.g. for a
+  Wikipedia PageError or DisambiguationError) are kept
+  SOURCEDB_CACHE_NEGATIVE_TTL seconds, so repeated bad lookups stay cheap;
+* concurrent misses for the same key in one process wait for a single
+  plugin call instead of each making their own.
+
+Other plugin errors (e.g. network failures) are not cached.
+"""
+import hashlib
+import json
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+
+from ct.render_cache import LRUCache
+
+
+# seconds to keep page data
+SOURCEDB_CACHE_TTL = getattr(settings, 'SOURCEDB_CACHE_TTL', 7 * 86400)
+
+# seconds to keep search results
+SOURCEDB_CACHE_SEARCH_TTL = getattr(settings, 'SOURCEDB_CACHE_SEARCH_TTL', 86400)
+
+# seconds to remember that a page does not exist
+SOURCEDB_CACHE_NEGATIVE_TTL = getattr(settings, 'SOURCEDB_CACHE_NEGATIVE_TTL', 3600)
+
+# maximum number of lookups kept in each process
+SOURCEDB_CACHE_SIZE = getattr(settings, 'SOURCEDB_CACHE_SIZE', 2000)
+
+# also store lookups in the shared SourceDBEntry table?
+SOURCEDB_CACHE_DB = getattr(settings, 'SOURCEDB_CACHE_DB', True)
+
+# seconds to wait for another thread's lookup of the same key
+SOURCEDB_CACHE_WAIT = getattr(settings, 'SOURCEDB_CACHE_WAIT', 30.)
+
+# plugin to use for each sourceDB name, e.g. {'wikipedia': 'localfile'}
+# to serve Wikipedia lookups from a local file with no network
+SOURCEDB_PLUGINS = getattr(settings, 'SOURCEDB_PLUGINS', {})
+
+
+def make_key(sourceDB, *args):
+    'get hex digest identifying a lookup of args from sourceDB'
+    return hashlib.sha1(force_bytes(json.dumps([sourceDB] + list(args)))) \
+        .hexdigest()
+
+
+class SourceDBDoc(object):
+    """
+    Cached copy of the data of a plugin LessonDoc.
+    """
+    attrs = ('sourceDB', 'sourceID', 'title', 'description', 'url')
+
+    def __init__(self, **kwargs):
+        for attr in self.attrs:
+            setattr(self, attr, kwargs.get(attr))
+
+    @classmethod
+    def from_doc(klass, doc):
+        return klass(**dict((attr, getattr(doc, attr, None))
+                            for attr in klass.attrs))
+
+    def to_dict(self):
+        return dict((attr, getattr(self, attr)) for attr in self.attrs)
+
+
+class PendingLookup(object):
+    'a plugin call in progress, for other threads to wait on'
+    def __init__(self):
+        self.done = threading.Event()
+        self.entry = None
+
+
+class CachedSourceDB(object):
+    """
+    Caching stand-in for a sourceDB plugin's LessonDoc class:
+    call it with a sourceID to get a SourceDBDoc, or call search().
+    """
+    def __init__(self, sourceDB, plugin, lru=None, useDB=SOURCEDB_CACHE_DB,
+                 ttl=SOURCEDB_CACHE_TTL, searchTTL=SOURCEDB_CACHE_SEARCH_TTL,
+                 negativeTTL=SOURCEDB_CACHE_NEGATIVE_TTL):
+        self.sourceDB = sourceDB
+        self.plugin = plugin
+        self.lru = lru if lru is not None else LRUCache(SOURCEDB_CACHE_SIZE)
+        self.useDB = useDB
+        self.ttl = ttl
+        self.searchTTL = searchTTL
+        self.negativeTTL = negativeTTL
+        self.stats = dict(hits=0, dbHits=0, misses=0, coalesced=0)
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> PendingLookup
+
+    def __call__(self, sourceID):
+        'get SourceDBDoc for sourceID; raises KeyError if no such page'
+        data = self.lookup(make_key(self.sourceDB, 'page', sourceID),
+                           lambda: SourceDBDoc.from_doc(
+                               self.plugin(sourceID)).to_dict(),
+                           self.ttl)
+        return SourceDBDoc(**data)
+
+    def search(self, query, max_results=10):
+        'return list of [(title, sourceID, url)]'
+        results = self.lookup(
+            make_key(self.sourceDB, 'search', query, max_results),
+            lambda: self.fetch_search(query, max_results), self.searchTTL)
+        return [tuple(t) for t in results]
+
+    def get_search(self, query, max_results=10):
+        'get cached search results, or None if not cached'
+        entry = self._get(make_key(self.sourceDB, 'search', query, max_results))
+        if entry is not None:
+            return [tuple(t) for t in entry['value']]
+
+    def fetch_search(self, query, max_results=10):
+        '''search with the plugin, bypassing the cache; this does not use
+        the db, so is safe to call from any thread'''
+        return [list(t) for t in self.plugin.search(query, max_results)]
+
+    def set_search(self, query, max_results, results):
+        'cache results of fetch_search()'
+        self.stats['misses'] += 1
+        self._store(make_key(self.sourceDB, 'search', query, max_results),
+                    dict(value=[list(t) for t in results]), self.searchTTL)
+
+    def lookup(self, key, fetch, ttl):
+        '''get cached value for key, else fetch() it; a KeyError from
+        fetch() is cached too, and re-raised for every lookup'''
+        entry = self._get(key)
+        if entry is None:
+            entry = self._fetch_once(key, fetch, ttl)
+        if 'error' in entry:
+            raise KeyError(entry['error'])
+        return entry['value']
+
+    def _get(self, key):
+        now = timezone.now()
+        entry = self.lru.get(key)
+        if entry is not None and entry['expires'] > now:
+            self.stats['hits'] += 1
+            return entry
+        if self.useDB:
+            entry = self._db_get(key, now)
+            if entry is not None:
+                self.stats['dbHits'] += 1
+                self.lru.set(key, entry)
+                return entry
+        return None
+
+    def _fetch_once(self, key, fetch, ttl):
+        'fetch key, or wait for the thread already fetching it'
+        with self._lock:
+            pending = self._pending.get(key)
+            isFetcher = pending is None
+            if isFetcher:
+                pending = self._pending[key] = PendingLookup()
+        if not isFetcher:
+            pending.done.wait(SOURCEDB_CACHE_WAIT)
+            if pending.entry is not None:
+                self.stats['coalesced'] += 1
+                return pending.entry
+            # the other thread failed or is too slow: try ourselves
+            return self._fetch(key, fetch, ttl)
+        try:
+            pending.entry = self._fetch(key, fetch, ttl)
+            return pending.entry
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.done.set()
+
+    def _fetch(self, key, fetch, ttl):
+        self.stats['misses'] += 1
+        try:
+            entry = dict(value=fetch())
+        except KeyError as e:
+            entry = dict(error=e.args[0] if e.args else '')
+            ttl = self.negativeTTL
+        return self._store(key, entry, ttl)
+
+    def _store(self, key, entry, ttl):
+        entry['expires'] = timezone.now() + timedelta(seconds=ttl)
+        self.lru.set(key, entry)
+        if self.useDB:
+            self._db_set(key, entry)
+        return entry
+
+    def _db_get(self, key, now):
+        from ct.models import SourceDBEntry
+        try:
+            row = SourceDBEntry.objects.get(pk=key, expires__gt=now)
+        except SourceDBEntry.DoesNotExist:
+            return None
+        entry = json.loads(row.data)
+        entry['expires'] = row.expires
+        return entry
+
+    def _db_set(self, key, entry):
+        from ct.models import SourceDBEntry
+        data = json.dumps(dict((k, v) for k, v in entry.items()
+                               if k != 'expires'))
+        kwargs = dict(sourceDB=self.sourceDB, data=data,
+                      expires=entry['expires'])
+        if SourceDBEntry.objects.filter(pk=key).update(**kwargs):
+            return
+        try:
+            with transaction.atomic():  # another worker may beat us to it
+                SourceDBEntry.objects.create(key=key, **kwargs)
+        except IntegrityError:
+            pass
+
+    def clear(self, stats=True):
+        """
+        Empty the process LRU (the shared table is left alone).
+        """
+        self.lru.clear()
+        if stats:
+            for k in self.stats:
+                self.stats[k] = 0
+
+
+_cachedSourceDBs = {}
+_lock = threading.Lock()
+
+
+def get_cached_sourceDB(sourceDB):
+    'get the CachedSourceDB for the named sourceDB'
+    try:
+        return _cachedSourceDBs[sourceDB]
+    except KeyError:
+        pass
+    from fsm.registry import plugin_registry
+    plugin = plugin_registry.get_sourceDB_plugin(
+        SOURCEDB_PLUGINS.get(sourceDB, sourceDB))
+    with _lock:
+        return _cachedSourceDBs.setdefault(sourceDB,
+                                           CachedSourceDB(sourceDB, plugin))
+
+
+def purge_expired():
+    'delete expired SourceDBEntry rows; returns the number deleted'
+    from ct.models import SourceDBEntry
+    expired = SourceDBEntry.objects.filter(expires__lte=timezone.now())
+    n = expired.count()
+    expired.delete()
+    return n
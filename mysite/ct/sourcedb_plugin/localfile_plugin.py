@@ -0,0 +1,84 @@
+"""
+Offline stand-in for the Wikipedia sourceDB plugin.
+
+Pages come from the JSON file SOURCEDB_LOCALFILE, a list of
+{"title": ..., "summary": ..., "url": ...} objects, so that concept
+search and lookup can be tested and benchmarked with no network.  Set
+SOURCEDB_PLUGINS = {'wikipedia': 'localfile'} to serve Wikipedia
+lookups from it.
+"""
+import json
+import os
+import re
+import threading
+
+from django.conf import settings
+
+
+# JSON file of pages to serve
+SOURCEDB_LOCALFILE = getattr(settings, 'SOURCEDB_LOCALFILE',
+                             os.path.join(os.path.dirname(__file__),
+                                          'localfile.json'))
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class PageFile(object):
+    """
+    Pages of one JSON file, with a word index of their titles.
+    """
+    def __init__(self, path):
+        with open(path) as ifile:
+            pages = json.load(ifile)
+        self.pages = dict((page['title'], page) for page in pages)
+        self.words = {}
+        for title in self.pages:
+            for word in set(WORD_RE.findall(title.lower())):
+                self.words.setdefault(word, set()).add(title)
+
+    def search(self, query, max_results):
+        'titles containing every word of query, exact title matches first'
+        words = WORD_RE.findall(query.lower())
+        if not words:
+            return []
+        titles = set(self.words.get(words[0], ()))
+        for word in words[1:]:
+            titles &= self.words.get(word, set())
+        query = query.lower().strip()
+        return sorted(titles, key=lambda t: (t.lower() != query, len(t), t)) \
+            [:max_results]
+
+
+_pageFiles = {}
+_lock = threading.Lock()
+
+
+def get_page_file(path=None):
+    'get the (cached) PageFile for path, by default SOURCEDB_LOCALFILE'
+    path = path or SOURCEDB_LOCALFILE
+    with _lock:
+        try:
+            return _pageFiles[path]
+        except KeyError:
+            pageFile = _pageFiles[path] = PageFile(path)
+            return pageFile
+
+
+class LessonDoc(object):
+    sourceDB = 'localfile'
+    def __init__(self, sourceID):
+        try:
+            self._data = get_page_file().pages[sourceID]
+        except KeyError:
+            raise KeyError('Page id "%s" does not match any pages.' % sourceID)
+        self.sourceID = sourceID
+        self.title = sourceID
+        self.description = self._data['summary']
+        self.url = self._data['url']
+
+    @classmethod
+    def search(klass, query, max_results=10):
+        'return list of [(title, sourceID, url)]'
+        pageFile = get_page_file()
+        return [(s, s, pageFile.pages[s]['url'])
+                for s in pageFile.search(query, max_results)]
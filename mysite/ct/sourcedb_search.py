@@ -0,0 +1,169 @@
+"""
+Concurrent (federated) searches of external sourceDBs, with per-source
+timeouts.
+
+SourceDBSearch starts the plugin searches for a query on a bounded
+per-process thread pool and returns at once, so the caller can run its
+local database search meanwhile.  iter_results() then yields each
+source's results as soon as they arrive, giving up on a source
+SOURCEDB_SEARCH_TIMEOUTS[sourceDB] seconds after the start.  A source
+that is too slow or fails just contributes no results, so the page shows
+whatever the other sources found.  iter_merged() streams the results of
+all sources, deduplicated by normalized title.
+
+Only plugin calls run in the pool: cache lookups and stores happen in
+the calling thread (see CachedSourceDB.get_search() / set_search()), so
+pool threads never open db connections.
+"""
+import logging
+import os
+import Queue
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from ct.sourcedb_cache import get_cached_sourceDB
+
+
+# number of external searches run at once by each process
+SOURCEDB_SEARCH_THREADS = getattr(settings, 'SOURCEDB_SEARCH_THREADS', 4)
+
+# seconds to wait for a sourceDB's search results
+SOURCEDB_SEARCH_TIMEOUT = getattr(settings, 'SOURCEDB_SEARCH_TIMEOUT', 3.)
+
+# per-sourceDB overrides of SOURCEDB_SEARCH_TIMEOUT
+SOURCEDB_SEARCH_TIMEOUTS = getattr(settings, 'SOURCEDB_SEARCH_TIMEOUTS', {})
+
+# sourceDBs searched by default
+SOURCEDB_SEARCH_SOURCES = getattr(settings, 'SOURCEDB_SEARCH_SOURCES',
+                                  ('wikipedia',))
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+LOGGER = logging.getLogger(__name__)
+
+_pool = None
+_poolPID = None
+_lock = threading.Lock()
+
+
+def get_pool():
+    'get this process\'s search thread pool (a fresh one after fork)'
+    global _pool, _poolPID
+    with _lock:
+        if _poolPID != os.getpid():
+            _pool = ThreadPool(SOURCEDB_SEARCH_THREADS)
+            _poolPID = os.getpid()
+        return _pool
+
+
+def get_timeout(sourceDB):
+    return SOURCEDB_SEARCH_TIMEOUTS.get(sourceDB, SOURCEDB_SEARCH_TIMEOUT)
+
+
+def normalize_title(title):
+    'key identifying the same topic across sources, e.g. "new york city"'
+    return ' '.join(WORD_RE.findall(title.lower().replace('_', ' ')))
+
+
+def run_search(cached, query, max_results, done):
+    'pool task: search one sourceDB, and report to done queue'
+    try:
+        done.put((cached.sourceDB, cached.fetch_search(query, max_results),
+                  None))
+    except Exception as e:
+        done.put((cached.sourceDB, None, e))
+
+
+class SourceDBSearch(object):
+    """
+    Searches of several sourceDBs for one query, running in the pool.
+    """
+    def __init__(self, query, sourceDBs=SOURCEDB_SEARCH_SOURCES,
+                 max_results=10, timeout=None):
+        self.query = query
+        self.sourceDBs = list(sourceDBs)
+        self.max_results = max_results
+        self.startTime = time.time()
+        self.timedOut = []  # sourceDBs that were too slow
+        self.failed = []  # sourceDBs whose search raised an error
+        self._cached = {}  # sourceDB -> cached results
+        self._deadlines = {}  # sourceDB -> time to give up, if searching
+        self._done = Queue.Queue()
+        self._timer = None
+        for sourceDB in self.sourceDBs:
+            cached = get_cached_sourceDB(sourceDB)
+            results = cached.get_search(query, max_results)
+            if results is not None:
+                self._cached[sourceDB] = results
+                continue
+            self._deadlines[sourceDB] = self.startTime + \
+                (timeout if timeout is not None else get_timeout(sourceDB))
+            get_pool().apply_async(run_search,
+                                   (cached, query, max_results, self._done))
+
+    def iter_results(self):
+        '''generate (sourceDB, [(title, sourceID, url)]) for each source
+        that answers in time, in order of arrival'''
+        for sourceDB in self.sourceDBs:
+            if sourceDB in self._cached:
+                yield sourceDB, self._cached[sourceDB]
+        try:
+            for t in self._iter_fetched():
+                yield t
+        finally:
+            if self._timer:
+                self._timer.cancel()
+
+    def _iter_fetched(self):
+        # Queue.get(timeout) polls every 50 ms in Python 2, so instead
+        # block on get() and have a timer thread put None at the deadline
+        while self._deadlines:
+            deadline = min(self._deadlines.values())
+            if not self._timer or self._timer.deadline != deadline:
+                if self._timer:
+                    self._timer.cancel()
+                self._timer = threading.Timer(
+                    max(deadline - time.time(), 0), self._done.put, (None,))
+                self._timer.daemon = True
+                self._timer.deadline = deadline
+                self._timer.start()
+            item = self._done.get()
+            if item is None: # a deadline passed
+                now = time.time()
+                for sourceDB, deadline in self._deadlines.items():
+                    if deadline <= now:
+                        LOGGER.warning('%s search for %r timed out', sourceDB,
+                                       self.query)
+                        self.timedOut.append(sourceDB)
+                        del self._deadlines[sourceDB]
+                continue
+            sourceDB, results, error = item
+            if self._deadlines.pop(sourceDB, None) is None:
+                continue # reported after we gave up on it
+            if error is not None:
+                LOGGER.error('%s search for %r failed: %s', sourceDB,
+                             self.query, error)
+                self.failed.append(sourceDB)
+                continue
+            get_cached_sourceDB(sourceDB).set_search(
+                self.query, self.max_results, results)
+            yield sourceDB, [tuple(t) for t in results]
+
+    def results(self):
+        'get {sourceDB: [(title, sourceID, url)]} of sources that answered'
+        return dict(self.iter_results())
+
+    def iter_merged(self):
+        '''generate (sourceDB, title, sourceID, url) from all sources as
+        they arrive, skipping titles already given by another source'''
+        seen = set()
+        for sourceDB, results in self.iter_results():
+            for title, sourceID, url in results:
+                key = normalize_title(title)
+                if key not in seen:
+                    seen.add(key)
+                    yield sourceDB, title, sourceID, url
@@ -1,34 +1,201 @@
 from django.utils.safestring import mark_safe
 #from markdown import markdown
 from django import template
+import logging
 import re
+import uuid
 import pypandoc
 from django.contrib.staticfiles.templatetags import staticfiles
 from django.utils import timezone
+from django.conf import settings
 from datetime import timedelta
 
+from ct.render_cache import md2html_cache, make_key
+from ct import pandoc_pool, fastrst
+
 register = template.Library()
 
 InlineMathPat = re.compile(r'\\\((.+?)\\\)', flags=re.DOTALL)
 DisplayMathPat = re.compile(r'\\\[(.+?)\\\]', flags=re.DOTALL)
 StaticImagePat = re.compile(r'STATICIMAGE/([^"]+)')
 
+PANDOC_ARGS = ('--mathjax',)
+
+# 'pypandoc' (one pandoc process per document) or 'pool' (ct.pandoc_pool)
+MD2HTML_BACKEND = getattr(settings, 'MD2HTML_BACKEND', 'pypandoc')
+
+# render simple texts in Python (ct.fastrst) instead of running pandoc?
+# Only done if the installed pandoc is >= 2, whose HTML ct.fastrst matches.
+MD2HTML_FASTPATH = getattr(settings, 'MD2HTML_FASTPATH', True)
+
+# max number of texts md2html_many() sends to pandoc in one run
+MD2HTML_BATCH_SIZE = getattr(settings, 'MD2HTML_BATCH_SIZE', 50)
+
+# RST constructs whose meaning can depend on the rest of the document
+# (section titles, targets, footnotes, citations, substitutions, named
+# references), so texts containing them are never converted together
+UnbatchablePat = re.compile(r'^([!-/:-@[-`{-~])\1+\s*$|^\.\. [_[|]|`_|\]_|__',
+                            flags=re.MULTILINE)
+
+LOGGER = logging.getLogger(__name__)
+
+_fastPathOK = None  # does the installed pandoc match ct.fastrst's HTML?
+
 @register.filter(name='md2html')
 def md2html(txt, stripP=False):
     'converst ReST to HTML using pandoc, w/ audio support'
-    txt, markers = add_temporary_markers(txt, find_audio)
-    txt, videoMarkers = add_temporary_markers(txt, find_video, len(markers))
+    txt = md2html_cache.get_or_render(txt, md2html_options(), render_rst)
+    return strip_p(txt, stripP)
+
+def strip_p(txt, stripP):
+    if stripP and txt.startswith('<p>') and txt.endswith('</p>'):
+        txt = txt[3:-4]
+    return mark_safe(txt)
+
+def md2html_options():
+    'renderer options that md2html output depends on, for cache keys'
+    return ('rst', 'html') + PANDOC_ARGS + (staticfiles.static('ct'),)
+
+def md2html_key(txt):
+    'cache key identifying md2html output for txt'
+    return make_key(txt, md2html_options())
+
+def md2html_many(texts, stripP=False):
+    'md2html for a list of texts, converting cache misses in batches'
+    htmls = md2html_cache.get_or_render_many(list(texts), md2html_options(),
+                                             render_rst_many)
+    return [strip_p(txt, stripP) for txt in htmls]
+
+def md2html_checked(texts):
+    'like md2html_many() but returns [(html, ok)], so failures can be skipped'
+    return [(mark_safe(html), ok) for html, ok in
+            md2html_cache.get_or_render_many(list(texts), md2html_options(),
+                                             render_rst_many, withStatus=True)]
+
+@register.simple_tag(name='md2html_prerender')
+def md2html_prerender(objects, path='text'):
+    """
+    Batch-convert the text at path on each of objects, so that later
+    md2html filters on the same texts hit the cache, e.g.
+    {% md2html_prerender errorCounts '0.description' %}
+    """
+    texts = []
+    for o in objects:
+        try:
+            txt = template.Variable('o.' + path).resolve(dict(o=o))
+        except template.VariableDoesNotExist:
+            continue
+        if txt:
+            texts.append(txt)
+    md2html_many(texts)
+    return ''
+
+def render_rst(txt):
+    'uncached ReST to HTML conversion; returns (html, ok)'
+    result = render_rst_fast(txt)
+    if result:
+        return result
+    txt, markers, videoMarkers = add_media_markers(txt)
+    ok = True
     try:
-        txt = pypandoc.convert(txt, 'html', format='rst',
-                               extra_args=('--mathjax',))
+        txt = convert_rst(txt)
     except StandardError:
-        pass
+        ok = False
+    return replace_media_markers(txt, markers, videoMarkers), ok
+
+def render_rst_fast(txt):
+    'pandoc-free conversion; returns (html, True), or None if not eligible'
+    if not MD2HTML_FASTPATH or not fast_path_ok():
+        return None
+    txt, markers, videoMarkers = add_media_markers(txt)
+    html = fastrst.render(txt)
+    if html is None:
+        return None
+    return replace_media_markers(html, markers, videoMarkers), True
+
+def fast_path_ok():
+    '''check once whether pandoc is >= 2, as ct.fastrst output would
+    otherwise differ from pandoc's for the texts it cannot render'''
+    global _fastPathOK
+    if _fastPathOK is None:
+        version = pandoc_pool.pandoc_version()
+        _fastPathOK = version >= (2,)
+        if not _fastPathOK:
+            LOGGER.warning('md2html fast path off: needs pandoc >= 2, found %s',
+                           '.'.join(str(v) for v in version) or 'none')
+    return _fastPathOK
+
+def render_rst_many(texts):
+    """
+    Uncached conversion of a list of texts; returns list of (html, ok).
+
+    Batchable texts are joined with unique separator paragraphs and
+    converted by one pandoc run, then split apart again; any batch whose
+    separators don't all come back intact is converted text by text.
+    """
+    results = [None] * len(texts)
+    batch = []
+    for i, txt in enumerate(texts):
+        results[i] = render_rst_fast(txt)
+        if results[i]:
+            continue
+        if is_batchable(txt):
+            batch.append(i)
+        else:
+            results[i] = render_rst(txt)
+    for j in range(0, len(batch), MD2HTML_BATCH_SIZE):
+        chunk = batch[j:j + MD2HTML_BATCH_SIZE]
+        if len(chunk) == 1:
+            results[chunk[0]] = render_rst(texts[chunk[0]])
+            continue
+        htmls = convert_rst_batch([texts[i] for i in chunk])
+        for i, html in zip(chunk, htmls):
+            results[i] = (html, True) if html is not None \
+                else render_rst(texts[i])
+    return results
+
+def is_batchable(txt):
+    'can txt be converted as part of a larger document without changes?'
+    return bool(txt.strip()) and not txt.lstrip().startswith(':') \
+        and not UnbatchablePat.search(txt)
+
+def convert_rst_batch(texts):
+    """
+    Convert texts with one pandoc run; returns list of html, or a list of
+    None if the run failed or the output could not be split reliably.
+    """
+    sep = 'md2htmlsep%s' % uuid.uuid4().hex
+    docs = []
+    for txt in texts:  # markers are numbered per text, as in render_rst()
+        docs.append(add_media_markers(txt))
+    joined = ('\n\n%s\n\n' % sep).join(txt for txt, m, vm in docs)
+    try:
+        html = convert_rst(joined)
+    except StandardError:
+        return [None] * len(texts)
+    parts = html.split('<p>%s</p>\n' % sep)
+    if len(parts) != len(texts) or any(sep in part for part in parts):
+        return [None] * len(texts)
+    return [replace_media_markers(part, markers, videoMarkers)
+            for part, (txt, markers, videoMarkers) in zip(parts, docs)]
+
+def add_media_markers(txt):
+    'replace audio/video directives by markers that pandoc passes through'
+    txt, markers = add_temporary_markers(txt, find_audio)
+    txt, videoMarkers = add_temporary_markers(txt, find_video, len(markers))
+    return txt, markers, videoMarkers
+
+def replace_media_markers(txt, markers, videoMarkers):
+    'substitute audio/video HTML for markers in pandoc output'
     txt = replace_temporary_markers(txt, audio_html, markers)
     txt = replace_temporary_markers(txt, video_html, videoMarkers)
-    txt = StaticImagePat.sub(staticfiles.static('ct') + '/' + r'\1', txt)
-    if stripP and txt.startswith('<p>') and txt.endswith('</p>'):
-        txt = txt[3:-4]
-    return mark_safe(txt)
+    return StaticImagePat.sub(staticfiles.static('ct') + '/' + r'\1', txt)
+
+def convert_rst(txt, backend=None):
+    'run pandoc on txt using the configured backend'
+    if (backend or MD2HTML_BACKEND) == 'pool':
+        return pandoc_pool.get_pool().convert(txt, 'html', format='rst')
+    return pypandoc.convert(txt, 'html', format='rst', extra_args=PANDOC_ARGS)
 
 def nolongerused():
     'convert markdown to html, preserving latex delimiters'
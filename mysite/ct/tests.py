@@ -7,11 +7,17 @@ Replace this with more appropriate tests for your application.
 
 from django.contrib.auth.models import User
 from django.test import TestCase
+from django.core.management import call_command
+from django.conf import settings
 from ct.models import *
 from fsm.models import *
 from ct import views, ct_util
 import time
+import unittest
+import os
 import urllib
+import json
+from StringIO import StringIO
 
 
 class OurTestCase(TestCase):
@@ -230,6 +236,132 @@ class LessonMethodTests(TestCase):
                          self.ul.lesson.concept)
         self.assertTrue(ul2b.lesson.is_committed())
 
+    def test_version_tree(self):
+        'check closure table, tree heads and diffs kept by checkin'
+        root = Lesson(title='foo', text='a\nb', addedBy=self.user,
+                      commitTime=timezone.now())
+        root.save_root()
+        v2 = root.checkout(self.user)
+        v2.text = 'a\nc'
+        v2.checkin(commit=True)
+        v3 = v2.checkout(self.user)
+        v3.text = 'a\nc\nd'
+        v3.save() # save without closure, as if made before it existed
+        branch = Lesson(parent=v3, addedBy=self.user, **v3._clone_dict())
+        branch.checkin(commit=False) # adds v3 to closure too
+        self.assertEqual(root.get_head(), v2)
+        v3.checkin(commit=True)
+        with self.assertNumQueries(1):
+            self.assertEqual(list(branch.get_history()),
+                             [branch, v3, v2, root])
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(l.pk for l in root.get_descendants()),
+                             [v2.pk, v3.pk, branch.pk])
+        with self.assertNumQueries(1):
+            self.assertEqual(root.get_head(), v3) # branch not committed
+        self.assertEqual(list(Lesson.get_heads([root.treeID, 0])), [v3])
+        with self.assertNumQueries(1):
+            changes = v3.get_changes(since=root)
+        self.assertEqual([l for l, diff in changes], [v2, v3])
+        self.assertIn('+c', changes[0][1])
+        self.assertIn('-b', changes[0][1])
+        self.assertEqual(changes[1][1][-1], '+d')
+        self.assertEqual(root.get_changes()[0][1][2:],
+                         ['@@ -0,0 +1,2 @@', '+a', '+b'])
+        rows = set(LessonClosure.objects.values_list('ancestor', 'descendant',
+                                                     'depth'))
+        call_command('rebuild_lesson_trees', stdout=StringIO())
+        self.assertEqual(set(LessonClosure.objects.values_list(
+            'ancestor', 'descendant', 'depth')), rows)
+        self.assertEqual(root.get_head(), v3)
+
+    def test_fork(self):
+        'check bulk fork of a course and its unit, in constant queries'
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        emUL = Lesson(title='oops', text='x', addedBy=self.user) \
+            .save_as_error_model(self.ul.lesson.concept, self.ul)
+        emUL.save_resolution(Lesson(title='fix', text='y', addedBy=self.user))
+        course = Course.objects.create(title='Course', description='',
+                                       addedBy=self.user)
+        course.courseunit_set.create(unit=self.ul.unit, order=0,
+                                     addedBy=self.user)
+        def tree(unit):
+            'set of (lesson, kind, order, parent lesson) of unit'
+            return set((ul.lesson_id, ul.kind, ul.order,
+                        ul.parent and ul.parent.lesson_id)
+                       for ul in unit.unitlesson_set.all())
+        self.assertFalse(self.ul.lesson.is_committed())
+        calls = []
+        fork = course.fork(self.user, progress=lambda *a: calls.append(a))
+        unit = fork.courseunit_set.get().unit
+        self.assertEqual(tree(unit), tree(self.ul.unit))
+        self.assertEqual(len(tree(unit)), 5) # Q, answer, concept, em, fix
+        self.assertEqual(calls, [(1, 1)])
+        self.assertEqual(fork.get_user_role(self.user), Role.INSTRUCTOR)
+        lesson = Lesson.objects.get(pk=self.ul.lesson.pk)
+        self.assertEqual(lesson.changeLog, 'snapshot for fork by jacob')
+        self.assertEqual(lesson.get_head(), lesson)
+        with CaptureQueriesContext(connection) as queries:
+            course.fork(self.user) # now with nothing to snapshot
+        for i in range(5): # forking a bigger unit takes no more queries
+            create_question_unit(self.user).copy(self.ul.unit, self.user)
+        Lesson.commit_all(Lesson.objects.filter(commitTime__isnull=True),
+                          'test')
+        with CaptureQueriesContext(connection) as queries2:
+            course.fork(self.user)
+        self.assertEqual(len(queries2), len(queries))
+        from mock import patch
+        bulk_create = UnitLesson.objects.bulk_create
+        with patch.object(UnitLesson.objects, 'bulk_create', # pks reversed
+                          lambda objs: bulk_create(objs[::-1])):
+            fork = course.fork(self.user)
+        self.assertEqual(tree(fork.courseunit_set.get().unit),
+                         tree(self.ul.unit))
+
+    def test_delta_history(self):
+        'check old versions stored as deltas and rebuilt on demand'
+        lines = ['line %d of a long lesson text\n' % i for i in range(30)]
+        versions = [Lesson(title='foo', text=''.join(lines), data='{}',
+                           addedBy=self.user, commitTime=timezone.now())]
+        versions[0].save_root()
+        for i in range(5): # depths 1 to 5
+            lesson = versions[-1].checkout(self.user)
+            lines[i * 5] = 'edit %d\n' % i
+            lesson.text = ''.join(lines)
+            lesson.checkin(commit=True)
+            versions.append(lesson)
+        UnitLesson.create_from_lesson(versions[1], self.unit2) # in use
+        concept = Concept.objects.create(title='bar', addedBy=self.user)
+        ConceptLink.objects.create(concept=concept, lesson=versions[2],
+                                   addedBy=self.user) # shown on concept page
+        changes = versions[5].get_changes()
+        self.assertEqual(LessonDelta.compress_all(keyframeInterval=3), 1)
+        self.assertEqual([l.pk for l in Lesson.objects.filter(isDelta=True)],
+                         [versions[4].pk]) # 3 is keyframe
+        lesson = Lesson.objects.get(pk=versions[4].pk)
+        self.assertEqual((lesson.text, lesson.data), (None, None))
+        with self.assertNumQueries(1):
+            lesson.load_text()
+        self.assertEqual((lesson.text, lesson.data),
+                         (versions[4].text, '{}'))
+        self.assertEqual(Lesson.objects.get(pk=versions[2].pk).load_text()
+                         .text, versions[2].text)
+        with self.assertNumQueries(1):
+            self.assertEqual(versions[5].get_changes(), changes)
+        self.assertEqual(LessonDelta.compress_all(keyframeInterval=3), 0)
+        ConceptLink.objects.create(concept=concept, lesson=versions[4],
+                                   addedBy=self.user) # linked after compress
+        self.assertEqual(LessonDelta.compress_all(keyframeInterval=3), 0)
+        lesson = Lesson.objects.get(pk=versions[4].pk)
+        self.assertEqual((lesson.isDelta, lesson.text),
+                         (False, versions[4].text))
+        self.assertFalse(LessonDelta.objects.filter(lesson=lesson).exists())
+        out = StringIO()
+        call_command('compress_lesson_history', keyframe_interval=3, scans=1,
+                     stdout=out)
+        self.assertIn('compressed 0 of', out.getvalue())
+
 
 class FakeRequest(object):
     'trivial holder for request data to pass to test calls'
@@ -259,6 +391,389 @@ def create_question_unit(user, utitle='Ask Me some questions',
     return ul
 
 
+class StudentTasksTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', password='pw')
+        self.course = Course.objects.create(title='Great Course',
+                                            addedBy=self.user)
+        self.ulQ = create_question_unit(self.user)
+        self.unit = self.ulQ.unit
+        self.uls = [self.ulQ]
+        for i in range(4):
+            lesson = Lesson(title='Q%d' % i, text='?',
+                            kind=Lesson.ORCT_QUESTION, addedBy=self.user)
+            lesson.save_root()
+            self.uls.append(UnitLesson.create_from_lesson(lesson, self.unit))
+        emLesson = Lesson.objects.create(title='an error', text='oops',
+                                         kind=Lesson.ERROR_MODEL,
+                                         addedBy=self.user, treeID=0)
+        self.em = UnitLesson.objects.create(
+            unit=self.unit, lesson=emLesson, kind=UnitLesson.MISUNDERSTANDS,
+            parent=self.ulQ, addedBy=self.user, treeID=0)
+        def respond(ul, selfeval=None, status=None, errorStatus=None):
+            r = Response.objects.create(
+                lesson=ul.lesson, unitLesson=ul, course=self.course,
+                text='foo', confidence=Response.SURE, author=self.user,
+                selfeval=selfeval, status=status)
+            if errorStatus:
+                r.studenterror_set.create(errorModel=self.em, author=self.user,
+                                          status=errorStatus)
+            return r
+        respond(self.uls[1])
+        respond(self.uls[2], Response.DIFFERENT, NEED_HELP_STATUS)
+        respond(self.uls[3], Response.DIFFERENT, NEED_HELP_STATUS,
+                NEED_REVIEW_STATUS)
+        respond(self.ulQ, Response.CORRECT, DONE_STATUS)
+        respond(self.ulQ, Response.DIFFERENT, NEED_HELP_STATUS, NEED_HELP_STATUS)
+        respond(self.ulQ)
+
+    def test_task_table(self):
+        'check unit tasks match the per-task queries, in three queries'
+        user = self.user
+        expected = [(ul, task) for task, uls in (
+            ('start', self.unit.get_unanswered_uls(user)),
+            ('selfeval', self.unit.get_selfeval_uls(user)),
+            ('classify', self.unit.get_serrorless_uls(user)),
+            ('resolve', self.unit.get_unresolved_uls(user))) for ul in uls]
+        with self.assertNumQueries(3):
+            taskTable = StudentTasks(user, self.unit).get_task_table()
+            titles = [ul.lesson.title for ul, task in taskTable]
+        self.assertEqual(sorted((ul.pk, task) for ul, task in taskTable),
+                         sorted((ul.pk, task) for ul, task in expected))
+        self.assertEqual([task for ul, task in taskTable],
+                         ['start', 'selfeval', 'selfeval', 'classify',
+                          'resolve', 'resolve'])
+
+    def test_ul_tables(self):
+        'check question tasks match get_next_step(), in two queries'
+        expected = [(r, r.get_next_step()[0]) for r in
+                    self.ulQ.response_set.order_by('atime')
+                    if r.get_next_step()]
+        with self.assertNumQueries(2):
+            tasks = StudentTasks(self.user, unitLesson=self.ulQ)
+            responseTable = tasks.get_response_table()
+            errorTable = tasks.get_error_table()
+            self.assertEqual(errorTable[0].errorModel.lesson.title, 'an error')
+        self.assertEqual([(r, step) for r, step, label in responseTable],
+                         expected)
+        self.assertEqual(len(errorTable), 1)
+        self.assertEqual(errorTable[0].status, NEED_HELP_STATUS)
+        url = '/ct/courses/%d/units/%d/lessons/%d/tasks/' % (
+            self.course.pk, self.unit.pk, self.ulQ.pk)
+        self.client.login(username='jacob', password='pw')
+        self.assertContains(self.client.get(url), 'an error')
+
+    def test_classify_other_kinds(self):
+        'check only the classify step is listed for non-ORCT responses'
+        def comment(selfeval):
+            return Response.objects.create(
+                lesson=self.ulQ.lesson, unitLesson=self.ulQ,
+                course=self.course, text='bar', confidence=Response.SURE,
+                author=self.user, kind=Response.COMMENT, selfeval=selfeval)
+        comment(None) # self-assess step, not listed
+        r = comment(Response.DIFFERENT)
+        responseTable = StudentTasks(self.user, unitLesson=self.ulQ) \
+            .get_response_table()
+        self.assertEqual([(x, step) for x, step, label in responseTable
+                          if x.kind == Response.COMMENT],
+                         [(r, Response.CLASSIFY_STEP)])
+
+
+class TreeQuerySetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', password='pw')
+        self.ul = create_question_unit(self.user)
+        self.unit2 = Unit.objects.create(title='copies', addedBy=self.user)
+        for i in range(3): # copies share the question's treeID
+            self.ul.copy(self.unit2, self.user)
+        for i in range(2):
+            lesson = Lesson(title='quest %d' % i, text='?',
+                            kind=Lesson.ORCT_QUESTION, addedBy=self.user)
+            lesson.save_root()
+            UnitLesson.create_from_lesson(lesson, self.unit2)
+
+    def test_distinct_trees(self):
+        'check db-side treeID dedupe matches distinct_subset()'
+        qs = UnitLesson.objects.filter(lesson__title__icontains='quest')
+        expected = [ul.pk for ul in distinct_subset(qs.order_by('pk'))]
+        self.assertEqual(len(expected), 3)
+        deduped = qs.distinct_trees().order_by('pk')
+        self.assertEqual([ul.pk for ul in deduped], expected)
+        self.assertEqual(deduped.count(), 3)
+        self.assertEqual([ul.pk for ul in deduped[1:]], expected[1:])
+        # joins must not duplicate rows
+        qs = UnitLesson.objects.filter(unit__unitlesson__kind=UnitLesson.COMPONENT)
+        self.assertEqual(qs.distinct_trees().count(), len(distinct_subset(qs)))
+        self.assertEqual(UnitLesson.search_text('quest', 'question').count(), 3)
+
+
+class LessonSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jacob', password='pw')
+        self.unit = Unit.objects.create(title='Search', addedBy=self.user)
+        self.uls = {}
+        for title, text in (('Bayes theorem', 'conditional probability'),
+                            ('Priors', 'a Bayesian approach to estimation'),
+                            ('Likelihood', 'maximum likelihood estimation')):
+            lesson = Lesson(title=title, text=text, addedBy=self.user)
+            lesson.save_root()
+            self.uls[title] = UnitLesson.create_from_lesson(lesson, self.unit)
+
+    def search(self, s):
+        return [ul.lesson.title for ul in UnitLesson.search_text(s)]
+
+    def test_search(self):
+        'check ranked full-text search, kept current on save and delete'
+        from ct.search_index import get_search_backend
+        if get_search_backend().name == 'like':
+            raise unittest.SkipTest('no full-text index in this database')
+        self.assertEqual(self.search('bayes'), ['Bayes theorem', 'Priors'])
+        self.assertEqual(sorted(self.search('estimation')), ['Likelihood', 'Priors'])
+        self.assertEqual(self.search('likelihood estim'), ['Likelihood'])
+        self.assertEqual(self.search('!!'), [])
+        lesson = self.uls['Likelihood'].lesson
+        lesson.text = 'a Bayes factor'
+        lesson.save()
+        self.assertEqual(self.search('estimation'), ['Priors'])
+        self.assertEqual(self.search('bayes')[0], 'Bayes theorem')
+        self.assertEqual(len(self.search('bayes')), 3)
+        self.uls['Bayes theorem'].delete()
+        lesson = Lesson.objects.get(title='Bayes theorem')
+        lesson.delete()
+        self.assertEqual(len(self.search('bayes')), 2)
+        Lesson.objects.filter(pk=lesson.pk).update(title='x') # no signal
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('Indexed 2 lessons', out.getvalue())
+        self.assertEqual(len(self.search('bayes')), 2)
+
+    def test_search_bench(self):
+        'check the search benchmark runs and leaves no lessons behind'
+        nLessons = Lesson.objects.count()
+        out = StringIO()
+        call_command('search_bench', lessons=50, queries=3, seed=1, stdout=out)
+        self.assertIn('like', out.getvalue())
+        self.assertEqual(Lesson.objects.count(), nLessons)
+        self.assertEqual(self.search('bayes'), ['Bayes theorem', 'Priors'])
+
+
+class ConceptAutocompleteTests(TestCase):
+    def setUp(self):
+        from ct.concept_index import concept_index
+        self.index = concept_index
+        self.user = User.objects.create_user(username='jacob', password='pw')
+        for title, isError in (('New York City', False),
+                               ('York', False),
+                               ('Newton', False),
+                               ('Newtonian fallacy', True)):
+            Concept.objects.create(title=title, isError=isError,
+                                   addedBy=self.user)
+        self.index.load()
+
+    def tearDown(self):
+        self.index.clear() # drop concepts rolled back with this test
+
+    def titles(self, q, isError=False):
+        return [t[1] for t in self.index.search(q, isError)]
+
+    def test_search(self):
+        'check prefix search ranking, error / non-error split and signals'
+        self.assertEqual(self.titles('york'), ['York', 'New York City'])
+        self.assertEqual(self.titles('new yo'), ['New York City'])
+        self.assertEqual(self.titles('newt'), ['Newton'])
+        self.assertEqual(self.titles('newt', True), ['Newtonian fallacy'])
+        self.assertEqual(self.titles('?'), [])
+        c = Concept.objects.create(title='Yorkshire', addedBy=self.user)
+        self.assertEqual(self.titles('york'),
+                         ['York', 'Yorkshire', 'New York City'])
+        c.title = 'Leeds'
+        c.save()
+        self.assertEqual(self.titles('lee'), ['Leeds'])
+        self.assertEqual(len(self.titles('york')), 2)
+        c.delete()
+        self.assertEqual(self.titles('lee'), [])
+
+    def test_view(self):
+        'check JSON autocomplete, with db fallback while index loads'
+        self.client.login(username='jacob', password='pw')
+        url = reverse('ct:concept_autocomplete')
+        response = self.client.get(url, dict(q='newt', errors=1))
+        self.assertEqual([c['title'] for c in json.loads(response.content)],
+                         ['Newtonian fallacy'])
+        self.index._indexes, self.index._loading = None, True
+        response = self.client.get(url, dict(q='york', limit=1))
+        self.assertEqual(len(json.loads(response.content)), 1)
+        response = self.client.get(url, dict(q='york', limit=-5))
+        self.assertEqual(len(json.loads(response.content)), 1)
+        self.index._loading = False
+
+    def test_other_process(self):
+        'check renames and deletes logged by other processes are applied'
+        c = Concept.objects.get(title='York')
+        Concept.objects.filter(pk=c.pk).update(title='Leeds') # no signals
+        self.index.mark_changed(c.pk)
+        self.assertEqual(self.titles('york'), ['New York City'])
+        self.assertEqual(self.titles('lee'), ['Leeds'])
+        Concept.objects.filter(pk=c.pk).delete()
+        self.index.mark_changed(c.pk)
+        self.assertEqual(self.titles('lee'), [])
+        from mock import patch
+        from django.core.cache import cache
+        from ct.concept_index import CHANGE_KEY, get_change_count
+        self.index.mark_changed(c.pk)
+        cache.delete(CHANGE_KEY % get_change_count()) # evicted
+        with patch.object(self.index, 'start_loading') as start_loading:
+            self.index.search('lee')
+        self.assertEqual(start_loading.call_count, 1)
+
+    def test_fork(self):
+        'check a process forked mid-load starts over instead of waiting'
+        self.index._indexes, self.index._loading = None, True
+        self.index._pending.append((1, 'Stale', False))
+        self.index._pid = -1  # as seen from a forked child
+        self.assertEqual(self.titles('york'), ['York', 'New York City'])
+        self.assertEqual(self.index._pending, [])
+        self.assertFalse(self.index._loading)
+
+    def test_bench(self):
+        'check the autocomplete benchmark runs'
+        out = StringIO()
+        call_command('concept_index_bench', concepts=1000, queries=10,
+                     seed=1, stdout=out)
+        self.assertIn('indexed 1000 concepts', out.getvalue())
+
+
+class SourceDBCacheTests(TestCase):
+    def setUp(self):
+        from ct.sourcedb_cache import CachedSourceDB
+        from ct.sourcedb_plugin import localfile_plugin
+        self.calls = []
+        plugin = localfile_plugin.LessonDoc
+        class CountingDoc(plugin):
+            def __init__(doc, sourceID):
+                self.calls.append(sourceID)
+                plugin.__init__(doc, sourceID)
+        self.cache = CachedSourceDB('localfile', CountingDoc)
+        self.user = User.objects.create_user(username='jacob', password='pw')
+
+    def test_lookup(self):
+        'check page and negative caching, in process and in the db'
+        doc = self.cache('New York City')
+        self.assertIn('most populous', doc.description)
+        self.assertEqual(doc.url, 'http://en.wikipedia.org/wiki/New_York_City')
+        self.assertEqual(self.cache('New York City').title, 'New York City')
+        self.assertRaises(KeyError, self.cache, 'Old York')
+        self.assertRaises(KeyError, self.cache, 'Old York')
+        self.assertEqual(self.calls, ['New York City', 'Old York'])
+        self.cache.clear() # now served from SourceDBEntry table
+        self.assertEqual(self.cache('New York City').title, 'New York City')
+        self.assertRaises(KeyError, self.cache, 'Old York')
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.cache.stats['dbHits'], 2)
+        SourceDBEntry.objects.update(expires=timezone.now())
+        self.cache.clear()
+        self.cache('New York City') # expired, so fetched again
+        self.assertEqual(len(self.calls), 3)
+        from ct.sourcedb_cache import purge_expired
+        self.assertEqual(purge_expired(), 1) # Old York
+        self.assertEqual(self.cache.search('york new'),
+                         [('New York', 'New York',
+                           'http://en.wikipedia.org/wiki/New_York'),
+                          ('New York City', 'New York City',
+                           'http://en.wikipedia.org/wiki/New_York_City')])
+
+    def test_coalesce(self):
+        'check concurrent misses for one page make a single plugin call'
+        import threading
+        self.cache.useDB = False # other threads cannot see the test db
+        started = threading.Event()
+        def slow_fetch():
+            started.set()
+            time.sleep(0.2)
+            return 'page'
+        results = []
+        def lookup():
+            results.append(self.cache.lookup('k', slow_fetch, 60))
+        threads = [threading.Thread(target=lookup) for i in range(4)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['page'] * 4)
+        self.assertEqual(self.cache.stats['misses'], 1)
+        self.assertEqual(self.cache.stats['coalesced'], 3)
+
+    def test_lesson(self):
+        'check Lesson and UnitLesson sourceDB access via the local file'
+        lesson = Lesson.get_from_sourceDB('York', self.user, 'localfile')
+        self.assertEqual(lesson.sourceDB, 'localfile')
+        self.assertIn('walled city', lesson.text)
+        unit = Unit.objects.create(title='Cities', addedBy=self.user)
+        ul = UnitLesson.create_from_lesson(lesson, unit)
+        uls, results = UnitLesson.search_sourceDB('york', 'localfile')
+        self.assertEqual(uls, [ul])
+        self.assertEqual([t[0] for t in results], ['New York', 'New York City'])
+        unit2 = Unit.objects.create(title='Towns', addedBy=self.user)
+        ul2 = UnitLesson.create_from_lesson(lesson, unit2)
+        results.append(('York', 'York', lesson.url))
+        with self.assertNumQueries(1):
+            uls, _ = UnitLesson.map_sourceDB_results(results, 'localfile', unit2)
+        self.assertEqual(uls, [ul2])
+
+    def test_concurrent_search(self):
+        'check sourceDB searches run in the pool, and slow ones time out'
+        from ct import sourcedb_cache, sourcedb_search
+        from ct.sourcedb_plugin import localfile_plugin
+        class SlowDoc(localfile_plugin.LessonDoc):
+            @classmethod
+            def search(klass, query, max_results=10):
+                time.sleep(0.5)
+                return localfile_plugin.LessonDoc.search(query, max_results)
+        sourcedb_cache._cachedSourceDBs['slowfile'] = \
+            sourcedb_cache.CachedSourceDB('slowfile', SlowDoc)
+        sourcedb_search.SOURCEDB_SEARCH_TIMEOUTS['slowfile'] = 0.1
+        try:
+            t = time.time()
+            search = sourcedb_search.SourceDBSearch('new york',
+                                                    ('localfile', 'slowfile'))
+            results = search.results()
+            self.assertLess(time.time() - t, 0.4)
+            self.assertEqual(search.timedOut, ['slowfile'])
+            self.assertEqual(results.keys(), ['localfile'])
+            self.assertEqual(len(results['localfile']), 2)
+            search = sourcedb_search.SourceDBSearch('new york', ('localfile',))
+            self.assertEqual(search.results(), results) # from cache
+            search = sourcedb_search.SourceDBSearch(
+                'york', ('slowfile', 'localfile'), timeout=2)
+            merged = list(search.iter_merged())
+            self.assertEqual([t[0] for t in merged], ['localfile'] * 3)
+            self.assertEqual(search.timedOut, [])
+        finally:
+            del sourcedb_cache._cachedSourceDBs['slowfile']
+            del sourcedb_search.SOURCEDB_SEARCH_TIMEOUTS['slowfile']
+
+    def test_federated_view(self):
+        'check streamed, merged search results from the registered sources'
+        self.client.login(username='jacob', password='pw')
+        response = self.client.get(reverse('ct:sourcedb_search'),
+                                   dict(q='new york', sources='localfile,nope'))
+        lines = [json.loads(line) for line in
+                 ''.join(response.streaming_content).splitlines()]
+        self.assertEqual([d.get('title') for d in lines],
+                         ['New York', 'New York City', None])
+        self.assertEqual(lines[-1], dict(done=True, timedOut=[], failed=[]))
+
+    def test_federated_bench(self):
+        'check the federated search benchmark runs'
+        out = StringIO()
+        call_command('sourcedb_search_bench', latencies='1,20', queries=2,
+                     seed=1, stdout=out)
+        self.assertIn('federated / slowest single source (bench1)',
+                      out.getvalue())
+
+
 class ReversePathTests(TestCase):
     def test_home(self):
         'test trimming of args not needed for target'
@@ -291,3 +806,306 @@ class PageDataTests(TestCase):
         s = pageData.get_refresh_timer(request)
         self.assertNotEqual(s, '0:00')
         self.assertEqual(s[:3], '0:0')
+
+
+class Md2htmlTestCase(TestCase):
+    'md2html tests against (mocked) pandoc, so bypass ct.fastrst'
+    def setUp(self):
+        from ct.render_cache import md2html_cache
+        from mock import patch
+        self.cache = md2html_cache
+        self.cache.clear()
+        self.noFastPath = patch('ct.templatetags.ct_extras.MD2HTML_FASTPATH',
+                                False)
+        self.noFastPath.start()
+
+    def tearDown(self):
+        self.noFastPath.stop()
+
+
+class Md2htmlCacheTests(Md2htmlTestCase):
+
+    def test_convert_once(self):
+        'identical texts only converted once, first via LRU then via db'
+        from mock import patch
+        from ct.templatetags.ct_extras import md2html
+        with patch('pypandoc.convert', return_value='<p>hi</p>') as convert:
+            self.assertEqual(md2html('hi'), '<p>hi</p>')
+            self.assertEqual(md2html('hi'), '<p>hi</p>')
+            self.assertEqual(md2html('hi', stripP=True), 'hi')
+            self.assertEqual(convert.call_count, 1)
+            self.assertEqual(self.cache.stats['misses'], 1)
+            self.assertEqual(self.cache.stats['hits'], 2)
+            self.cache.clear() # e.g. a freshly started worker
+            self.assertEqual(md2html('hi'), '<p>hi</p>')
+            self.assertEqual(convert.call_count, 1)
+            self.assertEqual(self.cache.stats['dbHits'], 1)
+            md2html('something else')
+            self.assertEqual(convert.call_count, 2)
+        self.assertEqual(RenderedText.objects.count(), 2)
+
+    def test_failure_not_cached(self):
+        'failed conversions are not stored, so they get retried'
+        from mock import patch
+        from ct.templatetags.ct_extras import md2html
+        with patch('pypandoc.convert', side_effect=OSError('no pandoc')):
+            self.assertEqual(md2html('oops'), 'oops')
+        with patch('pypandoc.convert', return_value='<p>oops</p>') as convert:
+            self.assertEqual(md2html('oops'), '<p>oops</p>')
+            self.assertEqual(convert.call_count, 1)
+
+    def test_lru_bound(self):
+        'LRU evicts least recently used entries beyond maxsize'
+        from ct.render_cache import LRUCache
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('a'), 1)
+
+
+def has_pandoc_lua():
+    from ct.pandoc_pool import PandocWorker, PandocWorkerError
+    try:
+        worker = PandocWorker()
+    except PandocWorkerError:
+        return False
+    try:
+        worker.convert('test', timeout=10.)
+        return True
+    except PandocWorkerError:
+        return False
+    finally:
+        worker.close()
+
+
+class PandocPoolTests(Md2htmlTestCase):
+    def test_no_pandoc(self):
+        'missing pandoc raises PandocWorkerError, which md2html survives'
+        from ct.pandoc_pool import PandocPool, PandocWorkerError
+        pool = PandocPool(size=1, pandocPath='/nonexistent/pandoc')
+        self.assertRaises(PandocWorkerError, pool.convert, 'hi')
+        self.assertEqual(pool._nWorkers, 0)
+        from ct.templatetags import ct_extras
+        from mock import patch
+        with patch('ct.pandoc_pool.get_pool', return_value=pool):
+            with patch.object(ct_extras, 'MD2HTML_BACKEND', 'pool'):
+                html, ok = ct_extras.render_rst('hi')
+                self.assertFalse(ok)
+
+    @unittest.skipUnless(has_pandoc_lua(), 'needs pandoc >= 3 on PATH')
+    def test_pool(self):
+        'pool matches pypandoc output, and recycles its workers'
+        import pypandoc
+        from ct.pandoc_pool import PandocPool
+        pool = PandocPool(size=1, maxDocs=2)
+        try:
+            txt = u'Some *text* with :math:`x^2` and \xe9l\xe8ve'
+            html = pool.convert(txt)
+            self.assertEqual(html, pypandoc.convert(txt, 'html', format='rst',
+                                                    extra_args=('--mathjax',)))
+            worker = pool._idle.queue[0]
+            pool.convert('two')
+            self.assertNotEqual(pool._idle.queue[0], worker)
+            self.assertEqual(pool._nWorkers, 1)
+            self.assertEqual(pool.convert(''), '\n')
+        finally:
+            pool.close()
+
+
+def fake_pandoc(txt, *args, **kwargs):
+    'stand-in for pandoc: one <p> per blank-line separated paragraph'
+    return ''.join('<p>%s</p>\n' % p.strip() for p in txt.split('\n\n')
+                   if p.strip())
+
+
+class Md2htmlManyTests(Md2htmlTestCase):
+    def test_batch(self):
+        'batchable texts converted by one pandoc run, media markers per text'
+        from mock import patch
+        from ct.templatetags.ct_extras import md2html_many, render_rst
+        texts = ['first\n\n.. audio:: one.mp3\n',
+                 'second\n\n.. video:: youtube:abc\n\n.. audio:: two\n',
+                 'Title\n=====\n\n.. audio:: three.mp3',  # not batchable
+                 'first\n\n.. audio:: one.mp3\n']  # duplicate
+        with patch('pypandoc.convert', side_effect=fake_pandoc) as convert:
+            expected = [render_rst(txt)[0] for txt in texts]
+            self.assertEqual(convert.call_count, 4)
+            from ct.render_cache import md2html_cache
+            md2html_cache.clear()
+            htmls = md2html_many(texts)
+            self.assertEqual(convert.call_count, 6)  # 1 batch + 1 title
+            self.assertEqual(htmls, expected)
+            self.assertIn('two.ogg', htmls[1])
+            self.assertIn('youtube.com/embed/abc', htmls[1])
+            self.assertNotIn('mArKeR', ''.join(htmls))
+            self.assertEqual(md2html_many(texts), expected)  # now cached
+            self.assertEqual(convert.call_count, 6)
+
+    def test_bad_split(self):
+        'falls back to converting one by one if separators get mangled'
+        from mock import patch
+        from ct.templatetags.ct_extras import md2html_many
+        def mangle(txt, *args, **kwargs):
+            return fake_pandoc(txt).replace('md2htmlsep', 'oops')
+        with patch('pypandoc.convert', side_effect=mangle) as convert:
+            htmls = md2html_many(['a', 'b'])
+            self.assertEqual(convert.call_count, 3)
+            self.assertEqual(htmls, ['<p>a</p>\n', '<p>b</p>\n'])
+
+    def test_prerender_tag(self):
+        'md2html_prerender warms the cache for later md2html filters'
+        from mock import patch
+        from django.template import Template, Context
+        t = Template("{% load ct_extras %}{% md2html_prerender items '0' %}"
+                     "{% for s, n in items %}{{ s|md2html }}{% endfor %}")
+        with patch('pypandoc.convert', side_effect=fake_pandoc) as convert:
+            html = t.render(Context(dict(items=[('x', 1), ('y', 2)])))
+            self.assertEqual(convert.call_count, 1)
+        self.assertEqual(html, '<p>x</p>\n<p>y</p>\n')
+
+
+# (rst, html) pairs; html as produced by pandoc 3.x -f rst -t html --mathjax
+FASTRST_CORPUS = [
+    (u'Plain paragraph.',
+     u'<p>Plain paragraph.</p>\n'),
+    (u"Let's define a **concept** as a *concise* statement, see ``x = 1``\r\nand so on.\r\n\r\nSecond paragraph.",
+     u"<p>Let's define a <strong>concept</strong> as a <em>concise</em>\nstatement, see <code>x = 1</code> and so on.</p>\n<p>Second paragraph.</p>\n"),
+    (u'Some people asserted that :math:`p(A|B)=p(A)` in this Venn diagram,\r\nwhich implies a basic misunderstanding of what :math:`p(A|B)`\r\n*means*.  Suggestion: review the definition.',
+     u'<p>Some people asserted that <span\nclass="math inline">\\(p(A|B)=p(A)\\)</span> in this Venn diagram, which\nimplies a basic misunderstanding of what <span\nclass="math inline">\\(p(A|B)\\)</span> <em>means</em>. Suggestion: review\nthe definition.</p>\n'),
+    (u'* using **procedures** we know\r\n* thinking about *concepts*\r\n  on a second line',
+     u'<ul>\n<li>using <strong>procedures</strong> we know</li>\n<li>thinking about <em>concepts</em> on a second line</li>\n</ul>\n'),
+    (u'#. first\n#. second',
+     u'<ol>\n<li>first</li>\n<li>second</li>\n</ol>\n'),
+    (u'2. :math:`\\sum_{i=1}^n p(A, B=b_i)`.\n\n3. :math:`p(A)`\n',
+     u'<ol start="2" type="1">\n<li><span class="math inline">\\(\\sum_{i=1}^n p(A, B=b_i)\\)</span>.</li>\n<li><span class="math inline">\\(p(A)\\)</span></li>\n</ol>\n'),
+    (u'Escapes: A\\(x\\) \\* 1 & 2 < 3 > 0',
+     u'<p>Escapes: A(x) * 1 &amp; 2 &lt; 3 &gt; 0</p>\n'),
+    (u'.. image:: STATICIMAGE/no_intersection.png\r\n   :width: 80%\r\n\r\nAre events A, B independent?',
+     u'<p><img src="STATICIMAGE/no_intersection.png" style="width:80.0%"\nalt="image" /></p>\n<p>Are events A, B independent?</p>\n'),
+    (u'.. math:: \\sum_X{p(X)}=1',
+     u'<p><span class="math display">\\[\\sum_X{p(X)}=1\\]</span></p>\n'),
+    (u'mArKeR:0:\n\nafter the audio',
+     u'<p>mArKeR:0:</p>\n<p>after the audio</p>\n'),
+    (u'',
+     u'\n'),
+]
+
+FASTRST_UNSUPPORTED = [
+    'Title\n=====\n\nbody',
+    'see http://example.com',
+    'a reference_ here',
+    'literal block::\n\n  code',
+    '  block quote',
+    'term\n  definition',
+    '2*3*4',
+    '* item\n\n  second paragraph',
+    'A. alphabetic list',
+    '.. note:: admonition',
+    '|sub| stitution',
+]
+
+
+from ct.pandoc_pool import pandoc_version
+
+
+class FastRSTTests(TestCase):
+    def test_corpus(self):
+        'fast path reproduces pandoc output'
+        from ct import fastrst
+        for rst, html in FASTRST_CORPUS:
+            self.assertEqual(fastrst.render(rst), html)
+
+    def test_unsupported(self):
+        'anything outside the subset is left to pandoc'
+        from ct import fastrst
+        for rst in FASTRST_UNSUPPORTED:
+            self.assertIsNone(fastrst.render(rst), rst)
+
+    def test_md2html(self):
+        'md2html uses the fast path, with audio / video markers'
+        from mock import patch
+        from ct.templatetags.ct_extras import render_rst
+        with patch('pypandoc.convert') as convert:
+            html, ok = render_rst('hear this\n\n.. audio:: talk.mp3\n')
+            self.assertTrue(ok)
+            self.assertEqual(convert.call_count, 0)
+        self.assertTrue(html.startswith('<p>hear this</p>\n<p><audio controls>'))
+
+    def test_old_pandoc(self):
+        'the fast path is off, with a warning, under pandoc 1.x'
+        from mock import patch
+        from ct.templatetags import ct_extras
+        with patch('ct.pandoc_pool.pandoc_version', return_value=(1, 19)), \
+                patch.object(ct_extras, '_fastPathOK', None), \
+                patch.object(ct_extras.LOGGER, 'warning') as warning:
+            self.assertIsNone(ct_extras.render_rst_fast('plain *text*'))
+            self.assertIsNone(ct_extras.render_rst_fast('more text'))
+            self.assertEqual(warning.call_count, 1)
+
+    @unittest.skipUnless(pandoc_version() >= (2,), 'needs pandoc >= 2')
+    def test_vs_pandoc(self):
+        'byte-identical to pandoc on all eligible fixture and corpus texts'
+        import json
+        import pypandoc
+        from ct import fastrst
+        with open(os.path.join(settings.BASE_DIR, 'dumpdata', 'debug.json')) as ifile:
+            texts = [o['fields'].get('text') for o in json.load(ifile)]
+        texts = [t for t in texts if t] + [rst for rst, html in FASTRST_CORPUS]
+        nEligible = 0
+        for txt in texts:
+            html = fastrst.render(txt)
+            if html is not None:
+                nEligible += 1
+                self.assertEqual(html, pypandoc.convert(
+                    txt, 'html', format='rst', extra_args=('--mathjax',)))
+        self.assertGreater(nEligible, len(texts) / 2)
+
+
+class LessonHTMLTests(TestCase):
+    def setUp(self):
+        from ct.render_cache import md2html_cache
+        md2html_cache.clear()
+        self.user = User.objects.create_user(username='jacob', email='jacob@_',
+                                             password='top_secret')
+        self.lesson = Lesson(title='a lesson', text='some *text*',
+                             addedBy=self.user)
+        self.lesson.save_root()
+
+    def test_prerendered(self):
+        'commit stores HTML, which get_html() reads with one query'
+        from mock import patch
+        self.assertEqual(self.lesson.lessonhtml_set.count(), 1)
+        self.lesson.text = 'new *text*'
+        self.lesson.checkin(commit=True)
+        lh = self.lesson.lessonhtml_set.get()
+        self.assertEqual(lh.html, '<p>new <em>text</em></p>\n')
+        with patch('ct.templatetags.ct_extras.render_rst_many') as render:
+            with self.assertNumQueries(1):
+                html = self.lesson.get_html()
+            self.assertEqual(render.call_count, 0)
+        self.assertEqual(html, lh.html)
+
+    def test_stale(self):
+        'uncommitted edits are re-rendered, not served stale nor stored'
+        self.lesson.text = 'edited'
+        self.lesson.save()
+        self.assertEqual(self.lesson.get_html(), '<p>edited</p>\n')
+        self.assertEqual(self.lesson.lessonhtml_set.get().html,
+                         '<p>some <em>text</em></p>\n')
+
+    def test_render_all(self):
+        'backfill replaces old renderer versions and skips current ones'
+        from ct.render_cache import RENDERER_VERSION
+        self.lesson.lessonhtml_set.update(rendererVersion=RENDERER_VERSION - 1)
+        l2 = Lesson(title='draft', text='draft', addedBy=self.user)
+        l2.save()
+        self.assertEqual(LessonHTML.render_all(), (2, 0))
+        self.assertEqual(LessonHTML.objects.filter(
+            rendererVersion=RENDERER_VERSION).count(), 2)
+        self.assertEqual(LessonHTML.objects.count(), 2)
+        self.assertEqual(LessonHTML.render_all(), (0, 0))
+        self.assertEqual(LessonHTML.render_all(force=True), (2, 0))
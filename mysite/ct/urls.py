@@ -5,6 +5,9 @@ urlpatterns = patterns('',
     url(r'^$', main_page, name='home'),
     url(r'^about/$', about, name='about'),
     url(r'^people/(?P<user_id>\d+)/$', person_profile, name='person_profile'),
+    url(r'^concepts/autocomplete/$', concept_autocomplete,
+        name='concept_autocomplete'),
+    url(r'^sources/search/$', sourcedb_search, name='sourcedb_search'),
     # instructor UI
     # course tabs
     url(r'^teach/courses/(?P<course_id>\d+)/$', course_view, name='course'),
@@ -0,0 +1,67 @@
+"""
+Delta-compressed storage of old Lesson version texts.
+
+Every checkout clones a lesson's full text and data, so heavily edited
+lessons store many near-identical copies.  LessonDelta.compress_all()
+therefore replaces the text and data of old versions by a delta from
+their parent version's, zlib-compressed in the ``LessonDelta`` table,
+and clears them in ``ct_lesson`` (Lesson.isDelta marks such rows).
+Full text is kept for
+
+* tree heads and uncommitted versions;
+* versions used by a UnitLesson, Response, StudyList or ConceptLink
+  (e.g. the concept page shows the text of its linked lessons);
+* keyframes: every LESSON_KEYFRAME_INTERVAL'th version along each
+  branch, so rebuilding a version applies fewer deltas than that.
+
+Lesson.load_text() rebuilds a compressed version's text on demand; call
+it before showing the text of a version reached any other way.
+
+A delta is a list of ops on the lines of the parent's text: [i, j]
+copies its lines i:j, and a string is inserted as is.
+"""
+import difflib
+import json
+import zlib
+
+from django.conf import settings
+
+
+# number of versions along a branch between full-text keyframes
+LESSON_KEYFRAME_INTERVAL = getattr(settings, 'LESSON_KEYFRAME_INTERVAL', 10)
+
+
+def make_delta(old, new):
+    'get delta ops turning text old into new (either may be None)'
+    if new is None:
+        return None
+    a, b = (old or '').splitlines(True), new.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(
+            None, a, b, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return ops
+
+
+def apply_delta(old, ops):
+    'get text from applying make_delta() ops to text old'
+    if ops is None:
+        return None
+    a = (old or '').splitlines(True)
+    return ''.join(op if isinstance(op, basestring) else ''.join(a[op[0]:op[1]])
+                   for op in ops)
+
+
+def pack_delta(oldText, oldData, text, data):
+    'compressed delta from one version\'s text and data to the next\'s'
+    return zlib.compress(json.dumps(dict(text=make_delta(oldText, text),
+                                         data=make_delta(oldData, data))), 9)
+
+
+def unpack_delta(packed, oldText, oldData):
+    'get (text, data) from applying a pack_delta() result'
+    d = json.loads(zlib.decompress(bytes(packed)))
+    return apply_delta(oldText, d['text']), apply_delta(oldData, d['data'])
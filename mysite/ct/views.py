@@ -1,8 +1,10 @@
+import json
 import time
 import urllib
 from datetime import datetime
 
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Q, Count
 from django.conf import settings
 from django.utils import timezone
 from django.core.urlresolvers import reverse
@@ -12,12 +14,15 @@ from django.contrib.auth import logout, login
 from django.contrib.auth.models import AnonymousUser
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import HttpResponseRedirect, HttpResponse, \
+    StreamingHttpResponse
 from social.backends.utils import load_backends
 
 from ct.forms import *
 from ct.models import *
 from ct.ct_util import reverse_path_args, cache_this
+from ct.concept_index import concept_index
+from ct.sourcedb_search import SourceDBSearch, SOURCEDB_SEARCH_SOURCES
 from ct.templatetags.ct_extras import (md2html,
                                        get_base_url,
                                        get_object_url,
@@ -25,7 +30,9 @@ from ct.templatetags.ct_extras import (md2html,
                                        display_datetime,
                                        get_path_type)
 from fsm.fsm_base import FSMStack
-from fsm.models import FSM, FSMState, KLASS_NAME_DICT
+from fsm.models import FSMState, KLASS_NAME_DICT
+from fsm.catalog import fsm_catalog
+from fsm.live_channel import live_channel, INSTRUCTOR_CHANNEL
 
 
 ###########################################################
@@ -202,7 +209,7 @@ class PageData(object):
               .get_help(self.fsmStack.state, request)
         else: # only show Start Activity menu if no FSM running
             for groupName, data in fsmGroups: # set up fsmLauncher
-                for fsm in FSM.objects.filter(fsmgroup__group=groupName):
+                for fsm in fsm_catalog.get_group(groupName):
                     if fsm.description:
                         submitArgs = dict(title=fsm.description)
                     else:
@@ -221,7 +228,15 @@ class PageData(object):
         templateArgs['target'] = request.session.get('target', '_self')
         if self.has_refresh_timer(request):
             templateArgs['elapsedTime'] = self.get_refresh_timer(request)
-            templateArgs['refreshInterval'] = 15
+            state = self.fsmStack.state
+            if state and state.isLiveSession: # counts are pushed to us
+                latest = live_channel.get_latest((state.pk,
+                                                  INSTRUCTOR_CHANNEL))
+                templateArgs['liveEventsURL'] = reverse('fsm:live_events',
+                                                        args=(state.pk,))
+                templateArgs['liveVersion'] = latest.version if latest else 0
+            else:
+                templateArgs['refreshInterval'] = 15
         return self.fsm_redirect(request, addNextButton=addNextButton) \
             or render(request, templatefile, templateArgs, **kwargs)
     def fsm_push(self, request, name, *args, **kwargs):
@@ -258,7 +273,7 @@ def ul_page_data(request, unit_id, ul_id, currentTab, includeText=True,
     if includeNavTabs:
         pageData.navTabs = tabFunc(request.path, currentTab, ul)
     if includeText:
-        pageData.headText = md2html(ul.lesson.text)
+        pageData.headText = ul.lesson.get_html()
         ulType = ul.get_type()
         if ulType == IS_ERROR:
             pageData.headLabel = 'error model'
@@ -530,9 +545,15 @@ def _concepts(request, pageData, msg='', ignorePOST=False, conceptLinks=None,
                 cset = [(ul.lesson.title, get_object_url(request.path, ul))
                         for ul in UnitLesson.search_text(s, IS_ERROR)]
             else: # search correct concepts only
-                cset = UnitLesson.search_text(s, IS_CONCEPT)
-                cset2, wset = UnitLesson.search_sourceDB(s, unit=unit)
-                cset = distinct_subset(cset2 + cset, lambda x:x.lesson.concept)
+                # Wikipedia search runs in background while we query db
+                sourceSearch = SourceDBSearch(s, ('wikipedia',))
+                cset = list(UnitLesson.search_text(s, IS_CONCEPT))
+                cset2, wset = UnitLesson.map_sourceDB_results(
+                    sourceSearch.results().get('wikipedia', []), unit=unit)
+                if sourceSearch.timedOut or sourceSearch.failed:
+                    msg = 'Wikipedia search failed: results are incomplete.'
+                cset = distinct_subset(cset2 + cset,
+                                       lambda x:x.lesson.concept)
                 cset = [(ul.lesson.title, get_object_url(request.path, ul, subpath=''),
                          ul) for ul in cset]
                 cset += [(t[0],
@@ -546,9 +567,55 @@ def _concepts(request, pageData, msg='', ignorePOST=False, conceptLinks=None,
     kwargs.update(dict(cset=cset, msg=msg, searchForm=searchForm,
                        toTable=toTable, fromTable=fromTable,
                        conceptForm=conceptForm, conceptLinks=conceptLinks,
-                       actionLabel=actionLabel, errorModels=errorModels))
+                       actionLabel=actionLabel, errorModels=errorModels,
+                       searchErrors=errorModels is not None))
     return pageData.render(request, 'ct/concepts.html', kwargs)
 
+@login_required
+def concept_autocomplete(request):
+    '''JSON list of {id, title} of Concepts whose titles match GET q;
+    error models if GET errors is set'''
+    s = request.GET.get('q', '').strip()
+    isError = bool(request.GET.get('errors'))
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 10)), 50))
+    except ValueError:
+        limit = 10
+    results = []
+    if s:
+        results = concept_index.search(s, isError, limit)
+        if results is None: # index not ready, so ask the db
+            results = Concept.search_text(s).filter(isError=isError) \
+                .values_list('pk', 'title')[:limit]
+    data = [dict(id=conceptID, title=title) for conceptID, title in results]
+    return HttpResponse(json.dumps(data), content_type='application/json')
+
+def _sourcedb_stream(search):
+    'generate JSON lines of merged results, then a summary line'
+    for sourceDB, title, sourceID, url in search.iter_merged():
+        yield json.dumps(dict(sourceDB=sourceDB, title=title,
+                              sourceID=sourceID, url=url)) + '\n'
+    yield json.dumps(dict(done=True, timedOut=search.timedOut,
+                          failed=search.failed)) + '\n'
+
+@login_required
+def sourcedb_search(request):
+    '''stream deduplicated results of searching sourceDBs for GET q, one
+    JSON object per line, each source's as soon as it answers.  GET
+    sources is a comma-separated list of sourceDBs to search.'''
+    from fsm.registry import plugin_registry
+    sourceDBs = SOURCEDB_SEARCH_SOURCES
+    if request.GET.get('sources'):
+        known = plugin_registry.get_sourceDB_names()
+        sourceDBs = [sourceDB for sourceDB in request.GET['sources'].split(',')
+                     if sourceDB in known]
+    search = SourceDBSearch(request.GET.get('q', ''), sourceDBs)
+    response = StreamingHttpResponse(_sourcedb_stream(search),
+                                     content_type='application/x-ndjson')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # tell nginx not to buffer
+    return response
+
 
 ## def edit_concept(request, course_id, unit_id, ul_id,
 ##                  tabsFunc=concept_tabs):
@@ -909,15 +976,11 @@ def ul_teach(request, course_id, unit_id, ul_id):
                                          False)
     addForm = roleForm = answer = None
     if pageData.fsmStack.state and pageData.fsmStack.state.isLiveSession:
-        query = Q(unitLesson=ul, activity=pageData.fsmStack.state.activity,
-                  selfeval__isnull=False, kind=Response.ORCT_RESPONSE)
-        n = pageData.fsmStack.state.linkChildren.count() # livesession students
-        statusTable, evalTable, n = Response.get_counts(query, n=n)
+        statusTable, evalTable, n = ResponseTally.get_counts(
+                pageData.fsmStack.state.activity_id, ul)
         answer = ul.get_answers().all()[0]
     else: # default: all responses w/ selfeval
-        query = Q(unitLesson=ul, selfeval__isnull=False,
-                  kind=Response.ORCT_RESPONSE)
-        statusTable, evalTable, n = Response.get_counts(query)
+        statusTable, evalTable, n = UnitLessonStats.get_counts(ul)
     if ul.unit == unit: # ul is part of this unit
         if request.method == 'POST':
             roleForm = LessonRoleForm('', request.POST)
@@ -971,11 +1034,9 @@ def live_question(request, course_id, unit_id, ul_id):
         startForm = push_button(request)
         if not startForm:
             pageData.set_refresh_timer(request) # start the timer
-    query = Q(unitLesson=ul, activity=pageData.fsmStack.state.activity,
-              kind=Response.ORCT_RESPONSE)
-    n = pageData.fsmStack.state.linkChildren.count() # live session students
-    statusTable = Response.get_counts(query, n=n, tableKey='confidence',
-                    simpleTable=True, title='Student Responses')[0]
+    statusTable = ResponseTally.get_counts(pageData.fsmStack.state.activity_id,
+                    ul, tableKey='confidence', simpleTable=True,
+                    title='Student Responses')[0]
     return pageData.render(request, 'ct/lesson.html',
                   dict(unitLesson=ul, unit=unit, statusTable=statusTable,
                        startForm=startForm), addNextButton=True)
@@ -985,18 +1046,21 @@ def live_question(request, course_id, unit_id, ul_id):
 def ul_tasks(request, course_id, unit_id, ul_id):
     'suggest next steps on this question'
     unit, ul, _, pageData = ul_page_data(request, unit_id, ul_id, 'Tasks')
-    newInquiries = list(ul.get_new_inquiries())
+    query = Q(unitLesson=ul)
     if ul.lesson.kind == Lesson.ORCT_QUESTION:
         pageData.isQuestion = True
-        errorModels = list(ul.get_errors())
-        for em in errorModels:
-            newInquiries += list(em.get_new_inquiries())
-        for em in ul.get_answers():
-            newInquiries += list(em.get_new_inquiries())
-        errorTable = [(em, len(em.get_em_resolutions()[1]))
-                      for em in errorModels]
+        query |= Q(unitLesson__parent=ul, unitLesson__kind__in=(
+            UnitLesson.MISUNDERSTANDS, UnitLesson.ANSWERS))
+        errorModels = list(ul.get_errors().select_related('lesson'))
+        nres = dict(UnitLesson.objects.filter(parent__in=errorModels,
+                                              kind=UnitLesson.RESOLVES)
+                    .values_list('parent').annotate(c=Count('id')))
+        errorTable = [(em, nres.get(em.pk, 0)) for em in errorModels]
     else:
         errorTable = ()
+    newInquiries = Response.objects.filter(query, kind=Response.STUDENT_QUESTION,
+                                           needsEval=True) \
+        .select_related('author', 'unitLesson__lesson').order_by('atime')
     return pageData.render(request, 'ct/ul_tasks.html',
                   dict(unitLesson=ul, unit=unit, errorTable=errorTable,
                        newInquiries=newInquiries))
@@ -1056,12 +1120,11 @@ def copy_error_ul(ul, concept, unit, addedBy, parentUL):
 @login_required
 def ul_errors(request, course_id, unit_id, ul_id, showNETable=True):
     unit, ul, _, pageData = ul_page_data(request, unit_id, ul_id, 'Errors')
-    n = Response.objects.filter(unitLesson=ul,
-                                selfeval__isnull=False).count()
+    stats = UnitLessonStats.get_dict(ul)
+    n = stats.get('assessed', 0)
     showNovelErrors = False
     if n > 0:
-        query = Q(response__unitLesson=ul, response__selfeval__isnull=False)
-        seTable = StudentError.get_counts(query, n)
+        seTable = UnitLessonStats.get_error_counts(stats, n)
     else:
         seTable = []
     if n > 0 and showNETable:
@@ -1215,14 +1278,7 @@ def unit_tasks_student(request, course_id, unit_id):
     unit = get_object_or_404(Unit, pk=unit_id)
     pageData = PageData(request, title=unit.title,
                         navTabs=unit_tabs_student(request.path, 'Tasks'))
-    taskTable = [(ul, 'start')
-                 for ul in unit.get_unanswered_uls(request.user)]
-    taskTable += [(ul, 'selfeval')
-                  for ul in unit.get_selfeval_uls(request.user)]
-    taskTable += [(ul, 'classify')
-                  for ul in unit.get_serrorless_uls(request.user)]
-    taskTable += [(ul, 'resolve')
-                  for ul in unit.get_unresolved_uls(request.user)]
+    taskTable = StudentTasks(request.user, unit).get_task_table()
     return pageData.render(request, 'ct/unit_tasks_student.html',
                            dict(unit=unit, taskTable=taskTable))
 
@@ -1308,19 +1364,10 @@ def ul_tasks_student(request, course_id, unit_id, ul_id):
     responseTable = []
     if ul.lesson.kind == Lesson.ORCT_QUESTION:
         pageData.isQuestion = True
-        for r in ul.response_set.filter(author=request.user).order_by('atime'):
-            pageData.isAnswered = True
-            step = r.get_next_step()
-            if step and (r.kind == Response.ORCT_RESPONSE or
-                         step == Response.CLASSIFY_STEP):
-                responseTable.append((r, step[0], step[1]))
-            ## else:
-            ##     responseTable.append((r, None, None))
-        d = {}
-        for se in StudentError.get_ul_errors(ul,
-                response__author=request.user).exclude(status=DONE_STATUS):
-            d[se.errorModel] = se
-        errorTable = d.values()
+        tasks = StudentTasks(request.user, unitLesson=ul)
+        pageData.isAnswered = bool(tasks.responses)
+        responseTable = tasks.get_response_table()
+        errorTable = tasks.get_error_table()
     else:
         pageData.isQuestion = errorTable = False
     return pageData.render(request, 'ct/lesson_tasks.html',
@@ -1335,8 +1382,8 @@ def ul_errors_student(request, course_id, unit_id, ul_id):
 def study_concept(request, course_id, unit_id, ul_id):
     unit, ul, concept, pageData = ul_page_data(request, unit_id, ul_id,
                                                'Study')
-    defsTable = distinct_subset(UnitLesson.objects
-        .filter(lesson__concept=concept).exclude(treeID=ul.treeID))
+    defsTable = UnitLesson.objects.filter(lesson__concept=concept) \
+        .exclude(treeID=ul.treeID).distinct_trees()
     return pageData.render(request, 'ct/concept_student.html',
                            dict(unitLesson=ul, defsTable=defsTable))
 
@@ -1358,7 +1405,7 @@ def resolutions_student(request, course_id, unit_id, ul_id):
     concepts = UnitLesson.objects.filter(kind=UnitLesson.COMPONENT,
         lesson__concept__relatedFrom__fromConcept=em,
         lesson__concept__relatedFrom__relationship=ConceptGraph.MISUNDERSTANDS)
-    for conceptUL in distinct_subset(concepts):
+    for conceptUL in concepts.distinct_trees():
         lessonTable.append(conceptUL)
     try:
         se = ul.studenterror_set.filter(author=request.user) \
@@ -1447,9 +1494,18 @@ def save_response(form, ul, user, course_id, **kwargs):
     r.author = user
     for k,v in kwargs.items():
         setattr(r, k, v)
-    r.save()
+    with transaction.atomic(): # response and its live tallies together
+        r.save()
+        ResponseTally.count_response(r)
     return r
 
+def publish_live_counts(pageData):
+    'tell live session instructor (if any) that response counts changed'
+    state = pageData.fsmStack.state
+    if state and state.linkState_id: # not the students, who don't need it
+        live_channel.publish((state.linkState_id, INSTRUCTOR_CHANNEL),
+                             'counts')
+
 @login_required
 def ul_respond(request, course_id, unit_id, ul_id):
     'ask student a question'
@@ -1463,6 +1519,7 @@ def ul_respond(request, course_id, unit_id, ul_id):
                        pageData.fsmStack.state.activity
             r = save_response(form, ul, request.user, course_id,
                               activity=activity)
+            publish_live_counts(pageData)
             kwargs = dict(course_id=course_id, unit_id=unit_id, ul_id=ul_id,
                           resp_id=r.id)
             defaultURL = reverse('ct:assess', kwargs=kwargs)
@@ -1472,7 +1529,7 @@ def ul_respond(request, course_id, unit_id, ul_id):
         form = ResponseForm()
     set_crispy_action(request.path, form)
     return pageData.render(request, 'ct/ask.html',
-                  dict(unitLesson=ul, qtext=md2html(ul.lesson.text), form=form))
+                  dict(unitLesson=ul, qtext=ul.lesson.get_html(), form=form))
 
 def get_answer_html(unitLesson):
     'get HTML text for answer associated with this lesson, if any'
@@ -1481,7 +1538,7 @@ def get_answer_html(unitLesson):
     except IndexError:
         return '(author has not provided an answer)'
     else:
-        return md2html(answer.lesson.text)
+        return answer.lesson.get_html()
 
 
 @login_required
@@ -1492,9 +1549,13 @@ def assess(request, course_id, unit_id, ul_id, resp_id):
     if request.method == 'POST':
         form = SelfAssessForm(request.POST)
         if form.is_valid():
+            old = (r.confidence, r.selfeval, r.status)
             r.selfeval = form.cleaned_data['selfeval']
             r.status = form.cleaned_data['status']
-            r.save()
+            with transaction.atomic(): # response and its live tallies together
+                r.save()
+                ResponseTally.count_response(r, old)
+            publish_live_counts(pageData)
             if form.cleaned_data['liked']:
                 liked = Liked(unitLesson=r.unitLesson,
                               addedBy=request.user)
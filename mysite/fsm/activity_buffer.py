@@ -0,0 +1,233 @@
+"""
+Write-behind buffer for FSM ActivityEvent logging.
+
+With ``FSM_ACTIVITY_LOGGING = 'buffered'``, FSMState records node entry
+and exit as plain dicts appended to an in-process queue instead of
+inserting / updating ActivityEvent rows on the request path.  A daemon
+thread flushes the queue every FSM_ACTIVITY_FLUSH_INTERVAL seconds, or
+as soon as it holds FSM_ACTIVITY_FLUSH_SIZE records:
+
+* an exit that arrives before its entry was flushed is merged into it,
+  so the usual enter / leave pair costs a single bulk-inserted row;
+* other exits become one UPDATE each, matched by ActivityEvent.bufferKey.
+  An exit whose entry is not in the db yet (e.g. it is still queued in
+  another worker process) is retried on the next EXIT_RETRIES flushes.
+
+Records that cannot be written are appended to FSM_ACTIVITY_SPILL_FILE
+(one JSON record per line) and replayed by the next flush in any process,
+e.g. the flush_activity_log Celery task.
+
+The default mode, 'sync', keeps the original immediate writes.
+"""
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.utils import timezone
+
+
+# 'sync' (write immediately) or 'buffered'
+FSM_ACTIVITY_LOGGING = getattr(settings, 'FSM_ACTIVITY_LOGGING', 'sync')
+
+# max seconds a record waits in the buffer
+FSM_ACTIVITY_FLUSH_INTERVAL = getattr(settings, 'FSM_ACTIVITY_FLUSH_INTERVAL', 5.)
+
+# flush early once this many records are buffered
+FSM_ACTIVITY_FLUSH_SIZE = getattr(settings, 'FSM_ACTIVITY_FLUSH_SIZE', 200)
+
+# where records that could not be written are kept for replay
+FSM_ACTIVITY_SPILL_FILE = getattr(
+    settings, 'FSM_ACTIVITY_SPILL_FILE',
+    os.path.join(tempfile.gettempdir(), 'fsm_activity_spill.jsonl')
+)
+
+# flushes to wait for the entry row of an exit before dropping it
+EXIT_RETRIES = 5
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+LOGGER = logging.getLogger('fsm_activity')
+
+
+def dump_time(t):
+    return timezone.make_naive(t, timezone.utc).strftime(TIME_FORMAT) \
+        if timezone.is_aware(t) else t.strftime(TIME_FORMAT)
+
+
+def load_time(s):
+    t = datetime.strptime(s, TIME_FORMAT)
+    return timezone.make_aware(t, timezone.utc) if settings.USE_TZ else t
+
+
+class ActivityBuffer(object):
+    """
+    Thread-safe queue of ActivityEvent records, flushed in bulk.
+    """
+    def __init__(self, enabled=(FSM_ACTIVITY_LOGGING == 'buffered'),
+                 interval=FSM_ACTIVITY_FLUSH_INTERVAL,
+                 size=FSM_ACTIVITY_FLUSH_SIZE,
+                 spillFile=FSM_ACTIVITY_SPILL_FILE, background=True):
+        self.enabled = enabled
+        self.background = background  # flush from a daemon thread?
+        self.interval = interval
+        self.size = size
+        self.spillFile = spillFile
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._records = []
+        self._thread = None
+
+    def log_entry(self, activityID, userID, nodeName, unitLessonID=None):
+        """
+        Queue entry to a node; returns key to pass to log_exit().
+        """
+        key = uuid.uuid4().hex
+        self._append(dict(
+            op='entry', key=key, activity=activityID, user=userID,
+            nodeName=nodeName, unitLesson=unitLessonID,
+            startTime=dump_time(timezone.now()),
+        ))
+        return key
+
+    def log_exit(self, key, eventName):
+        """
+        Queue exit (via eventName) from the node entry logged as key.
+        """
+        self._append(dict(op='exit', key=key, exitEvent=eventName,
+                          endTime=dump_time(timezone.now())))
+
+    def _append(self, record):
+        with self._lock:
+            if self._pid != os.getpid():  # forked: parent flushes its own
+                self._reset()
+            self._records.append(record)
+            if self._thread is None and self.background:
+                self._thread = threading.Thread(target=self._run,
+                                                name='fsm-activity-flush')
+                self._thread.daemon = True
+                self._thread.start()
+            if len(self._records) >= self.size:
+                self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait(self.interval)
+            try:
+                close_old_connections()  # drop broken / expired db connection
+                self.flush()
+            except Exception:  # never let the flusher thread die
+                LOGGER.exception('activity log flush failed')
+
+    def flush(self):
+        """
+        Write all buffered (and previously spilled) records to the db.
+        Returns number of records written.
+        """
+        with self._flushLock:
+            with self._lock:
+                records, self._records = self._records, []
+            spilled, claimed = self._read_spill()
+            records = spilled + records
+            if not records:
+                return 0
+            try:
+                retry = self.write(records)
+            except Exception:
+                LOGGER.exception('cannot write activity log, spilling %d records',
+                                 len(records))
+                from fsm.models import ActivityLog
+                ActivityLog.clear_cache()  # in case a cached log was deleted
+                self._spill(records)
+                if claimed:
+                    os.remove(claimed)
+                return 0
+            if claimed:  # its records are now in the db
+                os.remove(claimed)
+            for r in retry:
+                if r['retries'] > EXIT_RETRIES:
+                    LOGGER.warning('dropping exit %s: entry never logged', r['key'])
+            retry = [r for r in retry if r['retries'] <= EXIT_RETRIES]
+            with self._lock:
+                self._records[:0] = retry
+            return len(records) - len(retry)
+
+    def write(self, records):
+        """
+        Store records in one transaction; returns exit records whose
+        entry row does not exist yet.
+        """
+        from fsm.models import ActivityEvent
+        entries = {}
+        exits = []
+        for record in records:
+            if record['op'] == 'entry':
+                entries[record['key']] = record
+            elif record['key'] in entries:  # merge exit into pending entry
+                entries[record['key']].update(exitEvent=record['exitEvent'],
+                                              endTime=record['endTime'])
+            else:
+                exits.append(record)
+        retry = []
+        with transaction.atomic():
+            ActivityEvent.objects.bulk_create([
+                ActivityEvent(
+                    bufferKey=r['key'], activity_id=r['activity'], user_id=r['user'],
+                    nodeName=r['nodeName'], unitLesson_id=r['unitLesson'],
+                    startTime=load_time(r['startTime']),
+                    exitEvent=r.get('exitEvent', ''),
+                    endTime=load_time(r['endTime']) if r.get('endTime') else None,
+                ) for r in entries.values()
+            ])
+            for r in exits:
+                if not ActivityEvent.objects.filter(bufferKey=r['key']).update(
+                        exitEvent=r['exitEvent'], endTime=load_time(r['endTime'])):
+                    r['retries'] = r.get('retries', 0) + 1
+                    retry.append(r)
+        return retry
+
+    def _spill(self, records):
+        with open(self.spillFile, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def _read_spill(self):
+        'take over records from the spill file, as (records, claimed path)'
+        if not self.spillFile or not os.path.exists(self.spillFile):
+            return [], None
+        claimed = '%s.%d.%d' % (self.spillFile, os.getpid(), int(time.time()))
+        try:
+            os.rename(self.spillFile, claimed)  # atomic vs. other processes
+        except OSError:
+            return [], None
+        with open(claimed) as f:
+            return [json.loads(line) for line in f if line.strip()], claimed
+
+    def pending(self):
+        'number of records waiting in this process'
+        return len(self._records)
+
+
+activity_buffer = ActivityBuffer()
+
+
+@atexit.register
+def _flush_at_exit():
+    if activity_buffer.pending():
+        try:
+            activity_buffer.flush()
+        except Exception:
+            LOGGER.exception('activity log flush at exit failed')
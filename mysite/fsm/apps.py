@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class FSMConfig(AppConfig):
+    """
+    Discover FSM / sourceDB plugins once all models are loaded.
+    """
+    name = 'fsm'
+
+    def ready(self):
+        from fsm.registry import plugin_registry
+        plugin_registry.discover()
@@ -0,0 +1,150 @@
+"""
+Process-wide compiled catalog of FSM graphs.
+
+An FSM's nodes and edges never change once FSM.save_graph() has stored
+them (a redeploy creates a new FSM row instead), so each FSM is loaded
+once per process into a CompiledFSM holding node-by-name and
+edge-by-(node, name) maps with plugins already resolved.  Transitions,
+stack setup and the FSM launcher menu then run without graph queries.
+
+The name -> FSM and group -> FSM lists do change on redeploy, so the
+whole catalog is dropped whenever the shared stamp in the Django cache
+changes; FSMCatalog.invalidate() bumps it (save_graph() calls it, as do
+save / delete signals on the graph models).
+"""
+import threading
+import uuid
+
+from django.core.cache import cache
+
+
+CATALOG_STAMP_KEY = 'fsm_catalog_stamp'
+
+
+class CompiledFSM(object):
+    """
+    One FSM with its nodes and edges, loaded with two queries.
+    """
+    def __init__(self, fsm):
+        from fsm.models import FSMNode, FSMEdge
+        self.fsm = fsm
+        self.nodes = {}  # by name
+        self.nodesByID = {}
+        self.outgoing = {}  # node pk -> [edge, ...]
+        self.edges = {}  # (node pk, edge name) -> edge
+        for node in FSMNode.objects.filter(fsm=fsm):
+            node.fsm = fsm
+            if node.funcName:  # resolve plugin now, not on first event
+                node._plugin
+            self.nodes[node.name] = node
+            self.nodesByID[node.pk] = node
+            self.outgoing[node.pk] = []
+        for edge in FSMEdge.objects.filter(fromNode__fsm=fsm).order_by('pk'):
+            edge.fromNode = self.nodesByID[edge.fromNode_id]
+            edge.toNode = self.nodesByID[edge.toNode_id]
+            self.outgoing[edge.fromNode_id].append(edge)
+            self.edges[(edge.fromNode_id, edge.name)] = edge
+        if fsm.startNode_id:
+            fsm.startNode = self.nodesByID[fsm.startNode_id]
+
+
+class FSMCatalog(object):
+    """
+    Lazily filled cache of CompiledFSM objects, by FSM pk.
+
+    The model instances it hands out are shared by all requests in this
+    process, so callers must treat them as read-only.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._reset()
+
+    def _reset(self):
+        self._graphs = {}  # FSM pk -> CompiledFSM
+        self._nodeFSM = {}  # FSMNode pk -> FSM pk
+        self._names = {}  # FSM name -> FSM pk
+        self._groups = {}  # FSMGroup.group -> [FSM pk, ...]
+
+    def _check_stamp(self):
+        'drop everything if the graph models changed since we loaded'
+        stamp = cache.get(CATALOG_STAMP_KEY)
+        if stamp is None:  # first use, or evicted from cache
+            cache.add(CATALOG_STAMP_KEY, uuid.uuid4().hex, None)
+            stamp = cache.get(CATALOG_STAMP_KEY)
+        if stamp != self._stamp:
+            self._reset()
+            self._stamp = stamp
+
+    def invalidate(self):
+        'force all processes to reload FSM graphs'
+        with self._lock:
+            cache.set(CATALOG_STAMP_KEY, uuid.uuid4().hex, None)
+            self._reset()
+            self._stamp = None
+
+    def _load(self, fsm):
+        graph = CompiledFSM(fsm)
+        self._graphs[fsm.pk] = graph
+        self._names[fsm.name] = fsm.pk
+        for nodeID in graph.nodesByID:
+            self._nodeFSM[nodeID] = fsm.pk
+        return graph
+
+    def get_graph(self, fsmID):
+        'get CompiledFSM for FSM pk; raises FSM.DoesNotExist'
+        from fsm.models import FSM
+        with self._lock:
+            self._check_stamp()
+            try:
+                return self._graphs[fsmID]
+            except KeyError:
+                return self._load(FSM.objects.get(pk=fsmID))
+
+    def get_fsm(self, name):
+        'get FSM (with startNode) by name; raises FSM.DoesNotExist'
+        from fsm.models import FSM
+        with self._lock:
+            self._check_stamp()
+            try:
+                return self._graphs[self._names[name]].fsm
+            except KeyError:
+                return self._load(FSM.objects.get(name=name)).fsm
+
+    def get_node(self, nodeID):
+        'get FSMNode by pk; raises FSMNode.DoesNotExist'
+        from fsm.models import FSMNode
+        with self._lock:
+            self._check_stamp()
+            try:
+                fsmID = self._nodeFSM[nodeID]
+            except KeyError:
+                fsmID = FSMNode.objects.values_list('fsm_id', flat=True) \
+                    .get(pk=nodeID)
+            return self.get_graph(fsmID).nodesByID[nodeID]
+
+    def get_outgoing(self, nodeID):
+        'get list of edges leaving the specified node'
+        node = self.get_node(nodeID)
+        return self.get_graph(node.fsm_id).outgoing[nodeID]
+
+    def get_edge(self, nodeID, name):
+        'get named edge leaving the specified node, or None'
+        node = self.get_node(nodeID)
+        return self.get_graph(node.fsm_id).edges.get((nodeID, name))
+
+    def get_group(self, groupName):
+        'get list of FSMs registered in the named launcher group'
+        from fsm.models import FSM
+        with self._lock:
+            self._check_stamp()
+            try:
+                fsmIDs = self._groups[groupName]
+            except KeyError:
+                fsmIDs = self._groups[groupName] = list(
+                    FSM.objects.filter(fsmgroup__group=groupName)
+                    .values_list('pk', flat=True))
+            return [self.get_graph(fsmID).fsm for fsmID in fsmIDs]
+
+
+fsm_catalog = FSMCatalog()
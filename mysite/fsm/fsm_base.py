@@ -7,7 +7,8 @@ FSMStack methods:
   * ``resume`` - resume an orphaned activity
   * ``get_current_url`` - get URL for resuming at current FSM state
 """
-from fsm.models import FSM, FSMState, FSMBadUserError, FSMStackResumeError
+from fsm.models import FSMState, FSMBadUserError, FSMStackResumeError
+from fsm.catalog import fsm_catalog
 
 
 class FSMStack(object):
@@ -21,13 +22,13 @@ class FSMStack(object):
             self.state = None
             return
         try:
-            self.state = FSMState.objects.select_related('fsmNode')\
-                             .prefetch_related('fsmNode__outgoing').get(pk=fsmID)
+            self.state = FSMState.objects.get(pk=fsmID)
         except FSMState.DoesNotExist:
             del request.session['fsmID']
             self.state = None
             return
-        for edge in self.state.fsmNode.outgoing.all():  # detect selection edges
+        self.state.fsmNode = fsm_catalog.get_node(self.state.fsmNode_id)
+        for edge in self.state.fsmNode.get_outgoing():  # detect selection edges
             if edge.name.startswith('select_'):
                 setattr(self, edge.name, edge)  # make available to HTML templates
 
@@ -62,7 +63,7 @@ class FSMStack(object):
         """
         stateData = stateData or {}
         startArgs = startArgs or {}
-        fsm = FSM.objects.select_related('startNode').get(name=fsmName)
+        fsm = fsm_catalog.get_fsm(fsmName)
         if not activity and self.state:
             activity = self.state.activity
         self.state = FSMState(
@@ -102,6 +103,7 @@ class FSMStack(object):
             raise FSMBadUserError('user mismatch!!')
         elif state.children.count() > 0:
             raise FSMStackResumeError('can only resume innermost stack level')
+        state.fsmNode = fsm_catalog.get_node(state.fsmNode_id)
         self.state = state
         request.session['fsmID'] = self.state.pk
         return self.get_current_url()
@@ -1,4 +1,12 @@
-from fsm.models import FSM
+import hashlib
+import json
+
+from fsm.models import FSM, FSMEdge
+
+
+# attributes compared by FSMSpecification.diff()
+NODE_ATTRS = ('title', 'description', 'help', 'path', 'data', 'funcName', 'doLogging')
+EDGE_ATTRS = ('toNode', 'title', 'description', 'help', 'showOption', 'data')
 
 
 class FSMSpecification(object):
@@ -34,6 +42,17 @@ class FSMSpecification(object):
                 edges.append(edge)
         self.nodeData = nodeDict
         self.edgeData = edges
+        self.specHash = self.get_hash()
+
+    def get_hash(self):
+        """
+        Get hex digest of this FSM specification's content.
+        """
+        edges = sorted(self.edgeData, key=lambda e: (e['fromNode'], e['name']))
+        spec = dict(fsm=self.fsmData, nodes=self.nodeData, edges=edges,
+                    groups=sorted(self.fsmGroups))
+        s = json.dumps(spec, sort_keys=True, default=repr)
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
 
     def save_graph(self, *args, **kwargs):
         """
@@ -44,10 +63,74 @@ class FSMSpecification(object):
             self.nodeData,
             self.edgeData,
             fsmGroups=self.fsmGroups,
+            specHash=self.specHash,
             *args,
             **kwargs
         )
 
+    def get_deployed(self):
+        """
+        Get the FSM currently deployed under this name, or None.
+        """
+        try:
+            return FSM.objects.get(name=self.fsmData['name'])
+        except FSM.DoesNotExist:
+            return None
+
+    def diff(self, fsm=None):
+        """
+        List differences between this spec and the deployed FSM, as
+        strings; empty list if it is up to date.
+        """
+        if fsm is None:
+            fsm = self.get_deployed()
+        if fsm is None:
+            return ['new FSM']
+        if fsm.specHash == self.specHash:
+            return []
+        lines = []
+        for attr, value in sorted(self.fsmData.items()):
+            if getattr(fsm, attr) != value:
+                lines.append('~ FSM %s: %r -> %r' % (attr, getattr(fsm, attr), value))
+        groups = set(fsm.fsmgroup_set.values_list('group', flat=True))
+        for group in sorted(set(self.fsmGroups) - groups):
+            lines.append('+ group %s' % group)
+        for group in sorted(groups - set(self.fsmGroups)):
+            lines.append('- group %s' % group)
+        nodes = dict((node.name, node) for node in fsm.fsmnode_set.all())
+        lines += _diff_dict(
+            'node', nodes, self.nodeData, NODE_ATTRS, lambda node, attr: getattr(node, attr)
+        )
+        edges = dict(((edge.fromNode.name, edge.name), edge) for edge in
+                     FSMEdge.objects.filter(fromNode__fsm=fsm).select_related('fromNode', 'toNode'))
+        edgeData = dict(((e['fromNode'], e['name']), e) for e in self.edgeData)
+        lines += _diff_dict(
+            'edge', edges, edgeData, EDGE_ATTRS,
+            lambda edge, attr: edge.toNode.name if attr == 'toNode' else getattr(edge, attr)
+        )
+        if not lines:  # e.g. deployed before spec hashes were stored
+            lines.append('~ content unchanged, spec hash not stored')
+        return lines
+
+
+def _diff_dict(label, dbObjs, specData, attrs, getAttr):
+    """
+    List added / removed / modified items of specData vs. dbObjs.
+    """
+    lines = []
+    for key in sorted(set(specData) | set(dbObjs)):
+        name = key if isinstance(key, basestring) else '.'.join(key)
+        if key not in dbObjs:
+            lines.append('+ %s %s' % (label, name))
+        elif key not in specData:
+            lines.append('- %s %s' % (label, name))
+        else:
+            for attr in attrs:
+                value = specData[key].get(attr, None)
+                if (value or None) != (getAttr(dbObjs[key], attr) or None):  # '' == None
+                    lines.append('~ %s %s: %s' % (label, name, attr))
+    return lines
+
 
 class CallerNode(object):
     """
@@ -61,27 +144,49 @@ class CallerNode(object):
         return edge.toNode
 
 
-def deploy(mod_path, username):
+def load_specs(mod_path):
     """
-    Load FSM specifications found in the specified plugin module.
+    Get list of FSM specifications from the specified plugin module.
     """
     import importlib
     mod = importlib.import_module(mod_path)
+    return mod.get_specs()
+
+
+def find_modules(ignore=('testme', '__init__'), pattern='*/fsm_plugin/*.py'):
+    """
+    Get list of module paths found via pattern but not ignore.
+    """
+    import glob
+    modpaths = []
+    for modpath in sorted(glob.glob(pattern)):
+        splitted_path = modpath[:-3].split('/')
+        if splitted_path[-1] not in ignore:
+            modpaths.append('.'.join(splitted_path))
+    return modpaths
+
+
+def deploy(mod_path, username, force=False):
+    """
+    Load FSM specifications found in the specified plugin module.
+
+    Specs whose content is unchanged since they were last deployed are
+    skipped (unless force); returns list of newly deployed FSMs.
+    """
+    deployed = dict(FSM.objects.values_list('name', 'specHash'))
     fsm_list = []
-    for fsmSpec in mod.get_specs():
-        fsm_list.append(fsmSpec.save_graph(username))
+    for fsmSpec in load_specs(mod_path):
+        if force or deployed.get(fsmSpec.fsmData['name']) != fsmSpec.specHash:
+            fsm_list.append(fsmSpec.save_graph(username))
     return fsm_list
 
 
 def deploy_all(username, ignore=('testme', '__init__'),
-               pattern='*/fsm_plugin/*.py'):
+               pattern='*/fsm_plugin/*.py', force=False):
     """
     Load all FSM specifications found via pattern but not ignore.
     """
-    import glob
     fsm_list = []
-    for modpath in glob.glob(pattern):
-        splitted_path = modpath[:-3].split('/')
-        if splitted_path[-1] not in ignore:
-            fsm_list.extend(deploy('.'.join(splitted_path), username))
+    for modpath in find_modules(ignore, pattern):
+        fsm_list.extend(deploy(modpath, username, force))
     return fsm_list
@@ -0,0 +1,179 @@
+"""
+Server-push channel for live classroom sessions.
+
+Each instructor FSMState with isLiveSession has two channels: the
+session channel, identified by the state's pk, tells everyone in the
+session about instructor transitions, and the instructor channel,
+identified by (state pk, INSTRUCTOR_CHANNEL), tells just the instructor
+that response counts changed.  publish() records the latest event in
+the LiveEvent table (one row per channel, with a version counter) and
+wakes up every waiter in this process at once.  wait() returns as soon
+as the channel version exceeds the version the client last saw.  Waiters
+in this process are woken directly; events published by other worker
+processes are picked up by re-reading the LiveEvent row every
+LIVE_CHANNEL_POLL_INTERVAL seconds, once for all the waiters on that
+channel in this process.
+
+Clients reach it via the fsm:live_events view (long-poll JSON, or
+Server-Sent Events).  Each waiting client holds a connection for up to
+LIVE_CHANNEL_TIMEOUT seconds, so it is served by gevent workers (see
+mysite/gunicorn_conf.py); waiters do not hold a db connection meanwhile.
+"""
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+
+
+# seconds a client request may wait for an event
+LIVE_CHANNEL_TIMEOUT = getattr(settings, 'LIVE_CHANNEL_TIMEOUT', 25.)
+
+# seconds between db checks for events published by other processes
+LIVE_CHANNEL_POLL_INTERVAL = getattr(settings, 'LIVE_CHANNEL_POLL_INTERVAL', 2.)
+
+# channel names of a live session: its session channel, for everyone in
+# the session, and its instructor channel, for the instructor only
+SESSION_CHANNEL = ''
+INSTRUCTOR_CHANNEL = 'instructor'
+
+_lock = threading.Lock()
+
+
+def channel_key(channelID):
+    '''get (state pk, channel name) of channelID, which is either the
+    instructor FSMState pk (its session channel) or such a pair'''
+    if isinstance(channelID, tuple):
+        return channelID
+    return channelID, SESSION_CHANNEL
+
+
+def release_db():
+    'close our db connection while we wait, unless in a transaction'
+    if not connection.in_atomic_block:
+        connection.close()
+
+
+class LiveMessage(object):
+    """
+    One channel event, as seen by clients.
+    """
+    def __init__(self, version, event, data=None):
+        self.version = version
+        self.event = event
+        self.data = data or {}
+
+    def as_dict(self):
+        return dict(version=self.version, event=self.event, data=self.data)
+
+
+class LiveChannel(object):
+    """
+    In-process pub/sub of live-session events, backed by LiveEvent rows.
+    """
+    def __init__(self, pollInterval=LIVE_CHANNEL_POLL_INTERVAL):
+        self.pollInterval = pollInterval
+        self._pid = None
+        self._init_process()
+
+    def _init_process(self):
+        '''(re)create our in-process state in a new process: gunicorn
+        imports us in its master, before forking the workers and before
+        gevent patches their threading module'''
+        with _lock:
+            if self._pid != os.getpid():
+                self._cond = threading.Condition()
+                self._last = {}  # channel key -> latest LiveMessage seen here
+                self._nextPoll = {}  # channel key -> time of next db check
+                self._pid = os.getpid()
+
+    def publish(self, channelID, event, **data):
+        """
+        Record event on channel and wake its waiters; returns LiveMessage.
+        """
+        from fsm.models import LiveEvent
+        self._init_process()
+        key = channel_key(channelID)
+        row = LiveEvent.objects.filter(state=key[0], channel=key[1])
+        blob = json.dumps(data)
+        with transaction.atomic():
+            if not row.update(version=F('version') + 1, event=event,
+                              data=blob):
+                try:
+                    with transaction.atomic():
+                        LiveEvent.objects.create(state_id=key[0],
+                                                 channel=key[1], version=1,
+                                                 event=event, data=blob)
+                except IntegrityError:  # created concurrently
+                    row.update(version=F('version') + 1, event=event,
+                               data=blob)
+            version = row.values_list('version', flat=True).get()
+        msg = LiveMessage(version, event, data)
+        with self._cond:
+            self._remember(key, msg)
+            self._cond.notify_all()
+        return msg
+
+    def _remember(self, key, msg):
+        last = self._last.get(key)
+        if last is None or msg.version > last.version:
+            self._last[key] = msg
+
+    def get_latest(self, channelID):
+        """
+        Get latest LiveMessage of channel from the db, or None.
+        """
+        from fsm.models import LiveEvent
+        self._init_process()
+        key = channel_key(channelID)
+        try:
+            row = LiveEvent.objects.get(state=key[0], channel=key[1])
+        except LiveEvent.DoesNotExist:  # forget channel of a deleted state
+            with self._cond:
+                self._last.pop(key, None)
+            return None
+        msg = LiveMessage(row.version, row.event, json.loads(row.data or '{}'))
+        with self._cond:  # the db is authoritative, even if version dropped
+            self._last[key] = msg
+        return msg
+
+    def wait(self, channelID, since=0, timeout=LIVE_CHANNEL_TIMEOUT):
+        """
+        Wait for a channel event newer than version since; returns the
+        latest LiveMessage, or None on timeout.
+        """
+        self._init_process()
+        key = channel_key(channelID)
+        deadline = time.time() + timeout
+        release_db()
+        while True:
+            now = time.time()
+            msg = self._poll(key, now)
+            if msg is not None and msg.version > since:
+                return msg
+            remaining = deadline - now
+            if remaining <= 0:
+                return None
+            with self._cond:
+                msg = self._last.get(key)
+                if msg is None or msg.version <= since:
+                    self._cond.wait(min(remaining, self._nextPoll[key] - now))
+
+    def _poll(self, key, now):
+        '''get latest LiveMessage of channel, from the db if no waiter in
+        this process has checked it in the last pollInterval seconds'''
+        with self._cond:
+            if now < self._nextPoll.get(key, 0):
+                return self._last.get(key)
+            self._nextPoll[key] = now + self.pollInterval
+        msg = self.get_latest(key)
+        release_db()
+        with self._cond:  # tell the other waiters what we found
+            self._cond.notify_all()
+        return msg
+
+
+live_channel = LiveChannel()
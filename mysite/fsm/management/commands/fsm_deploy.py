@@ -1,11 +1,12 @@
 import re
 import os
 import sys
+from optparse import make_option
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
-from fsm.fsmspec import deploy, deploy_all
+from fsm.fsmspec import deploy, deploy_all, find_modules, load_specs
 
 
 class Command(BaseCommand):
@@ -15,30 +16,58 @@ class Command(BaseCommand):
     that specification must be loaded to the database. Whenever the database table is flushed,
     the set of FSM specifications must be loaded.
     This command provides a convenient way to deploy|re-deploy FSM(s)
+    FSM(s) whose specification is unchanged since the last deploy are skipped.
     """
     help = 'Deploy all not ignored FSM(s)'
     args = 'APP.fsm_plugin.MODULENAME'
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report what would change, write nothing'),
+        make_option('--force', action='store_true', dest='force', default=False,
+                    help='Re-deploy FSM(s) even if unchanged'),
+    )
 
     def handle(self, *args, **options):
         os.chdir(settings.BASE_DIR)
         deployed = []
 
-        if len(args) == 0:
-            deployed += deploy_all('admin')
-        elif len(args) == 1:
-            if re.match(r'^.+\.fsm_plugin\..+$', args[0]):
-                try:
-                    deployed += deploy(args[0], 'admin')
-                except ImportError as err:
-                    self.stdout.write('FSM on path `%s` can\'t be imported.' % args[0])
-                    self.stderr.write('%s: %s' % (err.__class__.__name__, err))
-                    sys.exit(1)
-            else:
-                self.stdout.write('Please specify FSM path in form of `%s`.' % self.args)
-                self.stderr.write('Error: Specified path `%s` is incorrect.' % args[0])
-                sys.exit(1)
-        elif len(args) > 1:
+        if len(args) > 1:
             raise CommandError('Command doesn\'t accept more then one argument.')
+        elif len(args) == 1 and not re.match(r'^.+\.fsm_plugin\..+$', args[0]):
+            self.stdout.write('Please specify FSM path in form of `%s`.' % self.args)
+            self.stderr.write('Error: Specified path `%s` is incorrect.' % args[0])
+            sys.exit(1)
+
+        try:
+            if options['dry_run']:
+                return self.dry_run(args[0] if args else None, options['force'])
+            elif len(args) == 0:
+                deployed += deploy_all('admin', force=options['force'])
+            else:
+                deployed += deploy(args[0], 'admin', force=options['force'])
+        except ImportError as err:
+            self.stdout.write('FSM on path `%s` can\'t be imported.' % (args[0] if args else '*/fsm_plugin/*.py'))
+            self.stderr.write('%s: %s' % (err.__class__.__name__, err))
+            sys.exit(1)
 
         for fsm in deployed:
             self.stdout.write('FSM `%s` is deployed.' % fsm.name)
+        if not deployed:
+            self.stdout.write('All FSM(s) are up to date.')
+
+    def dry_run(self, modpath, force):
+        """
+        Print which FSM(s) would be deployed, and how they differ from the db.
+        """
+        for modpath in [modpath] if modpath else find_modules():
+            for fsmSpec in load_specs(modpath):
+                name = fsmSpec.fsmData['name']
+                lines = fsmSpec.diff()
+                if lines:
+                    self.stdout.write('FSM `%s` would be deployed:' % name)
+                    for line in lines:
+                        self.stdout.write('  ' + line)
+                elif force:
+                    self.stdout.write('FSM `%s` would be re-deployed (unchanged).' % name)
+                else:
+                    self.stdout.write('FSM `%s` is unchanged.' % name)
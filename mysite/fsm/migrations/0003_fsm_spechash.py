@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fsm', '0002_auto_20150723_0243'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fsm',
+            name='specHash',
+            field=models.CharField(max_length=40, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fsm', '0003_fsm_spechash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activityevent',
+            name='bufferKey',
+            field=models.CharField(max_length=32, null=True, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='fsmstate',
+            name='activityEventKey',
+            field=models.CharField(max_length=32, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fsm', '0004_activity_buffer_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LiveEvent',
+            fields=[
+                ('state', models.OneToOneField(related_name='+', primary_key=True, serialize=False, to='fsm.FSMState')),
+                ('version', models.IntegerField(default=0)),
+                ('event', models.CharField(max_length=32)),
+                ('data', models.TextField(null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
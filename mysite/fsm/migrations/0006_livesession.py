@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+def register_live_sessions(apps, schema_editor):
+    'add registry entries for live sessions already running'
+    FSMState = apps.get_model('fsm', 'FSMState')
+    LiveSession = apps.get_model('fsm', 'LiveSession')
+    for state in FSMState.objects.filter(isLiveSession=True,
+                                         activity__course__isnull=False) \
+            .select_related('user', 'activity__course'):
+        course = state.activity.course
+        name = ('%s %s' % (state.user.first_name, state.user.last_name)).strip()
+        LiveSession.objects.create(
+            state=state, course=course, courseTitle=course.title,
+            instructorName=name, startTime=state.activity.startTime,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ct', '0019_responsetally'),
+        ('fsm', '0005_liveevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LiveSession',
+            fields=[
+                ('state', models.OneToOneField(related_name='+', primary_key=True, serialize=False, to='fsm.FSMState')),
+                ('courseTitle', models.CharField(max_length=200)),
+                ('instructorName', models.CharField(max_length=200)),
+                ('startTime', models.DateTimeField(default=django.utils.timezone.now)),
+                ('course', models.ForeignKey(to='ct.Course')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunPython(register_live_sessions),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def copy_events(apps, schema_editor):
+    'keep the versions of running sessions, as their session channels'
+    OldLiveEvent = apps.get_model('fsm', 'OldLiveEvent')
+    LiveEvent = apps.get_model('fsm', 'LiveEvent')
+    LiveEvent.objects.bulk_create([
+        LiveEvent(state_id=e.state_id, channel='', version=e.version,
+                  event=e.event, data=e.data)
+        for e in OldLiveEvent.objects.all()
+    ])
+
+
+def copy_events_back(apps, schema_editor):
+    OldLiveEvent = apps.get_model('fsm', 'OldLiveEvent')
+    LiveEvent = apps.get_model('fsm', 'LiveEvent')
+    OldLiveEvent.objects.bulk_create([
+        OldLiveEvent(state_id=e.state_id, version=e.version, event=e.event,
+                     data=e.data)
+        for e in LiveEvent.objects.filter(channel='')
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fsm', '0006_livesession'),
+    ]
+
+    operations = [
+        migrations.RenameModel('LiveEvent', 'OldLiveEvent'),
+        migrations.CreateModel(
+            name='LiveEvent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('channel', models.CharField(default='', max_length=16)),
+                ('version', models.IntegerField(default=0)),
+                ('event', models.CharField(max_length=32)),
+                ('data', models.TextField(null=True)),
+                ('state', models.ForeignKey(related_name='+', to='fsm.FSMState')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='liveevent',
+            unique_together=set([('state', 'channel')]),
+        ),
+        migrations.RunPython(copy_events, copy_events_back),
+        migrations.DeleteModel('OldLiveEvent'),
+    ]
@@ -1,11 +1,18 @@
+import copy
 import json
 
 from django.utils import timezone
 from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 
-from fsm.utils import get_plugin
+from fsm.registry import plugin_registry
+from fsm.catalog import fsm_catalog
+from fsm.activity_buffer import activity_buffer
+from fsm.live_channel import live_channel
 
 from ct.ct_util import reverse_path_args
 from ct.models import (
@@ -20,7 +27,8 @@ from ct.models import (
     UnitLesson,
     ConceptLink,
     StudentError,
-    ConceptGraph
+    ConceptGraph,
+    ResponseTally
 )
 
 
@@ -41,6 +49,89 @@ KLASS_NAME_DICT = dict(
 )
 
 
+class JSONRef(object):
+    """
+    Not yet loaded reference to a db object stored in a JSON blob.
+    """
+    def __init__(self, klassName, pk):
+        self.klassName = klassName
+        self.pk = pk
+
+    def __repr__(self):
+        return '<JSONRef %s %s>' % (self.klassName, self.pk)
+
+
+class JSONRefDict(dict):
+    """
+    Dict of JSON blob data whose db object references are loaded on demand.
+
+    Reading any JSONRef value loads every pending reference of the same
+    class with one in_bulk() query; the rest of the dict is untouched.
+    """
+    def resolve(self, klassName=None):
+        """
+        Replace pending references (of klassName, or all) by db objects.
+        """
+        pending = {}
+        for key, value in dict.items(self):
+            if isinstance(value, JSONRef) and klassName in (None, value.klassName):
+                pending.setdefault(value.klassName, []).append((key, value.pk))
+        for name, refs in pending.items():
+            klass = KLASS_NAME_DICT[name]
+            objs = klass.objects.in_bulk([pk for key, pk in refs])
+            for key, pk in refs:
+                try:
+                    dict.__setitem__(self, key, objs[pk])
+                except KeyError:
+                    raise klass.DoesNotExist('%s %s not found' % (name, pk))
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, JSONRef):
+            self.resolve(value.klassName)
+            value = dict.__getitem__(self, key)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *args):
+        if key in self:
+            self[key]  # load it first
+        return dict.pop(self, key, *args)
+
+    def values(self):
+        self.resolve()
+        return dict.values(self)
+
+    def items(self):
+        self.resolve()
+        return dict.items(self)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        self.resolve()
+        return dict(self)
+
+    def __eq__(self, other):
+        self.resolve()
+        if isinstance(other, JSONRefDict):
+            other.resolve()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self.resolve()
+        return dict.__repr__(self)
+
+
 class JSONBlobMixin(object):
     """
     Mixin to dump/load data to/from JSON blob fields.
@@ -61,8 +152,10 @@ class JSONBlobMixin(object):
         Get json representation of dict of db objects.
         """
         data = {}
-        for key, value in state_data.items():
-            if value.__class__.__name__ in KLASS_NAME_DICT:  # save db object id
+        for key, value in dict.items(state_data):  # don't load lazy refs
+            if isinstance(value, JSONRef):  # not loaded yet, just copy id
+                data['%s_%s_id' % (key, value.klassName)] = value.pk
+            elif value.__class__.__name__ in KLASS_NAME_DICT:  # save db object id
                 name, pk = self.dump_json_id(value, key)
                 data[name] = pk
             else:  # just copy literal value, assuming JSON can serialize it
@@ -96,23 +189,32 @@ class JSONBlobMixin(object):
         obj = KLASS_NAME_DICT[klass_name].objects.get(pk=pk)
         return (splitted_name[0], obj)
 
-    def load_json_id_dict(self, state_data):
+    def load_json_id_dict(self, state_data, lazy=False):
         """
         Get dict of db objects from json blob representation.
+
+        Objects are fetched with one in_bulk() query per class; if lazy,
+        each class is only fetched when one of its objects is first
+        accessed in the returned dict.
         """
         data = json.loads(state_data)
-        obj_dict = {}
+        obj_dict = JSONRefDict()
         for key, value in data.items():
-            if key.endswith('_id'):  # retrieve db object
-                name, obj = self.load_json_id(key, value)
-                obj_dict[name] = obj
+            if key.endswith('_id'):  # db object reference
+                splitted_name = key.split('_')
+                dict.__setitem__(obj_dict, splitted_name[0],
+                                 JSONRef(splitted_name[-2], value))
             else:  # just copy literal value
-                obj_dict[key] = value
+                dict.__setitem__(obj_dict, key, value)
+        if not lazy:
+            obj_dict.resolve()
         return obj_dict
 
     def load_json_data(self, attr='data'):
         """
         Get dict of db objects from json blob field.
+
+        db objects are loaded lazily, one query per class on first access.
         """
         dict_attr = '_%s_dict' % attr
         try:
@@ -121,7 +223,7 @@ class JSONBlobMixin(object):
             pass
         state_data = getattr(self, attr)
         if state_data:
-            obj_dict = self.load_json_id_dict(state_data)
+            obj_dict = self.load_json_id_dict(state_data, lazy=True)
         else:
             obj_dict = {}
         setattr(self, dict_attr, obj_dict)
@@ -160,9 +262,11 @@ class FSM(models.Model):
     hideNav = models.BooleanField(default=False)
     atime = models.DateTimeField('time submitted', default=timezone.now)
     addedBy = models.ForeignKey(User)
+    specHash = models.CharField(max_length=40, null=True)  # see fsmspec
 
     @classmethod
-    def save_graph(cls, fsmData, nodeData, edgeData, username, fsmGroups=(), oldLabel='OLD'):
+    def save_graph(cls, fsmData, nodeData, edgeData, username, fsmGroups=(), oldLabel='OLD',
+                   specHash=None):
         """Store FSM specification from node
 
         Store FSM specification from node, edge graph
@@ -172,6 +276,7 @@ class FSM(models.Model):
         using the old FSM will continue to work (following the old FSM spec),
         but any new activities will be created using the new FSM spec
         (since they request it by name).
+        Nodes and edges are stored with one bulk insert each.
         """
         user = User.objects.get(username=username)
         name = fsmData['name']
@@ -193,33 +298,41 @@ class FSM(models.Model):
                 for group in old.fsmgroup_set.all():
                     group.delete()
                 # old.fsmgroup_set.clear() # RelatedManager has no attribute clear
-            fsm = cls(addedBy=user, **fsmData)  # create new FSM
+            fsm = cls(addedBy=user, specHash=specHash, **fsmData)  # create new FSM
             fsm.save()
-            for groupName in fsmGroups:  # register in specified groups
-                fsm.fsmgroup_set.create(group=groupName)
-            nodes = {}
+            FSMGroup.objects.bulk_create([  # register in specified groups
+                FSMGroup(fsm=fsm, group=groupName) for groupName in fsmGroups
+            ])
+            newNodes = []
             for name, nodeDict in nodeData.items():  # save nodes
                 node = FSMNode(name=name, fsm=fsm, addedBy=user, **nodeDict)
                 if node.funcName:  # make sure plugin imports successfully
-                    get_plugin(node.funcName)
-                node.save()
-                nodes[name] = node
-                if name == 'START':
-                    fsm.startNode = node
-                    fsm.save()
+                    plugin_registry.get_plugin(node.funcName)
+                newNodes.append(node)
+            FSMNode.objects.bulk_create(newNodes)
+            nodes = dict((node.name, node) for node in fsm.fsmnode_set.all())  # get pks
+            if 'START' in nodes:
+                fsm.startNode = nodes['START']
+                fsm.save()
+            newEdges = []
             for edgeDict in edgeData:  # save edges
                 edgeDict = edgeDict.copy()  # don't modify input dict!
                 edgeDict['fromNode'] = nodes[edgeDict['fromNode']]
                 edgeDict['toNode'] = nodes[edgeDict['toNode']]
-                edge = FSMEdge(addedBy=user, **edgeDict)
-                edge.save()
+                newEdges.append(FSMEdge(addedBy=user, **edgeDict))
+            FSMEdge.objects.bulk_create(newEdges)
+        fsm_catalog.invalidate()  # new spec must be served by name
         return fsm
 
     def get_node(self, name):
         """
         Get node in this FSM with specified name.
         """
-        return self.fsmnode_set.get(name=name)
+        try:
+            return fsm_catalog.get_graph(self.pk).nodes[name]
+        except KeyError:
+            raise FSMNode.DoesNotExist('FSM %s has no node %s'
+                                       % (self.name, name))
 
 
 class FSMGroup(models.Model):
@@ -232,17 +345,12 @@ class FSMGroup(models.Model):
 
 class PluginDescriptor(object):
     """
-    Self-caching plugin access property.
+    Plugin access property, using the shared instance in plugin_registry.
     """
     def __get__(self, obj, objtype):
-        try:
-            return obj._pluginData
-        except AttributeError:
-            if not obj.funcName:
-                raise AttributeError('no plugin funcName')
-            klass = get_plugin(obj.funcName)
-            obj._pluginData = klass()
-            return obj._pluginData
+        if not obj.funcName:
+            raise AttributeError('no plugin funcName')
+        return plugin_registry.get_instance(obj.funcName)
 
     def __set__(self, obj, val):
         raise AttributeError('read only attribute!')
@@ -270,10 +378,9 @@ class FSMNode(JSONBlobMixin, models.Model):
         Process event using plugin if available, otherwise generic processing.
         """
         if self.funcName:  # use plugin to process event
-            if eventName:
-                func = getattr(self._plugin, eventName + '_event', None)
-            else:  # let plugin intercept render event
-                func = getattr(self._plugin, 'render_event', None)
+            events = plugin_registry.get_info(self.funcName).events
+            # no eventName: let plugin intercept render event
+            func = events.get(eventName or 'render')
             if func is not None:
                 return func(self, fsmStack, request, **kwargs)
         if eventName == 'start':  # default: just return our path
@@ -312,6 +419,12 @@ class FSMNode(JSONBlobMixin, models.Model):
         else:
             return func(self, state, request)
 
+    def get_outgoing(self):
+        """
+        Get list of edges leaving this node, from the FSM catalog.
+        """
+        return fsm_catalog.get_outgoing(self.pk)
+
 
 class FSMDone(ValueError):
     pass
@@ -348,22 +461,28 @@ class FSMEdge(JSONBlobMixin, models.Model):
         """
         Execute edge plugin code if any and return destination node.
         """
-        try:
-            func = getattr(self.fromNode._plugin, self.name + '_edge')
-        except AttributeError:  # just return target node
+        func = self._get_plugin_method('edges')
+        if func is None:  # just return target node
             return self.toNode
-        else:
-            return func(self, fsmStack, request, **kwargs)
+        return func(self, fsmStack, request, **kwargs)
     def filter_input(self, obj):
         """
         Use plugin code to check whether obj is acceptable input to this edge.
         """
-        try: # see if plugin code provides select_X_filter() call
-            func = getattr(self.fromNode._plugin, self.name + '_filter')
-        except AttributeError: # no plugin method, so accept by default
+        # see if plugin code provides select_X_filter() call
+        func = self._get_plugin_method('filters')
+        if func is None:  # no plugin method, so accept by default
             return True
-        else:
-            return func(self, obj)
+        return func(self, obj)
+
+    def _get_plugin_method(self, table):
+        """
+        Get this edge's method from fromNode plugin dispatch table, or None.
+        """
+        if not self.fromNode.funcName:
+            return None
+        info = plugin_registry.get_info(self.fromNode.funcName)
+        return getattr(info, table).get(self.name)
 
 
 class FSMState(JSONBlobMixin, models.Model):
@@ -387,6 +506,7 @@ class FSMState(JSONBlobMixin, models.Model):
     atime = models.DateTimeField('time started', default=timezone.now)
     activity = models.ForeignKey('ActivityLog', null=True)
     activityEvent = models.ForeignKey('ActivityEvent', null=True)
+    activityEventKey = models.CharField(max_length=32, null=True)  # if buffered
 
     def get_all_state_data(self):
         """
@@ -428,16 +548,21 @@ class FSMState(JSONBlobMixin, models.Model):
         """
         Execute the specified transition and return destination URL.
         """
-        try:
-            edge = self.fsmNode.outgoing.get(name=name)
-        except FSMEdge.DoesNotExist:
+        edge = fsm_catalog.get_edge(self.fsmNode_id, name)
+        if edge is None:
             return None  # FSM does not handle this event, return control
         if self.activityEvent:  # record exit from this node
             self.activityEvent.log_exit_event(name)
             self.activityEvent = None
+        elif self.activityEventKey:  # same, for buffered logging
+            activity_buffer.log_exit(self.activityEventKey, name)
+            self.activityEventKey = None
         self.fsmNode = edge.transition(fsmStack, request, **kwargs)
         self.path = self.fsmNode.get_path(self, request, **kwargs)
         self.save()
+        if self.isLiveSession:  # let linked students follow us
+            live_channel.publish(self.pk, 'transition', node=self.fsmNode.name,
+                                 unitLesson=self.unitLesson_id)
         return self.path
 
     def fsm_on_path(self, path):
@@ -452,6 +577,8 @@ class FSMState(JSONBlobMixin, models.Model):
         """
         if not self.fsmNode.doLogging:
             return
+        if activity_buffer.enabled:
+            return self.log_entry_buffered(user)
         if self.activityEvent and self.activityEvent.nodeName == self.fsmNode.name:
             return
         # NB: should probably extract unitLesson ID from request.path!!
@@ -470,15 +597,94 @@ class FSMState(JSONBlobMixin, models.Model):
             self.activity = self.activityEvent.activity
         self.save()
 
+    def log_entry_buffered(self, user):
+        """
+        Queue entry to this node in activity_buffer, instead of saving
+        an ActivityEvent now.
+        """
+        if self.activityEventKey:  # already logged; cleared on transition
+            return
+        if not self.activity_id:
+            self.activity = ActivityLog.get_cached(self.fsmNode.fsm.name)
+        self.activityEventKey = activity_buffer.log_entry(
+            self.activity_id, user.pk, self.fsmNode.name, self.unitLesson_id
+        )
+        self.save(update_fields=['activity', 'activityEventKey'])
+
     @classmethod
     def find_live_sessions(cls, user):
         """
-        Get live sessions relevant to this user.
+        Get LiveSession entries for the courses this user has a role in.
         """
-        return cls.objects.filter(
-            isLiveSession=True, activity__course__role__user=user
+        courseIDs = get_role_course_ids(user)
+        if not courseIDs:
+            return LiveSession.objects.none()
+        return LiveSession.objects.filter(course_id__in=courseIDs)
+
+
+# seconds to cache the ids of a user's courses (dropped on Role change)
+ROLE_COURSES_CACHE_TIMEOUT = getattr(settings, 'ROLE_COURSES_CACHE_TIMEOUT', 600)
+ROLE_COURSES_KEY = 'role_courses_%d'
+
+
+def get_role_course_ids(user):
+    """
+    Get (cached) list of ids of courses in which user has any role.
+    """
+    key = ROLE_COURSES_KEY % user.pk
+    courseIDs = cache.get(key)
+    if courseIDs is None:
+        courseIDs = list(Role.objects.filter(user=user)
+                         .values_list('course_id', flat=True).distinct())
+        cache.set(key, courseIDs, ROLE_COURSES_CACHE_TIMEOUT)
+    return courseIDs
+
+
+class LiveSession(models.Model):
+    """
+    Registry of running live sessions by course, for the home page.
+
+    The liveteach START node adds an entry; quitting the session removes
+    it, and so does deleting the instructor's FSMState.
+    """
+    state = models.OneToOneField(FSMState, primary_key=True, related_name='+')
+    course = models.ForeignKey('ct.Course')
+    courseTitle = models.CharField(max_length=200)
+    instructorName = models.CharField(max_length=200)
+    startTime = models.DateTimeField(default=timezone.now)
+
+    @classmethod
+    def start(cls, state, course):
+        """
+        Register state as a live session of course.
+        """
+        return cls.objects.create(
+            state=state, course=course, courseTitle=course.title,
+            instructorName=state.user.get_full_name(),
         )
 
+    @classmethod
+    def end(cls, state):
+        """
+        Unregister live session state, detaching all its students.
+        """
+        cls.objects.filter(state=state).delete()
+        state.linkChildren.update(linkState=None)
+
+
+class LiveEvent(models.Model):
+    """
+    Latest event published on a live session's channel (see live_channel).
+    """
+    state = models.ForeignKey(FSMState, related_name='+')
+    channel = models.CharField(max_length=16, default='')
+    version = models.IntegerField(default=0)
+    event = models.CharField(max_length=32)
+    data = models.TextField(null=True)
+
+    class Meta:
+        unique_together = ('state', 'channel')
+
 
 class ActivityLog(models.Model):
     """
@@ -488,6 +694,23 @@ class ActivityLog(models.Model):
     startTime = models.DateTimeField('time created', default=timezone.now)
     endTime = models.DateTimeField('time ended', null=True)
     course = models.ForeignKey(Course, null=True)
+    _cache = {}  # fsmName -> ActivityLog, for buffered logging
+
+    @classmethod
+    def get_cached(cls, fsmName):
+        """
+        Get (a copy of) the ActivityLog for fsmName, cached in this process.
+        """
+        try:
+            activityLog = cls._cache[fsmName]
+        except KeyError:
+            activityLog = cls._cache[fsmName] = \
+                cls.objects.get_or_create(fsmName=fsmName)[0]
+        return copy.copy(activityLog)
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cache.clear()
 
     @classmethod
     def log_node_entry(cls, fsmNode, user, unitLesson=None):
@@ -516,6 +739,7 @@ class ActivityEvent(models.Model):
     startTime = models.DateTimeField('time created', default=timezone.now)
     endTime = models.DateTimeField('time ended', null=True)
     exitEvent = models.CharField(max_length=64)
+    bufferKey = models.CharField(max_length=32, null=True, db_index=True)  # see activity_buffer
 
     def log_exit_event(self, eventName):
         """
@@ -524,3 +748,34 @@ class ActivityEvent(models.Model):
         self.exitEvent = eventName
         self.endTime = timezone.now()
         self.save()
+
+
+def fsm_graph_changed_handler(sender, **kwargs):
+    """
+    Drop compiled FSM graphs whenever the graph models are edited.
+    """
+    fsm_catalog.invalidate()
+
+for klass in (FSM, FSMGroup, FSMNode, FSMEdge):
+    post_save.connect(fsm_graph_changed_handler, sender=klass)
+    post_delete.connect(fsm_graph_changed_handler, sender=klass)
+
+
+def live_student_deleted_handler(sender, instance, **kwargs):
+    """
+    Keep the live session size tally in step when a student leaves.
+    """
+    if instance.linkState_id and instance.activity_id:
+        ResponseTally.add_student(instance.activity_id, -1)
+
+post_delete.connect(live_student_deleted_handler, sender=FSMState)
+
+
+def role_changed_handler(sender, instance, **kwargs):
+    """
+    Drop the cached course ids of the user whose Role changed.
+    """
+    cache.delete(ROLE_COURSES_KEY % instance.user_id)
+
+post_save.connect(role_changed_handler, sender=Role)
+post_delete.connect(role_changed_handler, sender=Role)
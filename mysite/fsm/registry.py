@@ -0,0 +1,181 @@
+"""
+Process-wide registry of FSM node plugins and sourceDB plugins.
+
+At app ready time every ``APP/fsm_plugin/*.py`` module and every
+``ct/sourcedb_plugin/*_plugin.py`` module is imported once.  Plugin node
+classes are stateless, so each class gets a single shared instance plus
+a dispatch table of its ``*_event``, ``*_edge`` and ``*_filter`` methods,
+replacing per-FSMNode instantiation and per-call getattr() lookups.
+
+warm_up() additionally loads the current FSM graphs into the FSM catalog;
+call it from the gunicorn master before forking (see mysite/gunicorn_conf.py)
+so that fresh workers start with everything already imported and compiled.
+"""
+import importlib
+import logging
+import os
+import pkgutil
+import threading
+
+from django.apps import apps
+
+
+LOGGER = logging.getLogger('fsm_plugins')
+
+SOURCEDB_PACKAGE = 'ct.sourcedb_plugin'
+
+
+class PluginInfo(object):
+    """
+    Shared instance of one plugin class and its method dispatch tables.
+    """
+    def __init__(self, klass):
+        self.klass = klass
+        self.instance = klass()
+        self.events = {}  # event name -> bound method
+        self.edges = {}  # edge name -> bound method
+        self.filters = {}  # edge name -> bound method
+        for attr in dir(klass):
+            for suffix, table in (('_event', self.events),
+                                  ('_edge', self.edges),
+                                  ('_filter', self.filters)):
+                if attr.endswith(suffix) and len(attr) > len(suffix):
+                    method = getattr(self.instance, attr)
+                    if callable(method):
+                        table[attr[:-len(suffix)]] = method
+
+
+class PluginRegistry(object):
+    """
+    Thread-safe cache of plugin classes by funcName.
+
+    Anything not found by discover() is imported on first use, exactly as
+    fsm.utils.get_plugin() does.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._klasses = {}  # funcName -> class
+        self._info = {}  # funcName -> PluginInfo
+        self._sourceDB = {}  # sourceDB name -> LessonDoc class
+        self.discovered = False
+
+    def discover(self):
+        """
+        Import all FSM and sourceDB plugin modules of installed apps.
+        """
+        with self._lock:
+            for appConfig in apps.get_app_configs():
+                if os.path.isdir(os.path.join(appConfig.path, 'fsm_plugin')):
+                    self._import_package(appConfig.name + '.fsm_plugin',
+                                         self._register_fsm_module)
+            if apps.is_installed('ct'):
+                self._import_package(SOURCEDB_PACKAGE,
+                                     self._register_sourceDB_module)
+            self.discovered = True
+
+    def _import_package(self, packageName, registerFunc):
+        try:
+            package = importlib.import_module(packageName)
+        except ImportError as e:
+            LOGGER.warning('cannot import plugin package %s: %s', packageName, e)
+            return
+        for _, modName, isPackage in pkgutil.iter_modules(package.__path__):
+            if isPackage:
+                continue
+            modName = '%s.%s' % (packageName, modName)
+            try:  # e.g. optional dependency missing: fail on use, not now
+                mod = importlib.import_module(modName)
+            except Exception as e:
+                LOGGER.warning('cannot import plugin module %s: %s', modName, e)
+                continue
+            registerFunc(mod)
+
+    def _register_fsm_module(self, mod):
+        for name, obj in vars(mod).items():
+            if isinstance(obj, type) and obj.__module__ == mod.__name__:
+                self._klasses['%s.%s' % (mod.__name__, name)] = obj
+
+    def _register_sourceDB_module(self, mod):
+        name = mod.__name__.split('.')[-1]
+        if name.endswith('_plugin') and hasattr(mod, 'LessonDoc'):
+            self._sourceDB[name[:-len('_plugin')]] = mod.LessonDoc
+
+    def get_plugin(self, funcName):
+        """
+        Get plugin class; raises ImportError / AttributeError if invalid.
+        """
+        try:
+            return self._klasses[funcName]
+        except KeyError:
+            pass
+        from fsm.utils import get_plugin
+        klass = get_plugin(funcName)
+        with self._lock:
+            self._klasses[funcName] = klass
+        return klass
+
+    def get_info(self, funcName):
+        """
+        Get PluginInfo (shared instance and dispatch tables) for funcName.
+        """
+        try:
+            return self._info[funcName]
+        except KeyError:
+            pass
+        klass = self.get_plugin(funcName)
+        with self._lock:
+            try:
+                return self._info[funcName]
+            except KeyError:
+                info = self._info[funcName] = PluginInfo(klass)
+                return info
+
+    def get_instance(self, funcName):
+        'get the shared plugin instance for funcName'
+        return self.get_info(funcName).instance
+
+    def get_sourceDB_plugin(self, sourceDB):
+        """
+        Get the LessonDoc class of the named sourceDB plugin.
+        """
+        try:
+            return self._sourceDB[sourceDB]
+        except KeyError:
+            pass
+        mod = importlib.import_module('%s.%s_plugin'
+                                      % (SOURCEDB_PACKAGE, sourceDB))
+        with self._lock:
+            self._sourceDB[sourceDB] = mod.LessonDoc
+        return mod.LessonDoc
+
+    def get_sourceDB_names(self):
+        """
+        Get sorted names of all sourceDB plugins.
+        """
+        if not self.discovered:
+            self.discover()
+        with self._lock:
+            return sorted(self._sourceDB)
+
+    def warm_up(self, loadGraphs=True):
+        """
+        Prepare this process to serve FSM requests without import or
+        graph-loading delays.  Returns (nPlugins, nGraphs).
+        """
+        if not self.discovered:
+            self.discover()
+        for funcName in list(self._klasses):
+            try:
+                self.get_info(funcName)
+            except Exception as e:  # not a node plugin, e.g. needs init args
+                LOGGER.debug('not a plugin class %s: %s', funcName, e)
+        nGraphs = 0
+        if loadGraphs:
+            from fsm.models import FSM
+            from fsm.catalog import fsm_catalog
+            for fsmID in FSM.objects.values_list('pk', flat=True):
+                fsm_catalog.get_graph(fsmID)
+                nGraphs += 1
+        return len(self._info), nGraphs
+
+plugin_registry = PluginRegistry()
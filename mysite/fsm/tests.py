@@ -1,19 +1,40 @@
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from mock import patch
+
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, DatabaseError
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
 
 from fsm.fsm_base import FSMStack
+from fsm.catalog import fsm_catalog
+from fsm.registry import plugin_registry
+from fsm.activity_buffer import ActivityBuffer, EXIT_RETRIES
+from fsm.live_channel import LiveChannel, live_channel, INSTRUCTOR_CHANNEL
 from fsm.models import (
     FSM,
     FSMNode,
     FSMState,
     ActivityLog,
+    ActivityEvent,
     JSONBlobMixin
 )
 from ct.models import (
+    Role,
     Course,
     Unit,
     Lesson,
     UnitLesson,
     Response,
+    ResponseTally,
+    StudentError,
+    UnitLessonStats,
     DONE_STATUS
 )
 from ct.tests import (
@@ -85,6 +106,10 @@ class FSMTests(OurTestCase):
             dict(name='next', fromNode='START', toNode='END', title='go go go'),
             dict(name='select_Lesson', fromNode='MID', toNode='MID', title='go go go'),
         )
+        ActivityLog.clear_cache()
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.spillFile = os.path.join(tmpdir, 'spill.jsonl')
 
     def test_load(self):
         """
@@ -145,6 +170,32 @@ class FSMTests(OurTestCase):
         self.assertEqual(d2, {'fruity': self.unit, 'anumber': 3,
                               'astring': 'jeff'})
 
+    def test_json_blob_lazy(self):
+        """
+        Check that blob objects are loaded per class, on first access.
+        """
+        unit2 = Unit(title='Another Courselet', addedBy=self.user)
+        unit2.save()
+        f = FSM.save_graph(self.fsmDict, self.nodeDict, self.edgeDict, 'jacob')
+        f.startNode.save_json_data(dict(unit=self.unit, unit2=unit2,
+                                        course=self.course, anumber=3))
+        node = FSMNode.objects.get(pk=f.startNode.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(node.get_data_attr('anumber'), 3)
+        with self.assertNumQueries(1):  # one in_bulk() for both units
+            self.assertEqual(node.get_data_attr('unit'), self.unit)
+            self.assertEqual(node.get_data_attr('unit2'), unit2)
+        node.set_data_attr('anumber', 4)
+        with self.assertNumQueries(1):  # just the UPDATE, course not loaded
+            node.save_json_data()
+        node = FSMNode.objects.get(pk=f.startNode.pk)  # eager loading
+        with self.assertNumQueries(2):
+            d = node.load_json_id_dict(node.data)
+        self.assertEqual(d, dict(unit=self.unit, unit2=unit2,
+                                 course=self.course, anumber=4))
+        self.course.delete()
+        self.assertRaises(Course.DoesNotExist, node.get_data_attr, 'course')
+
     def test_start(self):
         """
         Check basic startup of new FSM instance.
@@ -203,6 +254,58 @@ class FSMTests(OurTestCase):
         self.assertEqual(ae.exitEvent, 'select_Lesson')
         self.assertIsNone(fsmStack.state.activityEvent)
 
+    def test_buffered_logging(self):
+        """
+        Check that buffered logging writes node entry / exit on flush().
+        """
+        buf = ActivityBuffer(enabled=True, spillFile=self.spillFile, background=False)
+        f = FSM.save_graph(self.fsmDict, self.nodeDict, self.edgeDict, 'jacob')
+        with patch('fsm.models.activity_buffer', buf):
+            fsmStack = self.do_start(f, unitLesson=self.unitLesson)
+            request = FakeRequest(self.user, method='GET')
+            fsmStack.event(request, None)  # render event: log entry
+            fsmStack.event(request, None)  # already logged
+            self.assertEqual(buf.pending(), 1)
+            self.assertEqual(ActivityEvent.objects.count(), 0)
+            self.assertEqual(fsmStack.state.activity.fsmName, 'test')
+            request = FakeRequest(self.user)
+            fsmStack.event(request, 'select_Lesson', lesson=self.lesson)  # exit
+            self.assertIsNone(fsmStack.state.activityEventKey)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(buf.flush(), 2)
+            writes = [q['sql'] for q in queries if 'SAVEPOINT' not in q['sql']]
+            self.assertEqual(len(writes), 1)  # entry + exit = one INSERT
+            ae = ActivityEvent.objects.get()
+            self.assertEqual((ae.nodeName, ae.exitEvent, ae.unitLesson, ae.user),
+                             ('MID', 'select_Lesson', self.unitLesson, self.user))
+            self.assertTrue(ae.endTime > ae.startTime)
+            fsmStack.event(FakeRequest(self.user, method='GET'), None)
+            buf.flush()  # entry first
+            fsmStack.event(request, 'select_Lesson', lesson=self.lesson)
+            self.assertEqual(buf.flush(), 1)  # then exit
+            ae = ActivityEvent.objects.get(bufferKey__isnull=False, pk__gt=ae.pk)
+            self.assertEqual(ae.exitEvent, 'select_Lesson')
+
+    def test_buffered_logging_spill(self):
+        """
+        Check that records which cannot be written are spilled and replayed.
+        """
+        buf = ActivityBuffer(enabled=True, spillFile=self.spillFile, background=False)
+        activityID = ActivityLog.get_cached('test').pk
+        key = buf.log_entry(activityID, self.user.pk, 'MID')
+        with patch.object(buf, 'write', side_effect=DatabaseError('down')):
+            self.assertEqual(buf.flush(), 0)
+        self.assertTrue(os.path.exists(self.spillFile))
+        buf.log_exit(key, 'next')
+        buf.log_exit('unknown', 'next')  # entry never logged
+        self.assertEqual(buf.flush(), 2)
+        self.assertFalse(os.path.exists(self.spillFile))
+        self.assertEqual(ActivityEvent.objects.get(bufferKey=key).exitEvent, 'next')
+        for i in range(EXIT_RETRIES):
+            self.assertEqual(buf.pending(), 1)  # retried, then dropped
+            buf.flush()
+        self.assertEqual(buf.pending(), 0)
+
     def do_start(self, f, **kwargs):
         """
         Run tests of basic startup of new FSM instance.
@@ -241,6 +344,58 @@ class FSMTests(OurTestCase):
         self.assertEqual(f.startNode.get_path(fsmStack.state, request),
                          '/ct/some/where/else/')
 
+    def test_plugin_registry(self):
+        """
+        Check plugin discovery, shared instances and dispatch tables.
+        """
+        from ct.fsm_plugin import lessonseq
+        from ct.sourcedb_plugin import wikipedia_plugin
+        self.assertTrue(plugin_registry.discovered)
+        self.assertIs(plugin_registry.get_plugin('ct.fsm_plugin.lessonseq.START'),
+                      lessonseq.START)
+        self.assertIs(plugin_registry.get_sourceDB_plugin('wikipedia'),
+                      wikipedia_plugin.LessonDoc)
+        self.assertEqual(plugin_registry.get_sourceDB_names(),
+                         ['localfile', 'wikipedia'])
+        info = plugin_registry.get_info('fsm.fsm_plugin.testme.START')
+        self.assertEqual(sorted(info.events), ['start'])
+        self.assertEqual(sorted(info.edges), ['next'])
+        self.assertEqual(plugin_registry.get_info('fsm.fsm_plugin.testme.MID').filters.keys(),
+                         ['next'])
+        f = FSM.save_graph(self.fsmDict, self.nodeDict, self.edgeDict, 'jacob')
+        node = FSMNode.objects.get(pk=f.startNode.pk)
+        self.assertIs(node._plugin, f.startNode._plugin)  # one per class
+        self.assertIs(node._plugin, info.instance)
+        nPlugins, nGraphs = plugin_registry.warm_up()
+        self.assertTrue(nPlugins > 2)
+        self.assertEqual(nGraphs, 1)
+
+    def test_deploy(self):
+        """
+        Check that deploy() skips unchanged specs, and diff() reports changes.
+        """
+        from fsm.fsmspec import deploy
+        from fsm.fsm_plugin.testme import get_specs
+        fsm_list = deploy('ct.fsm_plugin.lessonseq', 'jacob')
+        self.assertEqual([fsm.name for fsm in fsm_list], ['lessonseq'])
+        with self.assertNumQueries(1):  # no writes
+            self.assertEqual(deploy('ct.fsm_plugin.lessonseq', 'jacob'), [])
+        self.assertEqual(len(deploy('ct.fsm_plugin.lessonseq', 'jacob', force=True)), 1)
+        spec = get_specs()[0]
+        self.assertEqual(spec.diff(), ['new FSM'])
+        f = spec.save_graph('jacob')
+        self.assertEqual(f.startNode.outgoing.get().toNode.name, 'END')
+        self.assertEqual(spec.diff(), [])
+        spec.nodeData['MID']['title'] = 'somewhere else'
+        del spec.nodeData['END']
+        spec.edgeData.append(dict(name='back', fromNode='MID', toNode='START', title='go back'))
+        self.assertNotEqual(spec.get_hash(), spec.specHash)
+        spec.specHash = spec.get_hash()
+        self.assertEqual(spec.diff(), ['- node END', '~ node MID: title', '+ edge MID.back'])
+        out = StringIO()
+        call_command('fsm_deploy', 'ct.fsm_plugin.lessonseq', dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'FSM `lessonseq` is unchanged.\n')
+
     def test_bad_funcName(self):
         """
         Check that FSM.save_graph() catches bad plugin funcName.
@@ -339,6 +494,307 @@ class FSMTests(OurTestCase):
         url2 = '/ct/courses/%d/units/%d/concepts/' % (self.course.pk, self.ulQ2.unit.pk)
         self.check_post_get(url, dict(fsmtask='next'), url2, 'Pretest')
 
+    def test_catalog(self):
+        """
+        Check that a warm FSM catalog runs transitions without graph queries.
+        """
+        f = FSM.save_graph(self.fsmDict, self.nodeDict, self.edgeDict, 'jacob',
+                           fsmGroups=('teach/unit_tasks',))
+        fsmStack = self.do_start(f)
+        request = FakeRequest(self.user, dict(fsmID=fsmStack.state.pk))
+        self.assertEqual([fsm.pk for fsm in fsm_catalog.get_group('teach/unit_tasks')],
+                         [f.pk])
+        with CaptureQueriesContext(connection) as queries:
+            fsmStack = FSMStack(request)
+            self.assertEqual(fsmStack.select_Lesson.toNode.name, 'MID')
+            fsmStack.event(request, 'select_Lesson', lesson=self.lesson)
+            self.assertEqual(fsmStack.state.fsmNode.name, 'MID')
+            self.assertEqual(fsm_catalog.get_group('teach/unit_tasks')[0].name, 'test')
+        self.assertTrue(len(queries) > 0)  # state load / save still queried
+        for query in queries:
+            for table in ('"fsm_fsm"', '"fsm_fsmnode"', '"fsm_fsmedge"', '"fsm_fsmgroup"'):
+                self.assertNotIn(table, query['sql'])
+
+    def test_catalog_invalidate(self):
+        """
+        Check that save_graph() makes the catalog serve the new FSM.
+        """
+        f = FSM.save_graph(self.fsmDict, self.nodeDict, self.edgeDict, 'jacob')
+        self.assertEqual(fsm_catalog.get_fsm('test').pk, f.pk)
+        f2 = FSM.save_graph(self.fsmDict, self.nodeDict, self.edgeDict, 'jacob')
+        self.assertEqual(fsm_catalog.get_fsm('test').pk, f2.pk)
+        self.assertEqual(fsm_catalog.get_fsm('test').startNode.pk, f2.startNode.pk)
+        self.assertEqual(fsm_catalog.get_fsm('testOLD').pk, f.pk)
+        self.assertEqual(f.get_node('END').fsm_id, f.pk)  # old FSM still works
+        self.assertIsNone(fsm_catalog.get_edge(f2.startNode.pk, 'invalid'))
+        self.assertRaises(FSMNode.DoesNotExist, f2.get_node, 'invalid')
+
+    def test_live_channel(self):
+        """
+        Check publish / wait versioning, and that live transitions publish.
+        """
+        f = FSM.save_graph(self.fsmDict, self.nodeDict, self.edgeDict, 'jacob')
+        fsmStack = self.do_start(f)
+        state = fsmStack.state
+        channel = LiveChannel(pollInterval=0.05)
+        self.assertIsNone(channel.get_latest(state.pk))
+        self.assertIsNone(channel.wait(state.pk, 0, timeout=0.1))
+        self.assertEqual(channel.publish(state.pk, 'counts').version, 1)
+        msg = channel.publish(state.pk, 'counts', n=3)
+        self.assertEqual(msg.version, 2)
+        msg = channel.wait(state.pk, 1, timeout=0.1)
+        self.assertEqual((msg.version, msg.event, msg.data), (2, 'counts', dict(n=3)))
+        self.assertIsNone(channel.wait(state.pk, 2, timeout=0.1))
+        # only live session transitions are published
+        fsmStack.event(FakeRequest(self.user), 'select_Lesson', lesson=self.lesson)
+        self.assertEqual(channel.get_latest(state.pk).version, 2)
+        state.isLiveSession = True
+        fsmStack.event(FakeRequest(self.user), 'select_Lesson', lesson=self.lesson)
+        msg = channel.get_latest(state.pk)
+        self.assertEqual((msg.version, msg.event), (3, 'transition'))
+        self.assertEqual(msg.data, dict(node='MID', unitLesson=None))
+        # the instructor channel is separate, and so are its versions
+        msg = channel.publish((state.pk, INSTRUCTOR_CHANNEL), 'counts')
+        self.assertEqual(msg.version, 1)
+        self.assertEqual(channel.get_latest(state.pk).version, 3)
+        msg = channel.wait((state.pk, INSTRUCTOR_CHANNEL), 0, timeout=0.1)
+        self.assertEqual((msg.version, msg.event), (1, 'counts'))
+
+    def test_live_events(self):
+        """
+        Check the live_events view, as long-poll and as event stream.
+        """
+        f = FSM.save_graph(self.fsmDict, self.nodeDict, self.edgeDict, 'jacob')
+        state = self.do_start(f).state
+        live_channel.publish((state.pk, INSTRUCTOR_CHANNEL), 'counts')
+        url = '/fsm/live/%d/events/' % state.pk
+        response = self.client.get(url, dict(since=0))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content),
+                         dict(version=1, event='counts', data={}))
+        with patch.object(live_channel, 'wait', return_value=None):
+            response = self.client.get(url, dict(since=1))
+        self.assertEqual(json.loads(response.content),
+                         dict(version=1, event='timeout', data={}))
+        with patch('fsm.views.LIVE_CHANNEL_TIMEOUT', 0.1):
+            response = self.client.get(url, HTTP_ACCEPT='text/event-stream')
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            self.assertEqual(''.join(response.streaming_content),
+                             'retry: 1000\n\nid: 1\nevent: counts\ndata: {}\n\n')
+        # students of this session may listen, others may not
+        User.objects.create_user(username='student', password='pw')
+        self.client.login(username='student', password='pw')
+        self.assertEqual(self.client.get(url).status_code, 404)
+        studentState = FSMState.objects.create(
+            user=User.objects.get(username='student'), fsmNode=state.fsmNode,
+            linkState=state
+        )
+        live_channel.publish(state.pk, 'transition', node='MID')
+        live_channel.publish((state.pk, INSTRUCTOR_CHANNEL), 'counts')
+        response = self.client.get(url, dict(since=0))
+        self.assertEqual(json.loads(response.content),  # no counts for us
+                         dict(version=1, event='transition',
+                              data=dict(node='MID')))
+        with patch('fsm.views.LIVE_CHANNEL_TIMEOUT', 0.1):
+            response = self.client.get(url, HTTP_LAST_EVENT_ID='1',
+                                       HTTP_ACCEPT='text/event-stream')
+            self.assertEqual(''.join(response.streaming_content),
+                             'retry: 1000\n\n')
+        studentState.linkState = None  # session ended
+        studentState.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_live_session_push(self):
+        """
+        Check that live session pages follow the instructor via live_events.
+        """
+        from ct.fsm_plugin.live import get_specs
+        from ct.fsm_plugin.livestudent import get_specs as get_specs2
+        get_specs()[0].save_graph(self.user.username)
+        get_specs2()[0].save_graph(self.user.username)
+        fsmData = dict(unit=self.ulQ.unit, course=self.course)
+        request, fsmStack, result = self.get_fsm_request('liveteach', fsmData)
+        fsmStack.event(request, 'next')  # instructor now at CHOOSE
+        liveState = fsmStack.state
+        eventsURL = '/fsm/live/%d/events/' % liveState.pk
+        User.objects.create_user(username='student', password='pw')
+        self.client.login(username='student', password='pw')
+        response = self.client.post('/ct/', dict(liveID=liveState.pk))
+        url = response['Location']  # START page of livestudent
+        self.assertContains(self.client.get(url), eventsURL)
+        response = self.post_from_page(url, dict(fsmedge='next'))
+        url = response['Location']
+        response = self.client.get(url)
+        self.assertContains(response, 'Wait for the Instructor')
+        self.assertContains(response, 'liveListen("%s", 1,' % eventsURL)
+        # instructor poses the question: student page is told to advance
+        fsmStack.event(request, 'select_UnitLesson', unitLesson=self.ulQ)
+        msg = json.loads(self.client.get(eventsURL, dict(since=1)).content)
+        self.assertEqual((msg['event'], msg['data']['node']), ('transition', 'QUESTION'))
+        response = self.post_from_page(url, dict(fsmedge='next'))
+        self.assertTrue(response['Location'].endswith('/ask/'))
+        # student response updates the instructor's counts
+        self.post_from_page(response['Location'],
+                            dict(text='i dunno', confidence=Response.GUESS))
+        self.assertEqual(live_channel.get_latest(
+            (liveState.pk, INSTRUCTOR_CHANNEL)).event, 'counts')
+        self.assertEqual(live_channel.get_latest(liveState.pk).event,
+                         'transition')  # students are not woken by counts
+        with self.assertNumQueries(1):
+            statusTable = ResponseTally.get_counts(
+                liveState.activity_id, self.ulQ, tableKey='confidence',
+                simpleTable=True)[0]
+        self.assertEqual(statusTable.data, ['100% (1)', '0% (0)', '0% (0)', '0% (0)'])
+
+    def test_live_session_registry(self):
+        """
+        Check the live session registry behind the home page.
+        """
+        from ct.fsm_plugin.live import get_specs
+        get_specs()[0].save_graph(self.user.username)
+        student = User.objects.create_user(username='student', password='pw')
+        self.assertEqual(list(FSMState.find_live_sessions(student)), [])
+        Role.objects.create(course=self.course, user=student)  # drops cache
+        fsmData = dict(unit=self.ulQ.unit, course=self.course)
+        request, fsmStack, result = self.get_fsm_request('liveteach', fsmData)
+        liveState = fsmStack.state
+        FSMState.find_live_sessions(student)  # cache course ids
+        with self.assertNumQueries(1):
+            liveSessions = list(FSMState.find_live_sessions(student))
+        self.assertEqual([ls.state_id for ls in liveSessions], [liveState.pk])
+        self.assertEqual(liveSessions[0].courseTitle, 'Great Course')
+        self.client.login(username='student', password='pw')
+        response = self.client.get('/ct/')
+        self.assertContains(response, 'name="liveID" value="%d"' % liveState.pk)
+        studentStates = [
+            FSMState.objects.create(user=student, fsmNode=liveState.fsmNode,
+                                    linkState=liveState)
+            for i in range(3)
+        ]
+        fsmStack.event(request, 'next')  # CHOOSE
+        fsmStack.event(request, 'select_UnitLesson', unitLesson=self.ulQ)
+        fsmStack.event(request, 'next')  # ANSWER
+        with CaptureQueriesContext(connection) as queries:
+            liveState.transition(fsmStack, request, 'quit')
+        self.assertEqual(liveState.fsmNode.name, 'END')
+        self.assertEqual(len([q for q in queries if 'SET "linkState_id" =' in q['sql']]), 1)
+        self.assertEqual(list(FSMState.find_live_sessions(student)), [])
+        self.assertFalse(FSMState.objects.filter(pk__in=[s.pk for s in studentStates],
+                                                 linkState__isnull=False).exists())
+
+    def test_live_loadtest(self):
+        """
+        Check that the live session load test runs and cleans up after itself.
+        """
+        from ct.fsm_plugin.live import get_specs
+        from ct.fsm_plugin.livestudent import get_specs as get_specs2
+        get_specs()[0].save_graph(self.user.username)
+        get_specs2()[0].save_graph(self.user.username)
+        nUsers = User.objects.count()
+        out, err = StringIO(), StringIO()
+        call_command('live_loadtest', students=3, concurrency=1, questions=2,
+                     seed=1, stdout=out, stderr=err)
+        self.assertEqual(err.getvalue(), '')
+        report = out.getvalue()
+        for label in ('WAIT_ASK', 'ASK', 'WAIT_ASSESS', 'ASSESS', 'ERRORS',
+                      'POST ul_respond', 'GET live_question'):
+            self.assertIn('\n%s ' % label, report)
+        self.assertEqual(User.objects.count(), nUsers)
+        self.assertFalse(Course.objects.filter(title__startswith='Load test').exists())
+
+    def test_response_tally(self):
+        """
+        Check that tallies track response edits and match a rebuild.
+        """
+        activity = ActivityLog.objects.create(fsmName='liveteach', course=self.course)
+        ResponseTally.start_session(activity)
+        ResponseTally.add_student(activity.pk, 3)
+        responses = []
+        for confidence in (Response.GUESS, Response.SURE, Response.SURE):
+            r = Response.objects.create(
+                lesson=self.ulQ.lesson, unitLesson=self.ulQ, course=self.course,
+                text='foo', confidence=confidence, author=self.user,
+                activity=activity
+            )
+            ResponseTally.count_response(r)
+            responses.append(r)
+        r = responses[1]
+        for selfeval in (Response.DIFFERENT, Response.CORRECT):  # re-assessed
+            old = (r.confidence, r.selfeval, r.status)
+            r.selfeval, r.status = selfeval, DONE_STATUS
+            r.save()
+            ResponseTally.count_response(r, old)
+        def get_tables():
+            return [(t.data if hasattr(t, 'data') else t) for t in
+                    ResponseTally.get_counts(activity.pk, self.ulQ)]
+        tables = get_tables()
+        self.assertEqual(tables[0], ['0% (0)', '0% (0)', '33% (1)', '67% (2)'])
+        self.assertEqual(tables[1][2], ('Pretty sure', ['0% (0)', '0% (0)', '33% (1)']))
+        self.assertEqual(tables[2], 3)
+        query = Q(unitLesson=self.ulQ, activity=activity, selfeval__isnull=False)
+        self.assertEqual(tables[1], Response.get_counts(query, n=3)[1])
+        ResponseTally.objects.filter(key='responses').update(count=99)  # drift
+        self.assertEqual(ResponseTally.rebuild(activity.pk), 6)
+        self.assertEqual(ResponseTally.objects.get(key='responses').count, 3)
+        self.assertEqual(get_tables(), tables)
+
+    def test_unitlesson_stats(self):
+        """
+        Check that the response rollup tracks saves and deletes and
+        matches a rebuild.
+        """
+        emLesson = Lesson.objects.create(title='an error', text='oops',
+                                         kind=Lesson.ERROR_MODEL,
+                                         addedBy=self.user, treeID=1)
+        em = UnitLesson.objects.create(unit=self.ulQ.unit, lesson=emLesson,
+                                       kind=UnitLesson.MISUNDERSTANDS,
+                                       parent=self.ulQ, addedBy=self.user,
+                                       treeID=emLesson.treeID)
+        responses = [Response.objects.create(
+            lesson=self.ulQ.lesson, unitLesson=self.ulQ, course=self.course,
+            text='foo', confidence=confidence, author=self.user
+        ) for confidence in (Response.GUESS, Response.SURE, Response.SURE)]
+        Response.objects.create(  # not counted
+            lesson=self.ulQ.lesson, unitLesson=self.ulQ, course=self.course,
+            text='why?', kind=Response.STUDENT_QUESTION, author=self.user
+        )
+        for r in responses:
+            r = Response.objects.get(pk=r.pk)  # as loaded by a view
+            r.selfeval, r.status = Response.DIFFERENT, DONE_STATUS
+            r.save()
+            r.studenterror_set.create(errorModel=em, author=self.user)
+        r.selfeval = Response.CORRECT  # re-assessed
+        r.save()
+        r.studenterror_set.all().delete()
+        Response.objects.get(pk=responses[0].pk).delete()
+        def get_tables():
+            return [(t.data if hasattr(t, 'data') else t) for t in
+                    UnitLessonStats.get_counts(self.ulQ)]
+        tables = get_tables()
+        query = Q(unitLesson=self.ulQ, selfeval__isnull=False,
+                  kind=Response.ORCT_RESPONSE)
+        expected = Response.get_counts(query)
+        self.assertEqual(tables, [expected[0].data, expected[1], 2])
+        with self.assertNumQueries(2):
+            errorTable = UnitLessonStats.get_error_counts(
+                UnitLessonStats.get_dict(self.ulQ), 2)
+            self.assertEqual(errorTable[0][0].lesson.title, 'an error')
+        query = Q(response__unitLesson=self.ulQ)
+        self.assertEqual(errorTable, StudentError.get_counts(query, 2))
+        UnitLessonStats.objects.filter(key='responses').update(count=99)  # drift
+        call_command('rebuild_stats', stdout=StringIO())
+        self.assertEqual(UnitLessonStats.objects.get(key='responses').count, 2)
+        self.assertEqual(get_tables(), tables)
+        self.assertEqual(UnitLessonStats.get_error_counts(
+            UnitLessonStats.get_dict(self.ulQ), 2), errorTable)
+
+    def post_from_page(self, url, postdata):
+        'POST as if submitted from the page at url'
+        origin = 'http://testserver'
+        if not url.startswith(origin):
+            url = origin + url
+        return self.client.post(url, postdata, HTTP_REFERER=url, HTTP_ORIGIN=origin)
+
     def get_fsm_request(self, fsmName, stateData, startArgs=None, **kwargs):
         """
         Create request, fsmStack and start specified FSM.
@@ -1,10 +1,11 @@
 from django.conf.urls import url, patterns
 
-from fsm.views import fsm_node, fsm_status
+from fsm.views import fsm_node, fsm_status, live_events
 
 
 urlpatterns = patterns(
     '',
     url(r'^nodes/(?P<node_id>\d+)/$', fsm_node, name='fsm_node'),
-    url(r'^nodes/$', fsm_status, name='fsm_status')
+    url(r'^nodes/$', fsm_status, name='fsm_status'),
+    url(r'^live/(?P<state_id>\d+)/events/$', live_events, name='live_events'),
 )
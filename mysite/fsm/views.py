@@ -1,5 +1,14 @@
+import json
+import time
+
+from django.db.models import Q
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect
+from django.http import (
+    HttpResponseRedirect,
+    HttpResponse,
+    HttpResponseNotFound,
+    StreamingHttpResponse,
+)
 from django.contrib.auth.decorators import login_required
 
 from fsm.models import (
@@ -7,6 +16,9 @@ from fsm.models import (
     FSMBadUserError,
     FSMStackResumeError,
 )
+from fsm.live_channel import (
+    live_channel, INSTRUCTOR_CHANNEL, LIVE_CHANNEL_TIMEOUT
+)
 from ct.views import PageData
 from ct.forms import (
     set_crispy_action,
@@ -25,9 +37,18 @@ def fsm_node(request, node_id):
         return HttpResponseRedirect('/ct/')
     if request.method == 'POST' and 'fsmedge' in request.POST:
         return pageData.fsm_redirect(request, request.POST['fsmedge'])
-    addNextButton = (pageData.fsmStack.state.fsmNode.outgoing.count() == 1)
+    addNextButton = (len(pageData.fsmStack.state.fsmNode.get_outgoing()) == 1)
+    liveState_id = pageData.fsmStack.state.linkState_id
+    if liveState_id:  # follow the live session instead of polling by hand
+        latest = live_channel.get_latest(liveState_id)
+        templateArgs = dict(
+            liveEventsURL=reverse('fsm:live_events', args=(liveState_id,)),
+            liveVersion=latest.version if latest else 0,
+        )
+    else:
+        templateArgs = None
     return pageData.render(
-        request, 'fsm/fsm_node.html', addNextButton=addNextButton
+        request, 'fsm/fsm_node.html', templateArgs, addNextButton=addNextButton
     )
 
 
@@ -62,7 +83,7 @@ def fsm_status(request):
             pageData.fsmStack.pop(request, eventName='exceptCancel')
             pageData.statusMessage = 'Activity canceled.'
         # follow this optional edge
-        elif pageData.fsmStack.state.fsmNode.outgoing.filter(name=task).count() > 0:
+        elif [e for e in pageData.fsmStack.state.fsmNode.get_outgoing() if e.name == task]:
             return pageData.fsm_redirect(request, task, vagueEvents=())
     if not pageData.fsmStack.state:  # search for unfinished activities
         unfinished = FSMState.objects.filter(user=request.user, children__isnull=True)
@@ -70,8 +91,8 @@ def fsm_status(request):
         unfinished = None
         cancelForm = CancelForm()
         set_crispy_action(request.path, cancelForm)
-        edges = pageData.fsmStack.state.fsmNode.outgoing
-        nextSteps = edges.filter(showOption=True)
+        edges = pageData.fsmStack.state.fsmNode.get_outgoing()
+        nextSteps = [e for e in edges if e.showOption]
         logoutForm = LogoutForm()
         set_crispy_action(
             reverse('ct:person_profile', args=(request.user.id,)),
@@ -87,3 +108,62 @@ def fsm_status(request):
             nextSteps=nextSteps
         )
     )
+
+
+def _sse_stream(channelID, since, timeout):
+    'yield Server-Sent Events blocks for channel events newer than since'
+    yield 'retry: 1000\n\n'
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return  # client reconnects, sending Last-Event-ID
+        msg = live_channel.wait(channelID, since, remaining)
+        if msg is None:
+            return
+        since = msg.version
+        yield 'id: %d\nevent: %s\ndata: %s\n\n' % (
+            msg.version, msg.event, json.dumps(msg.data)
+        )
+
+
+@login_required
+def live_events(request, state_id):
+    """
+    Wait for events on a live session channel (the instructor's FSMState).
+
+    Long-poll: GET ?since=VERSION returns the next event as JSON, or a
+    'timeout' event carrying the same version.  Clients that accept
+    text/event-stream get the events as Server-Sent Events instead.
+    Only the instructor and the students linked to the session may listen.
+    The instructor gets the session's instructor channel (response counts),
+    and students its session channel (instructor transitions).
+    """
+    state_id = int(state_id)
+    stateIDs = list(FSMState.objects.filter(
+        Q(pk=state_id) | Q(linkState_id=state_id), user=request.user
+    ).values_list('pk', flat=True))
+    if not stateIDs:
+        return HttpResponseNotFound('no such live session')
+    if state_id in stateIDs:
+        channelID = (state_id, INSTRUCTOR_CHANNEL)
+    else:
+        channelID = state_id
+    try:
+        since = int(request.META.get('HTTP_LAST_EVENT_ID') or
+                    request.GET.get('since', 0))
+    except ValueError:
+        since = 0
+    if 'text/event-stream' in request.META.get('HTTP_ACCEPT', ''):
+        response = StreamingHttpResponse(
+            _sse_stream(channelID, since, LIVE_CHANNEL_TIMEOUT),
+            content_type='text/event-stream'
+        )
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # tell nginx not to buffer
+        return response
+    msg = live_channel.wait(channelID, since)
+    data = msg.as_dict() if msg else dict(version=since, event='timeout', data={})
+    response = HttpResponse(json.dumps(data), content_type='application/json')
+    response['Cache-Control'] = 'no-cache'
+    return response
@@ -66,3 +66,88 @@ def check_anonymous():
             if user_session.session.expire_date < now:
                 user_session.session.delete()
                 user_session.user.delete()
+
+
+@app.task
+def render_lessons(force=False):
+    """Pre-render lesson HTML
+
+    Fill LessonHTML for lessons lacking HTML from the current renderer
+    version, e.g. after a deploy that bumps RENDERER_VERSION.
+    """
+    call_command('render_lessons', force=force)
+
+
+@app.task
+def flush_activity_log():
+    """Write buffered FSM activity log
+
+    Flush this process's ActivityEvent buffer, which includes
+    replaying any records spilled to FSM_ACTIVITY_SPILL_FILE
+    by web workers that could not write them.
+    """
+    from fsm.activity_buffer import activity_buffer
+    return activity_buffer.flush()
+
+
+@app.task
+def reconcile_response_tallies():
+    """Rebuild live session tallies
+
+    Recount the ResponseTally counters of running live sessions from
+    their Response rows, correcting any drift in the live tables.
+    """
+    call_command('rebuild_tallies')
+
+
+@app.task
+def purge_sourcedb_cache():
+    """Delete expired sourceDB lookups
+
+    Remove SourceDBEntry rows (cached Wikipedia pages and searches)
+    whose TTL has passed.
+    """
+    from ct.sourcedb_cache import purge_expired
+    return purge_expired()
+
+
+@app.task(bind=True)
+def fork_course(self, course_id, user_id, title=None):
+    """Fork a course
+
+    Copy a course with all its courselets for the specified user (see
+    Course.fork), reporting PROGRESS with the number of courselets done.
+    Returns the new course id.
+    """
+    from ct.models import Course
+    def progress(done, total):
+        self.update_state(state='PROGRESS', meta=dict(done=done, total=total))
+    course = Course.objects.get(pk=course_id)
+    return course.fork(User.objects.get(pk=user_id), title, progress).pk
+
+
+@app.task(bind=True)
+def fork_unit(self, unit_id, user_id, title=None):
+    """Fork a courselet
+
+    Copy a courselet with all its lessons, answers, error models and
+    resolutions for the specified user (see Unit.fork), reporting PROGRESS
+    with the number of UnitLessons copied.  Returns the new unit id.
+    """
+    from ct.models import Unit
+    def progress(done, total):
+        self.update_state(state='PROGRESS', meta=dict(done=done, total=total))
+    unit = Unit.objects.get(pk=unit_id)
+    return unit.fork(User.objects.get(pk=user_id), title, progress).pk
+
+
+@app.task
+def compress_lesson_history():
+    """Delta-compress old lesson versions
+
+    Store the text of Lesson versions that are no longer heads or in use
+    as compressed deltas from their parent versions (see
+    ct.version_store).  Returns the number of versions compressed.
+    """
+    from ct.models import LessonDelta
+    return LessonDelta.compress_all()
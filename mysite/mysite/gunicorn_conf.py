@@ -0,0 +1,51 @@
+"""
+gunicorn settings for serving mysite.wsgi, e.g.::
+
+  $ gunicorn -c mysite/gunicorn_conf.py mysite.wsgi
+
+The app is loaded once in the master process, which also imports all
+plugins and loads the FSM graphs (see fsm.registry) before forking, so
+workers inherit a warm process instead of paying for it on their first
+student request.
+
+Workers are gevent workers: every student page in a live session keeps a
+live_events request open (see fsm.live_channel), so each worker must
+serve many waiting requests at once.
+"""
+import multiprocessing
+
+if __name__ == '__config__':  # read by gunicorn -c, not just imported
+    # patch before the app is preloaded, so the thread-locals it creates at
+    # import (e.g. Django's db connections) are per greenlet in the workers
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = '127.0.0.1:8000'
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_class = 'gevent'
+worker_connections = 1000  # open requests per worker, mostly live listeners
+preload_app = True
+
+
+def when_ready(server):
+    'warm up plugins and FSM graphs in the master, before workers fork'
+    from django.core.cache import cache
+    from django.db import connections
+    from fsm.registry import plugin_registry
+    try:
+        nPlugins, nGraphs = plugin_registry.warm_up()
+        server.log.info('warmed up %d FSM plugins, %d FSM graphs',
+                        nPlugins, nGraphs)
+    except Exception:  # serve anyway, just cold
+        server.log.exception('FSM warm-up failed')
+    finally:  # workers must not share the master's sockets
+        for conn in connections.all():
+            conn.close()
+        cache.close()
+
+
+def post_worker_init(worker):
+    '''build the concept autocomplete index in the background, per worker:
+    a load started in the master would not survive the fork'''
+    from ct.concept_index import concept_index
+    concept_index.start_loading()
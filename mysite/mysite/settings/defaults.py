@@ -242,7 +242,23 @@ CELERYBEAT_SCHEDULE = {
     'check_anonymous': {
         'task': 'mysite.celery.check_anonymous',
         'schedule': timedelta(days=1),
-    }
+    },
+    'flush_activity_log': {  # replays spilled FSM_ACTIVITY_LOGGING records
+        'task': 'mysite.celery.flush_activity_log',
+        'schedule': timedelta(minutes=1),
+    },
+    'reconcile_response_tallies': {  # recounts live session tables
+        'task': 'mysite.celery.reconcile_response_tallies',
+        'schedule': timedelta(minutes=5),
+    },
+    'purge_sourcedb_cache': {  # deletes expired Wikipedia lookups
+        'task': 'mysite.celery.purge_sourcedb_cache',
+        'schedule': timedelta(days=1),
+    },
+    'compress_lesson_history': {  # stores old lesson versions as deltas
+        'task': 'mysite.celery.compress_lesson_history',
+        'schedule': timedelta(days=1),
+    },
 }
 
 # Cache settings